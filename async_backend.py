@@ -0,0 +1,225 @@
+import time
+import asyncio
+import logging
+
+import serial
+
+from backend import WaitEngine, openPort, dispenseCommand, aspirateCommand, strokeTime
+from protocol import PumpProtocolError, CommandSet, isNak, matchesCommand, parseStatus, parsePosition
+
+
+class AsyncSerialPort():
+    '''
+    Non-blocking serial transport for the event loop.
+
+    The port is opened with timeout=0 and watched with loop.add_reader, so
+    reading never blocks a thread. Complete CR-terminated frames are handed
+    to read_frame through a queue. reset drops frames nobody asked for, such
+    as the late reply to a command that timed out.
+    '''
+
+    def __init__(self, serialObject, loop=None):
+        self.serialObject = serialObject
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.buffer = bytearray()
+        self.frames = asyncio.Queue()
+        self.loop.add_reader(self.serialObject.fileno(), self._on_readable)
+
+
+    def _on_readable(self):
+        self.buffer += self.serialObject.read(self.serialObject.in_waiting or 1)
+        while True:
+            cr = self.buffer.find(b'\r')
+            if cr < 0:
+                break
+            self.frames.put_nowait(bytes(self.buffer[:cr + 1]))
+            del self.buffer[:cr + 1]
+
+
+    def write(self, data):
+        self.serialObject.write(data)
+
+    def reset(self):
+        # Discard anything buffered or queued, so the next frames read belong to the next command.
+        self.buffer.clear()
+        while not self.frames.empty():
+            self.frames.get_nowait()
+        self.serialObject.reset_input_buffer()
+
+    async def read_frame(self, timeout=10):
+        try:
+            return await asyncio.wait_for(self.frames.get(), timeout)
+        except asyncio.TimeoutError:
+            raise serial.SerialTimeoutException('Timed out waiting for a response from the pump.')
+
+    def close(self):
+        self.loop.remove_reader(self.serialObject.fileno())
+        self.serialObject.close()
+
+
+
+class AsyncPumpObject():
+    '''
+    Coroutine counterpart of backend.pumpObject.
+
+    Waiting for the pump to finish a move is an asyncio.sleep rather than a
+    blocked thread, so one event loop can supervise many pumps (or a pump
+    and other devices) at once. Exchanges on the port are serialised by a
+    lock, which is only held for a single command and its two frames.
+    '''
+
+    def __init__(self, waitEngine=None):
+        self.__PUMP_CONNECTION__ = 0 # 0 = Disconnected, 1 = Connected
+        self.__PUMP_STATUS__ = 0 # 0 = Uninitialised, 1 = Ready, 2 = Busy
+        self.__PUMP_STOP__ = 0 # 0 = Nothing, 1 = Immediate stop, break all pumping loops.
+        self.transferRunning = False # As backend.pumpObject.transferRunning.
+
+        self.__direction__ = '' # Aspirate or dispense.
+        self.__pumping_volume__ = 0 ## ul.
+        self.__flow_rate__ = 0 # ul/minute.
+        self.__pumped_volume__ = 0 # ul.
+        self.__total_volume__ = 0 # ul.
+        self.__time_start__ = 0 # unix time stamp.
+        self.__time_estimated__ = 0 # seconds.
+
+        self.waitEngine = waitEngine if waitEngine is not None else WaitEngine()
+        self.commandSet = CommandSet('a')
+        self.port = None
+        self.lock = None
+
+
+    async def connect(self, serial_port, baud=9600, timeout=10):
+        logging.info('Attempting to connect to %s.' % (serial_port))
+        try:
+            serialObject = openPort(serial_port, baud, timeout=0)
+        except serial.SerialException:
+            logging.info('Unable to connect to device.')
+            return
+
+        self.port = AsyncSerialPort(serialObject)
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        self.__PUMP_CONNECTION__ = 1
+        logging.info('Connected to %s.' % (serialObject.name))
+
+        # Setup hardware address
+        ack, recv = await self.query(self.commandSet.autoAddress)
+        logging.info(recv)
+        await self.waitReady()
+
+
+    async def disconnect(self):
+        self.port.close()
+        self.__PUMP_CONNECTION__ = 0
+        self.__PUMP_STATUS__ = 0
+        logging.info('Disconnected.')
+
+
+    async def query(self, command):
+        async with self.lock:
+            # No exchange is outstanding under the lock, anything already buffered is stray.
+            if self.port.buffer or not self.port.frames.empty():
+                self.port.reset()
+            self.port.write(command)
+            try:
+                ack = await self.port.read_frame(self.timeout)
+                response = await self.port.read_frame(self.timeout)
+                if not matchesCommand(command, response):
+                    raise PumpProtocolError('Response %r does not match command %r.' % (response, command))
+                isNak(ack) # Raises on a malformed ack.
+            except (serial.SerialTimeoutException, PumpProtocolError):
+                self.port.reset() # Out of step with the pump, drop whatever is buffered.
+                raise
+        return ack, response
+
+
+    async def status(self):
+        ack, statusBytes = await self.query(self.commandSet.status)
+        status = parseStatus(statusBytes)
+        if status is not None:
+            self.__PUMP_STATUS__ = status
+        return self.__PUMP_STATUS__
+
+    async def waitReady(self, expected=0.0, stoppable=False):
+        ## Wait for the pump to go idle, polling as the predicted end of the move approaches.
+        self.__PUMP_STATUS__ = 2
+        delays = self.waitEngine.delays(expected)
+        while self.__PUMP_STATUS__ == 2:
+            if self.__PUMP_STOP__ == 1:
+                if stoppable:
+                    break
+                await asyncio.sleep(self.waitEngine.min_interval)
+            else:
+                end = time.monotonic() + next(delays)
+                while self.__PUMP_STOP__ == 0 and time.monotonic() < end:
+                    await asyncio.sleep(min(end - time.monotonic(), self.waitEngine.tick))
+            await self.status()
+
+
+    async def initialise(self):
+        ack, recv = await self.query(self.commandSet.initialise)
+        logging.info(recv)
+        await self.waitReady()
+
+
+    async def stop(self):
+        self.__PUMP_STOP__ = 1
+        await self.query(self.commandSet.halt)
+        await self.query(self.commandSet.clear)
+        logging.info('Stopping pump! Clearing command queue.')
+        await self.waitReady()
+        if not self.transferRunning: # A stop of an idle pump must not carry over to the next transfer.
+            self.__PUMP_STOP__ = 0
+        logging.info('Pump stopped.')
+
+
+    async def dispense(self, syringe='A+B', dispense=2500, syringe_volume=500.0, expected=0.0):
+        logging.info("Dispensing syringe to waste.")
+        self.__direction__ = 'Dispensing'
+        self.__pumping_volume__ = syringe_volume
+        self.__flow_rate__ = dispense
+
+        await self.query(dispenseCommand(syringe, dispense, syringe_volume))
+        await self.waitReady(expected, stoppable=True)
+
+
+    async def pump(self, syringe='A+B', volume=100, aspirate=1000, dispense=2500, syringe_volume=500.0, stroke_steps=1000.0):
+        ## Pump volumes greater than the syringe volume one stroke at a time.
+        self.__pumped_volume__ = 0
+        self.__total_volume__ = volume
+        self.__time_start__ = time.time()
+
+        volume_remaining = volume
+        self.transferRunning = True
+        try:
+            while volume_remaining > 0 and self.__PUMP_STOP__ == 0:
+                stroke_volume = min(volume_remaining, syringe_volume)
+                await self.pumpSingleStroke(syringe, stroke_volume, aspirate, dispense, stroke_steps, syringe_volume)
+                volume_remaining -= stroke_volume
+                self.__pumped_volume__ = volume - volume_remaining
+        finally:
+            self.transferRunning = False
+            self.__PUMP_STOP__ = 0
+
+
+    async def pumpSingleStroke(self, syringe='A+B', volume=100, aspirate=1000, dispense=2500, stroke_steps=1000.0, syringe_volume=500.0):
+        steps_to_pump = volume*stroke_steps/syringe_volume
+
+        ack, posB = await self.query(self.commandSet.position['B'])
+        ack, posC = await self.query(self.commandSet.position['C'])
+        posB, posC = parsePosition(posB), parsePosition(posC)
+
+        # If syringe does not have enough volume available, dump the volume to waste.
+        if posB + steps_to_pump > stroke_steps or posC + steps_to_pump > stroke_steps:
+            travel = max(posB, posC)
+            await self.dispense(syringe, dispense, syringe_volume, strokeTime(travel, dispense, syringe_volume, stroke_steps))
+            if self.__PUMP_STOP__ == 1:
+                return
+
+        logging.info('Aspirating %d uL.' % (volume))
+        self.__direction__ = 'Aspirating'
+        self.__pumping_volume__ = volume
+        self.__flow_rate__ = aspirate
+
+        await self.query(aspirateCommand(syringe, steps_to_pump, aspirate, syringe_volume))
+        await self.waitReady(strokeTime(steps_to_pump, aspirate, syringe_volume, stroke_steps, valve_switches=2), stoppable=True)
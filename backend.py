@@ -1,25 +1,665 @@
+import os
+import json
+import types
+import collections
 import serial
 import time
+import queue
 import logging
-from datetime import datetime
+import logging.handlers
+import itertools
+import threading
+from concurrent.futures import Future, CancelledError
+
+from telemetry import Telemetry
+from serialtrace import TraceRecorder, TracingSerial
+from protocol import (PumpProtocolError, CONTINUOUS, SYRINGES, CommandSet, encode, aspirateBody, emptyBody,
+    syringeBody, syringeCommand, commandTokens, startsRun, isNak, matchesCommand, replyAddress, parseStatus,
+    parsePosition, parseConfig)
 
 
 
 
 
 ## Configure the logger.
+# Records go to a size-rotated log file and to an in-memory ring buffer the GUI drains.
 
-LOG_FILE = '%s_microlab.log' % (datetime.now().strftime("%Y:%m:%d:%H:%M:%S"))
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
-    level=logging.INFO, filename=LOG_FILE)
+LOG_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'microlab', 'microlab.log') # Wherever the tools are started from.
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_FILE_BYTES = 1000000 # Rotate the log file at this size.
+LOG_FILE_BACKUPS = 5
 
 
-class pumpObject():
+class RingBufferHandler(logging.Handler):
+    '''
+    Keeps the most recent formatted log lines in a bounded buffer.
+
+    Readers take everything logged since their last call with drain. When
+    the buffer is full the oldest lines are dropped and counted.
+    '''
+
+    def __init__(self, capacity=5000):
+        super(RingBufferHandler, self).__init__()
+        self.lines = collections.deque(maxlen=capacity)
+        self.dropped = 0
+
+    def emit(self, record):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(self.format(record))
+
+    def drain(self):
+        lines = []
+        self.acquire()
+        try:
+            while self.lines:
+                lines.append(self.lines.popleft())
+            if self.dropped:
+                lines.insert(0, '... %d log lines dropped.' % (self.dropped))
+                self.dropped = 0
+        finally:
+            self.release()
+        return lines
+
+
+LOG_BUFFER = RingBufferHandler()
+
+
+def configureLogging(filename=LOG_FILE):
+    ## Sends log records to the rotated log file and LOG_BUFFER. Called by the entry points, not on import.
+    root = logging.getLogger()
+    if LOG_BUFFER in root.handlers:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    fileHandler = logging.handlers.RotatingFileHandler(filename, maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS)
+    fileHandler.setFormatter(formatter)
+    LOG_BUFFER.setFormatter(formatter)
+
+    root.setLevel(logging.INFO)
+    root.addHandler(fileHandler)
+    root.addHandler(LOG_BUFFER)
+
+
+class FrameReader():
+    '''
+    Frames CR-terminated responses from the pump.
+
+    Bytes are drained from the serial port in bulk into a reusable buffer,
+    and a read only blocks (up to the port timeout) when no complete frame
+    is buffered. The time spent in each read_frame call is recorded in
+    last_latency, total_latency and calls.
+    '''
+
+    def __init__(self, serialObject, size=256):
+        self.serialObject = serialObject
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # First unread byte.
+        self.end = 0 # One past the last received byte.
+
+        self.calls = 0
+        self.last_latency = 0.0 # seconds.
+        self.total_latency = 0.0 # seconds.
+
+
+    def read_frame(self):
+        t0 = time.perf_counter()
+        while True:
+            cr = self.buffer.find(b'\r', self.start, self.end)
+            if cr >= 0:
+                break
+            self._fill()
+
+        frame = bytes(self.view[self.start:cr + 1])
+        self.start = cr + 1
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        self.last_latency = time.perf_counter() - t0
+        self.total_latency += self.last_latency
+        self.calls += 1
+        return frame
+
+
+    def reset(self):
+        # Discard anything buffered, e.g. after reconnecting.
+        self.start = self.end = 0
+        self.serialObject.reset_input_buffer()
+
+
+    def _fill(self):
+        if self.start > 0: # Move the partial frame to the front of the buffer.
+            length = self.end - self.start
+            self.buffer[:length] = self.view[self.start:self.end]
+            self.start, self.end = 0, length
+
+        if self.end == len(self.buffer): # Frame larger than the buffer, grow it.
+            self.view.release()
+            self.buffer.extend(bytes(len(self.buffer)))
+            self.view = memoryview(self.buffer)
+
+        # Take everything already waiting, or block for the next byte.
+        wanted = max(1, min(self.serialObject.in_waiting, len(self.buffer) - self.end))
+        received = self.serialObject.readinto(self.view[self.end:self.end + wanted])
+        if not received:
+            raise serial.SerialTimeoutException('Timed out waiting for a response from the pump.')
+        self.end += received
+
+
+
+## Serial I/O priorities, lowest value is sent first.
+PRIORITY_ABORT = 0
+PRIORITY_STATUS = 1
+PRIORITY_MOTION = 2
+
+
+class PumpCommand():
+    '''A command waiting for the serial I/O thread, ordered by priority then submission.'''
+
+    _sequence = itertools.count()
+
+    def __init__(self, command, priority=PRIORITY_MOTION, generation=None):
+        self.command = command
+        self.priority = priority
+        self.generation = generation # Abort generation of the program the command belongs to, see SerialIOThread.generation.
+        self.sequence = next(self._sequence)
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class SerialIOThread(threading.Thread):
+    '''
+    Sole owner of the serial port once connected.
+
+    Commands are taken from a priority queue (abort > status > motion) and
+    exchanged one at a time, so the ack and response frames read after each
+    write always belong to that command. Each submit returns a Future that
+    resolves to the (ack, response) frames. Exchanges are recorded in the
+    optional telemetry.Telemetry.
+
+    Every abort starts a new generation for the addresses it covers. A
+    command submitted with the generation its program started in is
+    cancelled instead of sent once that address has been aborted, so a
+    program can not finish queueing, and start, after a stop.
+    '''
+
+    def __init__(self, serialObject, reader, telemetry=None):
+        super(SerialIOThread, self).__init__(name='SerialIOThread', daemon=True)
+        self.serialObject = serialObject
+        self.reader = reader
+        self.telemetry = telemetry
+        self.commands = queue.PriorityQueue()
+        self.aborts = collections.Counter() # Aborts by address, None for those of every address.
+        self.abortLock = threading.Lock()
+
+
+    def submit(self, command, priority=PRIORITY_MOTION, generation=None):
+        pumpCommand = PumpCommand(command, priority, generation)
+        self.commands.put(pumpCommand)
+        return pumpCommand.future
+
+
+    def generation(self, address):
+        ## Count of the aborts that covered address so far.
+        address = address.encode('ascii') if isinstance(address, str) else address
+        with self.abortLock:
+            return self.aborts[None] + self.aborts[address]
+
+
+    def abort(self, commands, addresses=None):
+        ## Cancels every motion command still waiting (for addresses, if given) and sends commands ahead of everything else.
+        # Only the exchange already on the wire, if any, is sent before them.
+        addresses = None if addresses is None else [address.encode('ascii') for address in addresses]
+        with self.abortLock:
+            self.aborts.update([None] if addresses is None else addresses)
+        with self.commands.mutex:
+            pending = [pumpCommand for pumpCommand in self.commands.queue if pumpCommand.priority == PRIORITY_MOTION
+                and (addresses is None or pumpCommand.command[:1] in addresses)]
+        for pumpCommand in pending:
+            pumpCommand.future.cancel()
+        return [self.submit(command, PRIORITY_ABORT) for command in commands]
+
+
+    def stop(self):
+        # Jump the queue, then cancel anything still waiting.
+        self.commands.put(PumpCommand(None, PRIORITY_ABORT - 1))
+        self.join()
+        while not self.commands.empty():
+            self.commands.get_nowait().future.cancel()
+
+
+    def run(self):
+        while True:
+            pumpCommand = self.commands.get()
+            if pumpCommand.command is None:
+                break
+            if pumpCommand.generation is not None and pumpCommand.generation != self.generation(pumpCommand.command[:1]):
+                pumpCommand.future.cancel() # Its program was aborted after it started queueing.
+            if not pumpCommand.future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                pumpCommand.future.set_result(self.exchange(pumpCommand.command))
+            except Exception as e:
+                pumpCommand.future.set_exception(e)
+
+
+    def exchange(self, command):
+        t0 = time.perf_counter()
+        ack = response = None
+        try:
+            self.serialObject.write(command)
+            ack = self.reader.read_frame()
+            response = self.reader.read_frame()
+
+            # Responses carry the address the command was sent to, or the last address 1x assigned along the chain.
+            if not matchesCommand(command, response):
+                raise PumpProtocolError('Response %r does not match command %r.' % (response, command))
+            isNak(ack) # Raises PumpProtocolError if the ack is garbled.
+        except Exception as e:
+            if isinstance(e, PumpProtocolError):
+                self.reader.reset() # Out of step with the pump, drop whatever is buffered.
+            if self.telemetry is not None:
+                self.telemetry.recordCommand(command, ack, response, time.perf_counter() - t0, e)
+            raise
+
+        if self.telemetry is not None:
+            self.telemetry.recordCommand(command, ack, response, time.perf_counter() - t0)
+        return ack, response
+
+
+def openPort(port, baud=9600, timeout=10, **kwargs):
+    ## Opens port with the MicroLab's line settings, 7 data bits, odd parity and 1 stop bit.
+    # Exclusive, so another process (or a discovery probe) can not open the port under us.
+    return serial.Serial(port, baud, parity=serial.PARITY_ODD, bytesize=7, stopbits=serial.STOPBITS_ONE,
+        timeout=timeout, exclusive=True, **kwargs)
+
+
+def openTransport(serial_port, baud=9600, tracePath=None, telemetry=None):
+    ## (serialObject, FrameReader, started SerialIOThread) for a port name or an open serial-like object.
+    serialObject = openPort(serial_port, baud) if isinstance(serial_port, str) else serial_port
+    if tracePath is not None:
+        serialObject = TracingSerial(serialObject, TraceRecorder(tracePath))
+    reader = FrameReader(serialObject)
+    io = SerialIOThread(serialObject, reader, telemetry)
+    io.start()
+    return serialObject, reader, io
+
+
+
+## Instrument speed limits, seconds per full stroke.
+MIN_SECONDS_PER_STROKE = 1
+MAX_SECONDS_PER_STROKE = 250
+
+
+def secondsPerStroke(rate, syringe_volume=500.0):
+    # Instrument speed is seconds per full stroke, convert from ul/minute.
+    return round(syringe_volume/(rate/60.0))
+
+
+def rateLimits(syringe_volume=500.0):
+    # Minimum and maximum flow rates in ul/minute for a syringe.
+    return syringe_volume*60.0/MAX_SECONDS_PER_STROKE, syringe_volume*60.0/MIN_SECONDS_PER_STROKE
+
+
+def rateInRange(rate, syringe_volume=500.0):
+    return rate > 0 and MIN_SECONDS_PER_STROKE <= secondsPerStroke(rate, syringe_volume) <= MAX_SECONDS_PER_STROKE
+
+
+def dispenseCommand(syringe, dispense=2500, syringe_volume=500.0, address='a'):
+    # Empty the syringe through the output valve.
+    return syringeCommand(syringe, emptyBody(secondsPerStroke(dispense, syringe_volume)), address)
+
+
+def aspirateCommand(syringe, steps, aspirate=1000, syringe_volume=500.0, address='a'):
+    # Draw steps through the input valve, then switch to the output.
+    return syringeCommand(syringe, aspirateBody(steps, secondsPerStroke(aspirate, syringe_volume)), address)
+
+
+VALVE_SWITCH_TIME = 0.2 # seconds, estimated time for one valve switch.
+
+
+class TimingModel():
+    '''
+    Predicts how long the instrument takes to run commands.
+
+    Moving steps at S seconds per full stroke takes
+    speed_scale*steps/stroke_steps*S seconds plus valve_switch_time for each
+    valve switch, and every command sent costs command_latency. The defaults
+    are nominal, timing.fitTimingModel calibrates them against measured moves.
+    '''
+
+    def __init__(self, speed_scale=1.0, valve_switch_time=VALVE_SWITCH_TIME, command_latency=0.02, initialise_time=2.0):
+        self.speed_scale = speed_scale
+        self.valve_switch_time = valve_switch_time # seconds.
+        self.command_latency = command_latency # seconds.
+        self.initialise_time = initialise_time # seconds.
+
+    def moveTime(self, steps, seconds_per_stroke, valve_switches=0, stroke_steps=1000.0):
+        return self.speed_scale*steps/stroke_steps*seconds_per_stroke + valve_switches*self.valve_switch_time
+
+    def strokeTime(self, steps, rate, syringe_volume=500.0, stroke_steps=1000.0, valve_switches=0):
+        # Seconds to move the plunger steps at rate ul/minute, as rounded by the instrument.
+        return self.moveTime(steps, secondsPerStroke(rate, syringe_volume), valve_switches, stroke_steps)
+
+
+NOMINAL_TIMING = TimingModel()
+
+## Calibrated timing models by serial port, written by timing.py --calibrate.
+TIMING_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'microlab', 'timing.json')
+
+
+def loadTimingModel(port, path=TIMING_FILE):
+    ## The TimingModel calibrated for port, or a nominal one if it has not been calibrated.
+    try:
+        with open(path) as fh:
+            return TimingModel(**json.load(fh)[port])
+    except (OSError, ValueError, KeyError, TypeError):
+        return TimingModel()
+
+
+def saveTimingModel(timing, port, path=TIMING_FILE):
+    ## Saves the TimingModel calibrated for port, keeping those of other ports.
+    try:
+        with open(path) as fh:
+            models = json.load(fh)
+    except (OSError, ValueError):
+        models = {}
+    models[port] = vars(timing)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(models, fh, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def strokeTime(steps, rate, syringe_volume=500.0, stroke_steps=1000.0, valve_switches=0):
+    return NOMINAL_TIMING.strokeTime(steps, rate, syringe_volume, stroke_steps, valve_switches)
+
+
+class TransferProgram():
+    '''
+    A transfer compiled into queued instrument commands.
+
+    commands are sent in order, only the last one carries the R that starts
+    execution. phases holds the predicted (direction, volume, flow rate,
+    seconds, volume transferred once finished) of each move so the host can
+    follow progress without polling. positions holds the plunger positions
+    at the end of each phase, from those in start. latency is the predicted
+    time spent sending the commands.
+    '''
 
     def __init__(self):
+        self.commands = []
+        self.phases = []
+        self.start = {}
+        self.positions = []
+        self.latency = 0.0
+
+    def segments(self):
+        # (seconds, plunger positions at the end) of each phase, see predictPositions.
+        return [(phase[3], positions) for phase, positions in zip(self.phases, self.positions)]
+
+    @property
+    def duration(self):
+        return self.latency + sum(phase[3] for phase in self.phases)
+
+
+def compileTransfer(syringe='A+B', volume=100, aspirate=1000, dispense=2500, syringe_volume=500.0, stroke_steps=1000.0,
+        positions=None, address='a', max_command_length=250, timing=None):
+    ## Compiles a multi-stroke transfer into one on-pump program, chunked into commands of at most max_command_length bytes.
+    timing = timing or NOMINAL_TIMING
+    program = TransferProgram()
+    positions = dict(positions or {'B': 0, 'C': 0})
+    program.start = dict(positions)
+    names = SYRINGES[syringe]
+
+    dispense_body = emptyBody(secondsPerStroke(dispense, syringe_volume))
+    bodies = []
+    volume_remaining = volume
+    while volume_remaining > 0:
+        stroke_volume = min(volume_remaining, syringe_volume)
+        steps = int(stroke_volume*stroke_steps/syringe_volume)
+        stroke = ''
+
+        # If a syringe does not have enough room, dump it to waste first.
+        travel = max(positions[name] for name in names)
+        if travel + steps > stroke_steps:
+            stroke += dispense_body
+            program.phases.append(('Dispensing', syringe_volume, dispense,
+                timing.strokeTime(travel, dispense, syringe_volume, stroke_steps), volume - volume_remaining))
+            positions.update((name, 0) for name in names)
+            program.positions.append(dict(positions))
+
+        stroke += aspirateBody(steps, secondsPerStroke(aspirate, syringe_volume))
+        volume_remaining -= stroke_volume
+        program.phases.append(('Aspirating', stroke_volume, aspirate,
+            timing.strokeTime(steps, aspirate, syringe_volume, stroke_steps, valve_switches=2), volume - volume_remaining))
+        positions.update((name, positions[name] + steps) for name in names)
+        program.positions.append(dict(positions))
+
+        bodies.append(syringeBody(syringe, stroke))
+
+    chunk = ''
+    for body in bodies:
+        if chunk and len(address) + len(chunk) + len(body) + 2 > max_command_length:
+            program.commands.append(encode(address, chunk))
+            chunk = ''
+        chunk += body
+    program.commands.append(encode(address, chunk, run=True))
+    program.latency = timing.command_latency*len(program.commands)
+    return program
+
+
+def compileContinuousTransfer(volume=100, aspirate=1000, dispense=2500, syringe_volume=500.0, stroke_steps=1000.0,
+        positions=None, address='a', timing=None):
+    ## Compiles a continuous-flow transfer: each command dispenses one syringe while the other aspirates the next stroke.
+    # Flow only pauses between strokes if aspirating is slower than dispensing.
+    timing = timing or NOMINAL_TIMING
+    program = TransferProgram()
+    positions = dict(positions or {'B': 0, 'C': 0})
+    program.start = dict(positions)
+    aspirate_speed = secondsPerStroke(aspirate, syringe_volume)
+    dispense_body = emptyBody(secondsPerStroke(dispense, syringe_volume), after='')
+    bodies = []
+
+    # Start with both syringes empty.
+    if positions['B'] > 0 or positions['C'] > 0:
+        bodies.append('B%sC%s' % (dispense_body, dispense_body))
+        program.phases.append(('Dispensing', syringe_volume, dispense,
+            timing.strokeTime(max(positions.values()), dispense, syringe_volume, stroke_steps, valve_switches=1), 0))
+        program.positions.append({'B': 0, 'C': 0})
+    positions = {'B': 0, 'C': 0}
+
+    strokes = []
+    volume_remaining = volume
+    while volume_remaining > 0:
+        strokes.append(min(volume_remaining, syringe_volume))
+        volume_remaining -= strokes[-1]
+
+    filling, emptying = 'B', 'C'
+    delivered = 0
+    previous = None # (volume, steps) waiting in the emptying syringe.
+    for stroke_volume in strokes + [None]:
+        half_cycle = {}
+        seconds = 0
+        if stroke_volume is not None:
+            steps = int(stroke_volume*stroke_steps/syringe_volume)
+            half_cycle[filling] = aspirateBody(steps, aspirate_speed, after='')
+            seconds = timing.strokeTime(steps, aspirate, syringe_volume, stroke_steps, valve_switches=1)
+            positions[filling] = steps
+        if previous is not None:
+            half_cycle[emptying] = dispense_body
+            positions[emptying] = 0
+            seconds = max(seconds, timing.strokeTime(previous[1], dispense, syringe_volume, stroke_steps, valve_switches=1))
+            delivered += previous[0]
+            program.phases.append(('Dispensing', previous[0], dispense, seconds, delivered))
+        else:
+            program.phases.append(('Aspirating', stroke_volume, aspirate, seconds, delivered))
+        program.positions.append(dict(positions))
+
+        bodies.append(''.join(name + half_cycle[name] for name in 'BC' if name in half_cycle))
+        previous = (stroke_volume, steps) if stroke_volume is not None else None
+        filling, emptying = emptying, filling
+
+    # One command per half cycle keeps the syringes in step, the last one starts the program.
+    program.commands = [encode(address, body) for body in bodies[:-1]]
+    program.commands.append(encode(address, bodies[-1], run=True))
+    program.latency = timing.command_latency*len(program.commands)
+    return program
+
+
+def predictPositions(start, segments, elapsed):
+    ## Plunger positions elapsed seconds into segments of (seconds, positions at the end), moving steadily from start.
+    positions = dict(start)
+    elapsed = max(elapsed, 0.0)
+    for seconds, end in segments:
+        if elapsed < seconds:
+            fraction = elapsed/seconds
+            return dict((name, None if step is None or end[name] is None else int(round(step + (end[name] - step)*fraction)))
+                for name, step in positions.items())
+        elapsed -= seconds
+        positions.update(end)
+    return positions
+
+
+def trackPositions(positions, command):
+    ## Applies the plunger moves in a motion command to a {syringe: steps} model.
+    syringe = None
+    for letter, digits in commandTokens(command):
+        if letter in positions:
+            syringe = letter
+        elif letter == 'X': # Initialising homes both plungers.
+            for name in positions:
+                positions[name] = 0
+        elif letter in 'PDM' and digits and syringe is not None and positions[syringe] is not None:
+            steps = int(digits)
+            positions[syringe] = {'P': positions[syringe] + steps, 'D': positions[syringe] - steps, 'M': steps}[letter]
+
+
+def ranVolume(commands, syringe, syringe_volume=500.0, stroke_steps=1000.0):
+    ## Volume aspirated by the acknowledged commands of a transfer once the pump has gone idle.
+    # Commands after the last one carrying an R are still buffered on the pump and never ran.
+    run = 0
+    for index, command in enumerate(commands):
+        if startsRun(command):
+            run = index + 1
+    steps = 0
+    for command in commands[:run]:
+        steps += sum(int(digits) for letter, digits in commandTokens(command) if letter == 'P' and digits)
+    # Syringes stroke together except in continuous mode, where they take turns.
+    syringes = 1 if syringe == CONTINUOUS else len(SYRINGES[syringe])
+    return steps*syringe_volume/stroke_steps/syringes
+
+
+class WaitEngine():
+    '''
+    Decides when to poll aF while waiting for a move to finish.
+
+    Given the predicted duration of the move, the first poll is made lead
+    seconds before it should end, then the interval halves towards the
+    deadline (never below min_interval). Once the deadline has passed, or
+    when nothing is known about the move, polls back off from min_interval
+    to max_interval, staying at min_interval for the first lead seconds of
+    an overrun. Sleeps are taken in tick slices so a stop request is
+    noticed without touching the serial port. Predictions are multiplied by
+    scale, to calibrate against a particular instrument (or an emulator
+    running faster than real time).
+    '''
+
+    def __init__(self, lead=0.25, min_interval=0.02, max_interval=0.5, backoff=1.5, tick=0.05, scale=1.0):
+        self.lead = lead
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.tick = tick
+        self.scale = scale
+
+
+    def delays(self, expected=0.0):
+        # Yields the sleep before each successive poll.
+        deadline = time.monotonic() + expected*self.scale
+        interval = self.min_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining > self.lead:
+                yield remaining - self.lead
+            elif remaining > 0:
+                yield min(max(remaining/2.0, self.min_interval), self.max_interval)
+            elif remaining > -self.lead:
+                yield self.min_interval
+            else:
+                yield interval
+                interval = min(interval*self.backoff, self.max_interval)
+
+
+    def sleep(self, duration, interrupted):
+        end = time.monotonic() + duration
+        while not interrupted():
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, self.tick))
+
+
+
+class PumpStatus():
+    '''
+    Immutable snapshot of a pumpObject's state.
+
+    pumpObject.publishStatus builds one from a single moment and hands it to
+    the status listeners only when something differs from the last one, so
+    readers never see a half-updated state.
+
+    positions is the plunger model once every queued move has run, which
+    jumps to the end of a program as soon as it is queued. live_positions is
+    the prediction of where the plungers are at the snapshot's moment, for
+    display.
+    '''
+
+    __slots__ = ('connection', 'status', 'direction', 'pumping_volume', 'flow_rate', 'pumped_volume',
+        'total_volume', 'time_start', 'time_estimated', 'positions', 'live_positions')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PumpStatus is immutable.')
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, PumpStatus) and self.values() == other.values()
+
+    def __hash__(self):
+        return hash(self.values())
+
+    def changed(self, other):
+        # Names of the fields that differ from other (all of them if other is None).
+        if other is None:
+            return set(self.__slots__)
+        return set(name for name in self.__slots__ if getattr(self, name) != getattr(other, name))
+
+
+
+class pumpObject():
+
+    def __init__(self, address='a'):
+        self.address = address # Device address on the serial chain.
+        self.commandSet = CommandSet(address) # Its fixed commands, encoded once.
+        self.bus = None # The PumpBus this pump shares a port on, if any.
+
         self.__PUMP_CONNECTION__ = 0 # 0 = Disconnected, 1 = Connected
         self.__PUMP_STATUS__ = 0 # 0 = Uninitialised, 1 = Ready, 2 = Busy
         self.__PUMP_STOP__ = 0 # 0 = Nothing, 1 = Immediate stop, break all pumping loops.
+        self.stopRequests = 0 # Count of stopPump calls, outlives the __PUMP_STOP__ reset.
+        self.transferRunning = False # True while a transfer follows __PUMP_STOP__, it clears the flag as it ends.
+        self.lastStopLatency = None # seconds from the stop request to the pump confirmed idle.
 
 
         ## Pumping state details.
@@ -37,28 +677,52 @@ class pumpObject():
         self.__time_elapsed__ = 0 # seconds.
         self.__time_estimated__ = 0 # seconds.
 
+        self.waitEngine = WaitEngine()
+        self.timingModel = TimingModel()
+        self.telemetry = Telemetry()
+        self.moveSamples = collections.deque(maxlen=500) # Measured (steps, seconds per stroke, valve switches, seconds) moves.
+
+        # Plunger positions in steps once every queued move has run, None when unknown.
+        self._positions = {'B': None, 'C': None}
+        self._positions_synced = 0 # monotonic time of the last YQP re-sync.
+        self.positionResyncInterval = 300 # seconds, None to only re-sync after stops, initialisation and errors.
+        self._motion = None # (monotonic start, start positions, predictPositions segments) of the moves under way.
+
+        # Latest PumpStatus, and callables given each new one (on whichever thread changed the state).
+        self.statusSnapshot = None
+        self.statusListeners = []
+        self.statusLock = threading.Lock()
+        self.publishStatus()
+
+        self.journal = None # A journal.Journal to record transfers in, so they can be resumed after a crash.
+        self.tracePath = None # Record every byte to and from the pump in this serialtrace file on connect.
+        self.timingPath = None # Load the TimingModel calibrated for the port from this file on connect, e.g. TIMING_FILE.
 
 
 
 
 
     def connect(self, serial_port, baud=9600):
-        logging.info('Attempting to connect to %s.' % (serial_port))
+        # serial_port is a port name, or an open serial-like object such as a serialtrace.ReplaySerial.
+        logging.info('Attempting to connect to %s.' % (getattr(serial_port, 'name', serial_port)))
         try:
-            self.serialObject = serial.Serial(serial_port, baud, parity=serial.PARITY_ODD, bytesize=7, stopbits=serial.STOPBITS_ONE, timeout=10)
+            self.serialObject, self.reader, self.io = openTransport(serial_port, baud, self.tracePath, self.telemetry)
+            self._positions.update((name, None) for name in self._positions)
             self.__PUMP_CONNECTION__ = 1
         except:
             logging.info('Unable to connect to device.')
 
         if self.__PUMP_CONNECTION__ == 1: ## We are connected to the serial port.
             logging.info('Connected to %s.' % (self.serialObject.name))
+            if self.timingPath is not None and isinstance(serial_port, str):
+                self.timingModel = loadTimingModel(serial_port, self.timingPath)
+                logging.info('Timing model for %s: %s.' % (serial_port, vars(self.timingModel)))
 
             # Setup hardware address
-            self.serialObject.write(b'1a\r')
-            recv = self.read_from_pump()
-            logging.info(recv)
-            recv = self.read_from_pump()
+            ack, recv = self.query(self.commandSet.autoAddress, PRIORITY_STATUS)
+            logging.info(ack)
             logging.info(recv)
+            self.publishStatus()
 
             # Initialise the instrument.
             # self.serialObject.write(b'aXR\r')
@@ -66,105 +730,164 @@ class pumpObject():
             # print(recv)
             # recv = self.read_from_pump()
             # print(recv)
-            self.__PUMP_STATUS__ = 2
-
-            while self.__PUMP_STATUS__ == 2:
-                time.sleep(0.1)
-                self.pollPumpStatus()
+            self.waitReady()
 
 
     def initialise(self):
         # Initialise the instrument.
-        self.serialObject.write(b'aXR\r')
-        recv = self.read_from_pump()
-        logging.info(recv)
-        recv = self.read_from_pump()
+        ack, recv = self.query(self.commandSet.initialise)
+        logging.info(ack)
         logging.info(recv)
-        self.__PUMP_STATUS__ = 2
+        self.waitReady()
+        self.syncPositions()
 
-        while self.__PUMP_STATUS__ == 2:
-            time.sleep(0.1)
-            self.pollPumpStatus()
+
+    def attach(self, bus):
+        ## Connects through a PumpBus that owns the serial port, instead of opening it.
+        self.bus = bus
+        self.serialObject = bus.serialObject
+        self.reader = bus.reader
+        self.io = bus.io
+        self.telemetry = bus.telemetry
+        self.waitEngine = bus.waitEngine
+        self._positions.update((name, None) for name in self._positions)
+        self.__PUMP_CONNECTION__ = 1
+        self.publishStatus()
+        self.waitReady()
 
 
     def disconnect(self):
+        if self.bus is not None: # The port stays open for the other pumps on the bus.
+            self.__PUMP_CONNECTION__ = 0
+            self.__PUMP_STATUS__ = 0
+            self.publishStatus()
+            return
+
         logging.info('Attempting to disconnect from %s.' % (self.serialObject.name))
+        self.io.stop()
         self.serialObject.close()
         self.__PUMP_CONNECTION__ = 0
         self.__PUMP_STATUS__ = 0
+        self.publishStatus()
         logging.info('Disconnected.')
 
 
 
-    def read_from_pump(self):
-        time.sleep(0.01)
-        recv_buffer = b''
-        while True:
-            recv_byte = self.serialObject.read(1)
-            recv_buffer += recv_byte
-            if recv_byte == b'\r':
-                break
-        return recv_buffer
+    def command(self, body, prefix=None):
+        # Command bytes for body, addressed to this pump. The fixed commands are in self.commandSet.
+        return encode(self.address, body, prefix=prefix or '')
+
+    def submit(self, command, priority=PRIORITY_MOTION, generation=None):
+        # Queue a command on the I/O thread, returns a Future of the (ack, response) frames.
+        future = self.io.submit(command, priority, generation)
+        if priority == PRIORITY_MOTION:
+            future.add_done_callback(lambda f: self._trackMotion(command, f))
+        return future
+
+    def _trackMotion(self, command, future):
+        # Runs on the I/O thread once a motion command has been answered.
+        if future.cancelled() or future.exception() is not None or isNak(future.result()[0]):
+            self._positions.update((name, None) for name in self._positions) # Rejected or lost, re-sync.
+        else:
+            trackPositions(self._positions, command)
+            if self.journal is not None:
+                self.journal.command(command)
+        self.publishStatus()
+
+
+    def publishStatus(self):
+        ## Snapshots the state and, if it changed, hands the new PumpStatus to the listeners.
+        with self.statusLock:
+            snapshot = PumpStatus(self.__PUMP_CONNECTION__, self.__PUMP_STATUS__, self.__direction__, self.__pumping_volume__,
+                self.__flow_rate__, self.__pumped_volume__, self.__total_volume__, self.__time_start__, self.__time_estimated__,
+                tuple(sorted(self._positions.items())), tuple(sorted(self.livePositions().items())))
+            if snapshot != self.statusSnapshot:
+                self.statusSnapshot = snapshot
+                for listener in list(self.statusListeners):
+                    listener(snapshot)
+        return snapshot
+
+
+    @property
+    def positions(self):
+        ## Read-only view of the modelled plunger step positions.
+        return types.MappingProxyType(self._positions)
+
+    def livePositions(self, now=None):
+        ## Predicted plunger positions at now (time.monotonic), the modelled positions when nothing is moving.
+        motion = self._motion
+        if motion is None:
+            return dict(self._positions)
+        t0, start, segments = motion
+        now = time.monotonic() if now is None else now
+        return predictPositions(start, segments, (now - t0)/self.waitEngine.scale)
+
+    def followMotion(self, start=None, segments=None, t0=None):
+        # Predicts live positions along segments from t0 (now), or stops predicting if start is None.
+        self._motion = None if start is None else (time.monotonic() if t0 is None else t0, dict(start), segments)
+
+    def syncPositions(self):
+        # Both queries are queued together and share one wait.
+        futures = dict((name, self.submit(self.commandSet.position[name], PRIORITY_STATUS)) for name in self._positions)
+        for name, future in futures.items():
+            self._positions[name] = parsePosition(future.result()[1])
+        self._positions_synced = time.monotonic()
+        if self.journal is not None:
+            self.journal.positions(self._positions)
+        self.publishStatus()
+        return self.positions
+
+    def currentPositions(self):
+        # The modelled positions, re-synced with the pump when unknown or stale.
+        stale = self.positionResyncInterval is not None and time.monotonic() - self._positions_synced > self.positionResyncInterval
+        if stale or None in self._positions.values():
+            return self.syncPositions()
+        return self.positions
+
+    def query(self, command, priority=PRIORITY_MOTION):
+        return self.submit(command, priority).result()
 
     def getFirmwareVersion(self):
-        self.serialObject.write(b'aU\r')
-        firmware_bytes = self.serialObject.read_until(b'\r')
+        ack, firmware_bytes = self.query(self.commandSet.firmware, PRIORITY_STATUS)
         logging.info(firmware_bytes)
         return firmware_bytes
 
 
-    def stopPump(self):
+    def stopPump(self, requested=None):
+        ## Halts the pump and ends any transfer, requested is the monotonic time the stop was asked for.
+        requested = time.monotonic() if requested is None else requested
         self.__PUMP_STOP__ = 1
+        self.stopRequests += 1
 
-        self.serialObject.write(b'aK\r')
-        ack = self.read_from_pump()
-        ack = self.read_from_pump()
-        time.sleep(0.1)
-        self.serialObject.write(b'aV\r')
-        ack = self.read_from_pump()
-        ack = self.read_from_pump()
+        # Halt and clear the queue ahead of any pending I/O, host loops see __PUMP_STOP__ and return.
+        for future in self.io.abort([self.commandSet.halt, self.commandSet.clear], [self.address]):
+            future.result()
         logging.info('Stopping pump! Clearing command queue.')
 
         # Wait for pump to be ready.
-        while self.__PUMP_STATUS__ == 2:
-            time.sleep(0.1)
-            self.pollPumpStatus()
-        logging.info('Pump stopped.')
+        self.waitReady()
+        self.lastStopLatency = time.monotonic() - requested
+        self.telemetry.recordStop(self.lastStopLatency)
+        self.syncPositions()
+        # A stop of an idle pump must not carry over to the next transfer.
+        if not self.transferRunning:
+            self.__PUMP_STOP__ = 0
+        logging.info('Pump stopped %.3f seconds after the request.' % (self.lastStopLatency))
 
 
     def dispensePump(self, syringe='A+B', dispense=2500, syringe_volume=500.0, stroke_steps=1000.0):
         # Dispense syringe volume to waste.
-        dispense_sec_per_full_stroke = round(syringe_volume/(dispense/60.0))
-        pump_instruction = 'M0S%dN0' % (dispense_sec_per_full_stroke)
-
-        if syringe == 'A+B':
-            dispense_cmd_to_send = 'aBO%sOCO%sOR\r' % (pump_instruction, pump_instruction)
-        elif syringe == 'A':
-            dispense_cmd_to_send = 'aBO%sOR\r' % (pump_instruction)
-        elif syringe == 'B':
-            dispense_cmd_to_send = 'aCO%sOR\r' % (pump_instruction)
-
+        dispense_cmd_to_send = dispenseCommand(syringe, dispense, syringe_volume, self.address)
+        positions = self.currentPositions()
+        travel = max(positions[name] for name in SYRINGES[syringe])
 
         logging.info("Dispensing syringe to waste.")
         self.__direction__ = 'Dispensing'
         self.__pumping_volume__ = syringe_volume
         self.__flow_rate__ = dispense
+        self.publishStatus()
 
-        self.serialObject.write(bytearray(dispense_cmd_to_send.encode('ascii')))
-        ack = self.read_from_pump()
-        cmdecho = self.read_from_pump()
-
-        logging.info(ack)
-        logging.info(cmdecho)
-        self.__PUMP_STATUS__ = 2
-
-
-        # Wait for pump to be ready.
-        while self.__PUMP_STATUS__ == 2:
-            time.sleep(0.1)
-            self.pollPumpStatus()
-            if self.__PUMP_STOP__ == 1:
-                break
+        self.timedMove(dispense_cmd_to_send, travel, secondsPerStroke(dispense, syringe_volume), 0, stroke_steps, stoppable=True)
 
 
 
@@ -172,36 +895,68 @@ class pumpObject():
         ## Checks the pump configuration.
 
         logging.info('Checking pump config.')
-        self.serialObject.write(b'aH\r')
-        ack = self.read_from_pump()
-        configBytes = self.read_from_pump()
+        ack, configBytes = self.query(self.commandSet.configH, PRIORITY_STATUS)
 
-        config = configBytes[1:2].decode('utf-8')
+        config = parseConfig(configBytes)
         logging.info(ack)
         logging.info(configBytes)
 
-        self.serialObject.write(b'aJ\r')
-        ack = self.read_from_pump()
-        configBytes = self.read_from_pump()
+        ack, configBytes = self.query(self.commandSet.configJ, PRIORITY_STATUS)
 
-        config = configBytes[1:2].decode('utf-8')
+        config = parseConfig(configBytes)
         logging.info(ack)
         logging.info(configBytes)
 
 
-    def pumpCmd(self, syringe='A+B', volume=100, aspirate=1000, dispense=2500, syringe_volume=500.0):
+    def pumpCmd(self, syringe='A+B', volume=100, aspirate=1000, dispense=2500, syringe_volume=500.0, compiled=True):
         ## This function allows for pumping volumes greater than the syringe volume.
+        # compiled queues the whole transfer on the pump, otherwise it is sent a stroke at a time.
+        # Continuous mode is always compiled.
 
         stroke_steps = 1000.0
+        if not volume > 0: # A program with no strokes would be a bare R.
+            raise ValueError('Volume must be positive, got %s ul.' % (volume))
 
-        volume_remaining = volume
+        self.transferRunning = True # A stop from here on ends this transfer, see stopPump.
+        try:
+            self.__pumped_volume__ = 0
+            self.__total_volume__ = volume
 
-        self.__pumped_volume__ = 0
-        self.__total_volume__ = volume
+            self.__time_start__ = time.time()
 
-        self.__time_start__ = time.time()
+            t0 = time.monotonic()
+            polls = self.telemetry.commands['status']
+            if self.journal is not None:
+                self.journal.transfer({'address': self.address, 'syringe': syringe, 'volume': volume, 'aspirate': aspirate,
+                    'dispense': dispense, 'syringe_volume': syringe_volume, 'stroke_steps': stroke_steps, 'compiled': compiled})
 
-        self.__time_estimated__ = volume/(aspirate/60.0) + (round(volume/syringe_volume)*(syringe_volume/(dispense/60.0)))
+            program = self.compileTransfer(syringe, volume, aspirate, dispense, stroke_steps, syringe_volume)
+            self.__time_estimated__ = program.duration
+            self.publishStatus()
+
+            started = True
+            if compiled or syringe == CONTINUOUS:
+                started = self.pumpCmdCompiled(program)
+            else:
+                self.pumpCmdStrokes(syringe, volume, aspirate, dispense, stroke_steps, syringe_volume)
+            rejected = not started and self.__PUMP_STOP__ == 0
+
+            if self.__PUMP_STOP__ == 0 and not rejected:
+                self.telemetry.recordTransfer(int(-(-volume//syringe_volume)), time.monotonic() - t0,
+                    (program.duration - program.latency)*self.waitEngine.scale, self.telemetry.commands['status'] - polls)
+            if self.journal is not None:
+                self.journal.end('stopped' if self.__PUMP_STOP__ == 1 else 'rejected' if rejected else 'done')
+        finally:
+            self.transferRunning = False
+            self.__PUMP_STOP__ = 0
+            self.publishStatus()
+        if rejected:
+            raise PumpProtocolError('Pump %s rejected the transfer of %d ul, nothing was pumped.' % (self.address, volume))
+
+
+    def pumpCmdStrokes(self, syringe='A+B', volume=100, aspirate=1000, dispense=2500, stroke_steps=1000.0, syringe_volume=500.0):
+        ## Sends a transfer a stroke at a time.
+        volume_remaining = volume
 
         while volume_remaining > 0:
             # if self.__PUMP_STATUS__ == 2:
@@ -219,8 +974,159 @@ class pumpObject():
                 volume_remaining = volume_remaining-syringe_volume
 
             self.__pumped_volume__ = volume - volume_remaining
+            if self.journal is not None and self.__PUMP_STOP__ == 0:
+                self.journal.progress(self.__pumped_volume__, self.__total_volume__)
+            self.publishStatus()
+
+
+    def pendingTransfer(self):
+        ## (transfer parameters, volume delivered) of a journalled transfer that never ended, None if there is none.
+        if self.journal is None:
+            return None
+        pending = self.journal.pending()
+        if pending is None or pending.params['address'] != self.address:
+            return None
+        params = pending.params
+        delivered = max(pending.pumped, ranVolume(pending.commands, params['syringe'], params['syringe_volume'], params['stroke_steps']))
+        return params, min(delivered, params['volume'])
+
+
+    def resumeTransfer(self):
+        ## Pumps the rest of an interrupted transfer from the current plunger positions, returns the volume resumed.
+        # connect has already waited for the pump to finish every acknowledged command, so no re-home is needed.
+        pending = self.pendingTransfer()
+        if pending is None:
+            return 0
+        params, delivered = pending
+
+        # Drop queued commands that never got their R, then read where the plungers are.
+        self.query(self.commandSet.clear, PRIORITY_STATUS)
+        self.syncPositions()
+        self.journal.end('resumed')
+
+        remaining = params['volume'] - delivered
+        logging.info('Resuming a transfer of %d ul with %d ul delivered.' % (params['volume'], delivered))
+        if remaining > 0:
+            self.pumpCmd(params['syringe'], remaining, params['aspirate'], params['dispense'], params['syringe_volume'],
+                params['compiled'])
+        return remaining
+
+
+    def abandonTransfer(self):
+        ## Marks an interrupted transfer as not to be resumed.
+        if self.pendingTransfer() is not None:
+            self.journal.end('abandoned')
+
+
+    def compileTransfer(self, syringe='A+B', volume=100, aspirate=1000, dispense=2500, stroke_steps=1000.0, syringe_volume=500.0):
+        # Compiles a transfer from the current positions with this pump's timing model.
+        positions = self.currentPositions()
+        if syringe == CONTINUOUS:
+            return compileContinuousTransfer(volume, aspirate, dispense, syringe_volume, stroke_steps, positions,
+                self.address, timing=self.timingModel)
+        return compileTransfer(syringe, volume, aspirate, dispense, syringe_volume, stroke_steps, positions,
+            self.address, timing=self.timingModel)
+
+
+    def pumpCmdCompiled(self, program):
+        ## Runs a whole transfer as one queued program, following progress on the host clock.
+        logging.info('Queueing %d ul as %d command(s), predicted %.1f seconds.' % (
+            self.__total_volume__, len(program.commands), program.duration))
+
+        if not self.queueProgram(program):
+            return False
+        try:
+            return self.followProgram(program)
+        finally:
+            self.followMotion()
+            self.publishStatus()
+
+    def followProgram(self, program):
+        # Follows a queued program phase by phase until the pump confirms it has finished.
+        self.followMotion(program.start, program.segments())
+        self.__PUMP_STATUS__ = 2 # The pump runs the program without being polled.
+        self.publishStatus()
+
+        stopped = lambda: self.__PUMP_STOP__ == 1
+        deadline = time.monotonic()
+        for index, (direction, phase_volume, flow_rate, seconds, pumped_after) in enumerate(program.phases):
+            self.__direction__ = direction
+            self.__pumping_volume__ = phase_volume
+            self.__flow_rate__ = flow_rate
+            self.publishStatus()
+            deadline += seconds*self.waitEngine.scale
+
+            if index == len(program.phases) - 1:
+                # Confirm the end of the program with the pump.
+                self.waitReady((deadline - time.monotonic())/self.waitEngine.scale, stoppable=True)
+            else:
+                self.waitEngine.sleep(deadline - time.monotonic(), stopped)
 
-        self.__PUMP_STOP__ = 0
+            if stopped():
+                break
+            self.__pumped_volume__ = pumped_after
+            if self.journal is not None:
+                self.journal.progress(pumped_after, self.__total_volume__)
+            self.publishStatus()
+        return True
+
+
+    def queueProgram(self, program):
+        ## Sends a compiled program, returns False if a stop or a rejected chunk prevented it from starting.
+        # Taken before the stop check: stopPump sets the flag before it aborts, so a later stop is caught by either.
+        generation = self.io.generation(self.address)
+        # A stop that arrived while compiling must not start the program.
+        if self.__PUMP_STOP__ == 1:
+            return False
+
+        # The acks move the plunger model to the end of the program, but the plungers stay put until it starts.
+        self.followMotion(program.start, [])
+        queued = False
+        try:
+            queued = self.sendProgram(program, generation)
+        finally:
+            if not queued:
+                self.followMotion()
+        return queued
+
+    def sendProgram(self, program, generation):
+        # Chunks are queued back to back, but the last one starts the program, so it waits for the others to be accepted.
+        # Any chunk still unsent when the pump is aborted, the last included, is cancelled by the I/O thread.
+        try:
+            for batch in (program.commands[:-1], program.commands[-1:]):
+                for command, future in [(command, self.submit(command, PRIORITY_MOTION, generation)) for command in batch]:
+                    ack, cmdecho = future.result()
+                    logging.info(ack)
+                    logging.info(cmdecho)
+                    if isNak(ack):
+                        self.rejectProgram(command)
+                        return False
+        except CancelledError:
+            return False # Aborted by stopPump.
+        return True
+
+    def rejectProgram(self, command):
+        # Nothing has run, cancel the chunks still waiting and drop those already buffered on the pump.
+        logging.error('Pump %s rejected %r, the transfer was not started.' % (self.address, command))
+        for future in self.io.abort([self.commandSet.clear], [self.address]):
+            future.result()
+        self._positions.update((name, None) for name in self._positions) # The model counted the dropped chunks.
+        self.publishStatus()
+
+
+    def showProgress(self, program, elapsed):
+        # Sets the pumping state details from the phase of program predicted at elapsed seconds.
+        pumped = 0
+        for direction, phase_volume, flow_rate, seconds, pumped_after in program.phases:
+            self.__direction__ = direction
+            self.__pumping_volume__ = phase_volume
+            self.__flow_rate__ = flow_rate
+            elapsed -= seconds
+            if elapsed < 0:
+                break
+            pumped = pumped_after
+        self.__pumped_volume__ = pumped
+        self.publishStatus()
 
 
     def pumpCmdSingleStroke(self, syringe='A+B', volume=100, aspirate=1000, dispense=2500, stroke_steps=1000.0, syringe_volume=500.0):
@@ -234,53 +1140,25 @@ class pumpObject():
 
         steps_to_pump = volume*step_per_uL
 
-        # Instrument speed is seconds per full stroke.
-        # Need to convert ul/minute to seconds per full stroke.
-        seconds_per_full_stroke = round(syringe_volume/(aspirate/60.0))
-        dispense_sec_per_full_stroke = round(syringe_volume/(dispense/60.0))
-
-
-        ## Get the absolute step position of both syringes.
-        self.serialObject.write(b'aBYQP\r')
-        ack = self.read_from_pump()
-        absStepPosB = float(self.read_from_pump()[1:-1])
 
-        self.serialObject.write(b'aCYQP\r')
-        ack = self.read_from_pump()
-        absStepPosC = float(self.read_from_pump()[1:2])
+        ## Absolute step position of the syringes in use, from the host-side model.
+        positions = self.currentPositions()
+        travel = max(positions[name] for name in SYRINGES[syringe])
 
 
         # If syringe does not have enough volume available, dump the volume to waste.
-        pump_instruction = 'M0S%dN0' % (dispense_sec_per_full_stroke)
+        dispense_cmd_to_send = dispenseCommand(syringe, dispense, syringe_volume, self.address)
 
-        if syringe == 'A+B':
-            dispense_cmd_to_send = 'aBO%sOCO%sOR\r' % (pump_instruction, pump_instruction)
-        elif syringe == 'A':
-            dispense_cmd_to_send = 'aBO%sOR\r' % (pump_instruction)
-        elif syringe == 'B':
-            dispense_cmd_to_send = 'aCO%sOR\r' % (pump_instruction)
-
-        if absStepPosB+steps_to_pump > stroke_steps or absStepPosC+steps_to_pump > stroke_steps:
+        if travel+steps_to_pump > stroke_steps:
             logging.info("Dispensing syringe to waste.")
             self.__direction__ = 'Dispensing'
             self.__pumping_volume__ = syringe_volume
             self.__flow_rate__ = dispense
+            self.publishStatus()
 
-            self.serialObject.write(bytearray(dispense_cmd_to_send.encode('ascii')))
-            ack = self.read_from_pump()
-            cmdecho = self.read_from_pump()
-
-            logging.info(ack)
-            logging.info(cmdecho)
-            self.__PUMP_STATUS__ = 2
-
-
-        # Wait for pump to be ready.
-        while self.__PUMP_STATUS__ == 2:
-            time.sleep(0.1)
-            self.pollPumpStatus()
+            self.timedMove(dispense_cmd_to_send, travel, secondsPerStroke(dispense, syringe_volume), 0, stroke_steps, stoppable=True)
             if self.__PUMP_STOP__ == 1:
-                break
+                return
 
 
         # Aspirate the syringe.
@@ -288,52 +1166,235 @@ class pumpObject():
         self.__direction__ = 'Aspirating'
         self.__pumping_volume__ = volume
         self.__flow_rate__ = aspirate
+        self.publishStatus()
+
+        cmd_to_send = aspirateCommand(syringe, steps_to_pump, aspirate, syringe_volume, self.address)
+        # self.query(b'aBIP210S30N5OR\r')
 
-        pump_instruction = 'P%dS%dN5' % (steps_to_pump, seconds_per_full_stroke)
+        self.timedMove(cmd_to_send, int(steps_to_pump), secondsPerStroke(aspirate, syringe_volume), 2, stroke_steps, stoppable=True)
 
-        if syringe == 'A+B':
-            cmd_to_send = 'aBI%sOCI%sOR\r' % (pump_instruction, pump_instruction)
-        elif syringe == 'A':
-            cmd_to_send = 'aBI%sOR\r' % (pump_instruction)
-        elif syringe == 'B':
-            cmd_to_send = 'aCI%sOR\r' % (pump_instruction)
 
+    def timedMove(self, command, steps, seconds_per_stroke, valve_switches=0, stroke_steps=1000.0, stoppable=False):
+        ## Sends a move, waits for it to finish and records how long it took for calibration.
+        t0 = time.monotonic()
+        expected = self.timingModel.moveTime(steps, seconds_per_stroke, valve_switches, stroke_steps)
+        start = dict(self._positions)
+        end = dict(start)
+        trackPositions(end, command)
+        self.followMotion(start, [(expected, end)], t0)
+        try:
+            try:
+                ack, cmdecho = self.query(command)
+            except CancelledError:
+                return # Aborted by stopPump before it was sent.
+            logging.info(ack)
+            logging.info(cmdecho)
 
-        self.serialObject.write(bytearray(cmd_to_send.encode('ascii')))
-        # self.serialObject.write(b'aBIP210S30N5OR\r')
-        ack = self.read_from_pump()
-        configBytes = self.read_from_pump()
+            self.waitReady(expected, stoppable)
+        finally:
+            self.followMotion()
+            self.publishStatus()
+        if self.__PUMP_STOP__ == 0 and steps > 0:
+            self.moveSamples.append((steps, seconds_per_stroke, valve_switches, time.monotonic() - t0))
 
-        self.__PUMP_STATUS__ = 2
 
-        config = configBytes[1:2].decode('utf-8')
-        logging.info(ack)
-        logging.info(configBytes)
 
+    def waitReady(self, expected=0.0, stoppable=False):
+        ## Wait for the pump to go idle after a command expected to take `expected` seconds.
+        self.__PUMP_STATUS__ = 2
+        self.publishStatus()
+        delays = self.waitEngine.delays(expected)
+        t0 = time.monotonic()
+        polls = 0
         while self.__PUMP_STATUS__ == 2:
-            time.sleep(0.1)
+            if self.__PUMP_STOP__ == 1:
+                if stoppable:
+                    break
+                time.sleep(self.waitEngine.min_interval) # The halt ends the move early.
+            else:
+                self.waitEngine.sleep(next(delays), lambda: self.__PUMP_STOP__ == 1)
             self.pollPumpStatus()
-
+            polls += 1
+        self.telemetry.recordWait(time.monotonic() - t0, polls)
 
 
     def pollPumpStatus(self):
         if self.__PUMP_CONNECTION__ == 1:
             # Check if instrument is busy.
-            self.serialObject.write(b'aF\r')
-            ack = self.read_from_pump()
-            statusBytes = self.read_from_pump()
+            ack, statusBytes = self.query(self.commandSet.status, PRIORITY_STATUS)
+
+            status = parseStatus(statusBytes)
+            if status is not None:
+                self.__PUMP_STATUS__ = status
+                self.publishStatus()
+
+
+
 
-            statusByte = statusBytes[1:2].decode('utf-8')
-            # print(statusByte)
 
-            if statusByte == '*': ## Instrument is busy
-                self.__PUMP_STATUS__ = 2
-            elif statusByte == 'Y': ## Instrument is idle with nothing in command queue
-                self.__PUMP_STATUS__ = 1
-            elif statusByte == 'N': ## Instrument is idle with a non-empty command queue
-                self.__PUMP_STATUS__ = 2
 
 
 
+class PumpBus():
+    '''
+    Several MicroLab 500s daisy-chained on one serial port.
 
+    connect auto-addresses the chain (the first unit takes a, the next b and
+    so on) and attaches a pumpObject for each unit to one shared serial I/O
+    thread, so commands and status polls for every pump interleave on the
+    port. runTransfers starts a compiled transfer on each pump and follows
+    them all from the calling thread, polling only the pumps that are due
+    to finish.
+    '''
 
+    def __init__(self):
+        self.pumps = collections.OrderedDict() # address: pumpObject
+        self.telemetry = Telemetry()
+        self.waitEngine = WaitEngine()
+        self.io = None
+        self.tracePath = None # As pumpObject.tracePath, for the whole chain.
+
+
+    def connect(self, serial_port, baud=9600):
+        logging.info('Attempting to connect to the pump chain on %s.' % (getattr(serial_port, 'name', serial_port)))
+        self.serialObject, self.reader, self.io = openTransport(serial_port, baud, self.tracePath, self.telemetry)
+
+        # The reply to 1a carries the last address assigned along the chain.
+        ack, recv = self.io.submit(CommandSet('a').autoAddress, PRIORITY_STATUS).result()
+        last = replyAddress(recv)
+        self.pumps.clear()
+        for address in map(chr, range(ord('a'), ord(last) + 1)):
+            self.pumps[address] = pumpObject(address)
+            self.pumps[address].attach(self)
+        logging.info('Connected to %d pump(s) on %s.' % (len(self.pumps), self.serialObject.name))
+        return list(self.pumps.values())
+
+
+    def disconnect(self):
+        self.io.stop()
+        self.serialObject.close()
+        for pump in self.pumps.values():
+            pump.__PUMP_CONNECTION__ = 0
+            pump.__PUMP_STATUS__ = 0
+            pump.publishStatus()
+        logging.info('Disconnected from the pump chain.')
+
+
+    def initialise(self):
+        # All pumps initialise together.
+        for future in [pump.submit(pump.commandSet.initialise) for pump in self.pumps.values()]:
+            future.result()
+        for pump in self.pumps.values():
+            pump.waitReady(pump.timingModel.initialise_time)
+            pump.syncPositions()
+
+
+    def stopAll(self, requested=None):
+        ## Halts every pump on the chain ahead of any queued I/O.
+        requested = time.monotonic() if requested is None else requested
+        commands = []
+        for pump in self.pumps.values():
+            pump.__PUMP_STOP__ = 1
+            pump.stopRequests += 1
+            commands += [pump.commandSet.halt, pump.commandSet.clear]
+        for future in self.io.abort(commands):
+            future.result()
+        logging.info('Stopping all pumps! Clearing command queues.')
+
+        for pump in self.pumps.values():
+            pump.waitReady()
+            pump.lastStopLatency = time.monotonic() - requested
+            pump.syncPositions()
+            if not pump.transferRunning: # As in pumpObject.stopPump.
+                pump.__PUMP_STOP__ = 0
+        self.telemetry.recordStop(time.monotonic() - requested)
+
+
+    def runTransfers(self, transfers):
+        '''
+        Runs a transfer on several pumps at the same time and returns once
+        they have all finished, as {address: ul pumped}.
+
+        transfers is a list of dicts with an address and the pumpCmd
+        arguments (syringe, volume, aspirate, dispense, syringe_volume).
+        '''
+        started = {}
+        for transfer in transfers:
+            transfer = dict(transfer)
+            pump = self.pumps[transfer.pop('address')]
+            if pump.address in started:
+                raise ValueError('Pump %s has more than one transfer.' % (pump.address))
+            if not transfer.get('volume', 100) > 0:
+                raise ValueError('Pump %s: volume must be positive, got %s ul.' % (pump.address, transfer['volume']))
+            transfer.setdefault('syringe_volume', 500.0)
+
+            program = pump.compileTransfer(stroke_steps=1000.0, **transfer)
+            pump.__pumped_volume__ = 0
+            pump.__total_volume__ = transfer.get('volume', 100)
+            pump.__time_start__ = time.time()
+            pump.__time_estimated__ = program.duration
+            started[pump.address] = (pump, program, int(-(-pump.__total_volume__//transfer['syringe_volume'])))
+
+        transferring = [pump for pump, program, strokes in started.values()]
+        for pump in transferring:
+            pump.transferRunning = True
+
+        # Queue every program before following any, so the pumps start together.
+        for address, (pump, program, strokes) in list(started.items()):
+            logging.info('Pump %s: queueing %d ul as %d command(s), predicted %.1f seconds.' % (
+                address, pump.__total_volume__, len(program.commands), program.duration))
+            if not pump.queueProgram(program):
+                del started[address]
+        t0 = time.monotonic()
+        polls = collections.Counter()
+        for pump, program, strokes in started.values():
+            pump.followMotion(program.start, program.segments(), t0)
+
+        # Poll each pump from shortly before its predicted end, all polls due together go out together.
+        active = dict((address, self.waitEngine.delays(program.duration)) for address, (pump, program, strokes) in started.items())
+        due = dict((address, t0 + next(delays)) for address, delays in active.items())
+        for pump, program, strokes in started.values():
+            pump.__PUMP_STATUS__ = 2
+            pump.publishStatus()
+        stopped = lambda: any(self.pumps[address].__PUMP_STOP__ == 1 for address in active)
+
+        while active:
+            now = time.monotonic()
+            for address in active:
+                pump, program, strokes = started[address]
+                pump.showProgress(program, (now - t0)/self.waitEngine.scale)
+
+            polling = [address for address in active if due[address] <= now and self.pumps[address].__PUMP_STOP__ == 0]
+            futures = [(address, self.pumps[address].submit(self.pumps[address].commandSet.status, PRIORITY_STATUS)) for address in polling]
+            for address, future in futures:
+                status = parseStatus(future.result()[1])
+                if status is not None:
+                    self.pumps[address].__PUMP_STATUS__ = status
+                    self.pumps[address].publishStatus()
+                polls[address] += 1
+                due[address] = time.monotonic() + next(active[address])
+
+            for address in list(active):
+                pump, program, strokes = started[address]
+                if pump.__PUMP_STOP__ == 1:
+                    del active[address]
+                elif pump.__PUMP_STATUS__ != 2:
+                    del active[address]
+                    pump.__pumped_volume__ = pump.__total_volume__
+                    pump.publishStatus()
+                    self.telemetry.recordTransfer(strokes, time.monotonic() - t0,
+                        (program.duration - program.latency)*self.waitEngine.scale, polls[address])
+
+            if active:
+                self.waitEngine.sleep(min(due[address] for address in active) - time.monotonic(), stopped)
+
+        logging.info('Transfers finished, %d status polls for %d pump(s).' % (sum(polls.values()), len(started)))
+        for pump in transferring:
+            pump.transferRunning = False
+            pump.__PUMP_STOP__ = 0
+            pump.followMotion()
+            pump.publishStatus()
+        results = {}
+        for address, (pump, program, strokes) in started.items():
+            results[address] = pump.__pumped_volume__
+        return results
@@ -0,0 +1,305 @@
+'''
+Latency and throughput benchmarks for backend.pumpObject against the
+MicroLab 500 emulator, so changes to backend.py can be measured without an
+instrument attached.
+
+    python benchmark.py [--speedup 10] [--json results.json]
+
+Each benchmark opens its own emulated pump on a pseudo terminal and drives
+it through the normal pumpObject.connect path.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import importlib.util
+import statistics
+import tempfile
+import contextlib
+
+import backend
+import worklist
+from recipe import Recipe, RecipeRunner
+from serialtrace import ReplaySerial, readTrace
+from emulator import PumpEmulator, PumpChain, PtyPumpEmulator
+from telemetry import STOP_BUCKETS
+
+
+def summarise(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'n': 0}
+    return {
+        'n': len(samples),
+        'mean': statistics.mean(samples),
+        'p50': samples[len(samples)//2],
+        'p95': samples[min(len(samples) - 1, int(len(samples)*0.95))],
+        'max': samples[-1],
+    }
+
+
+@contextlib.contextmanager
+def session(speedup=1.0, initialise=True):
+    '''Connect a fresh pumpObject to a fresh emulated pump.'''
+    emulator = PumpEmulator(speedup=speedup)
+    with PtyPumpEmulator(emulator) as server:
+        pump = backend.pumpObject()
+        pump.waitEngine.scale = 1.0/speedup
+        pump.connect(server.port)
+        if initialise:
+            pump.initialise()
+        try:
+            yield pump, emulator
+        finally:
+            pump.disconnect()
+
+
+def run_with_timeout(fn, timeout, *args, **kwargs):
+    # Returns (finished, exception). Hung threads are left as daemons.
+    outcome = {}
+    def target():
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive(), outcome.get('error')
+
+
+
+def bench_round_trip(speedup, count=50):
+    ## Per-command round trip through the backend I/O thread.
+    commands = [b'aF\r', b'aBYQP\r', b'aCYQP\r', b'aH\r', b'aU\r']
+    results = {}
+    with session(speedup) as (pump, emulator):
+        for command in commands:
+            samples = []
+            for i in range(count):
+                t0 = time.perf_counter()
+                pump.query(command, backend.PRIORITY_STATUS)
+                samples.append(time.perf_counter() - t0)
+            results[command.decode('ascii').strip()] = summarise(samples)
+    return results
+
+
+def bench_polls_per_stroke(speedup, volume=2000, aspirate=15000, dispense=30000, syringe_volume=500.0):
+    ## Status polls issued for each completed stroke of a pumpCmd transfer.
+    with session(speedup) as (pump, emulator):
+        emulator.command_counts.clear()
+        pump.pumpCmd('A+B', volume, aspirate, dispense, syringe_volume)
+        strokes = -(-volume//int(syringe_volume))
+        counts = dict(emulator.command_counts)
+    return {
+        'strokes': strokes,
+        'polls_per_stroke': counts.get('F', 0)/float(strokes),
+        'position_queries_per_stroke': counts.get('YQP', 0)/float(strokes),
+        'commands': counts,
+    }
+
+
+def bench_transfer_overhead(speedup, volume=2000, aspirate=15000, dispense=30000, syringe_volume=500.0):
+    ## Wall clock time of pumpCmd not spent moving, scaled to one litre.
+    with session(speedup) as (pump, emulator):
+        motion_before = emulator.motion_time
+        t0 = time.monotonic()
+        pump.pumpCmd('A+B', volume, aspirate, dispense, syringe_volume)
+        wall = time.monotonic() - t0
+        motion = emulator.motion_time - motion_before
+
+    overhead = wall - motion
+    return {
+        'volume_ul': volume,
+        'wall_s': wall,
+        'motion_s': motion,
+        'overhead_s': overhead,
+        'overhead_s_per_litre': overhead*1e6/volume,
+    }
+
+
+def bench_stop_latency(speedup, trials=10, volume=5000, aspirate=3000, dispense=6000, syringe_volume=500.0, timeout=30.0,
+        max_stop=STOP_BUCKETS[-1]):
+    ## Time from stopPump to halted motion, and to both stopPump and pumpCmd returning.
+    # Trials alternate between compiled and stroke by stroke transfers; the max is the worst case seen.
+    # A trial fails if the pump moves again after the halt or the stop is confirmed later than max_stop seconds.
+    halt, confirmed, finished, failures = [], [], [], 0
+    moved, late = 0, 0
+    for trial in range(trials):
+        with session(speedup) as (pump, emulator):
+            transfer = threading.Thread(target=run_with_timeout, daemon=True,
+                args=(pump.pumpCmd, timeout, 'A+B', volume, aspirate, dispense, syringe_volume),
+                kwargs={'compiled': trial % 2 == 0})
+            transfer.start()
+            time.sleep(random.uniform(0.5, 3.0)/speedup)
+
+            t_press = time.monotonic()
+            done, error = run_with_timeout(pump.stopPump, timeout, requested=t_press)
+            transfer.join(timeout)
+            t_finished = time.monotonic()
+
+            if not done or error is not None or transfer.is_alive() or emulator.last_halt is None or emulator.status() != 'Y':
+                failures += 1
+                continue
+            halt.append(emulator.last_halt - t_press)
+            confirmed.append(pump.lastStopLatency)
+            finished.append(t_finished - t_press)
+            if emulator.motion_time > emulator.halt_motion_time + 1e-9:
+                moved += 1
+            elif pump.lastStopLatency > max_stop:
+                late += 1
+
+    return {
+        'halt_s': summarise(halt),
+        'confirmed_idle_s': summarise(confirmed),
+        'transfer_returned_s': summarise(finished),
+        'max_stop_s': max_stop,
+        'moved_after_halt': moved,
+        'over_max_stop': late,
+        'failed_trials': failures + moved + late,
+    }
+
+
+def bench_bus(speedup, pumps=3, volume=1500, aspirate=15000, dispense=30000, syringe_volume=500.0):
+    ## Several pumps on one daisy-chained port: the same transfers one after another, then all at once.
+    chain = PumpChain([PumpEmulator(speedup=speedup) for i in range(pumps)])
+    with PtyPumpEmulator(chain) as server:
+        bus = backend.PumpBus()
+        bus.waitEngine.scale = 1.0/speedup
+        bus.connect(server.port)
+        try:
+            bus.initialise()
+            transfers = [{'address': pump.address, 'volume': volume, 'aspirate': aspirate, 'dispense': dispense,
+                'syringe_volume': syringe_volume} for pump in bus.pumps.values()]
+
+            t0 = time.monotonic()
+            for transfer in transfers:
+                bus.runTransfers([transfer])
+            sequential = time.monotonic() - t0
+
+            polls = bus.telemetry.commands['status']
+            t0 = time.monotonic()
+            pumped = bus.runTransfers(transfers)
+            concurrent = time.monotonic() - t0
+            polls = bus.telemetry.commands['status'] - polls
+        finally:
+            bus.disconnect()
+
+    return {
+        'pumps': len(pumped),
+        'sequential_s': sequential,
+        'concurrent_s': concurrent,
+        'speedup': sequential/concurrent,
+        'concurrent_polls': polls,
+        'pumped_ul': pumped,
+    }
+
+
+def bench_gui_startup(speedup, runs=5, timeout=60.0):
+    ## Seconds from launching microlab_controller to first paint and to a usable window (offscreen).
+    if importlib.util.find_spec('PySide2') is None:
+        return {'skipped': 'PySide2 is not installed.'}
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    first_paint, ready = [], []
+    for run in range(runs):
+        t0 = time.time()
+        output = subprocess.run([sys.executable, os.path.join(here, 'microlab_controller.py'), '--startup-benchmark'],
+            cwd=here, env=env, stdout=subprocess.PIPE, timeout=timeout, check=True).stdout
+        timings = json.loads(output.splitlines()[-1])
+        # The controller measures from its first line, add the interpreter start up before it.
+        launch = timings['started'] - t0
+        first_paint.append(launch + timings['first_paint'])
+        ready.append(launch + timings['ready'])
+    return {'first_paint_s': summarise(first_paint), 'ready_s': summarise(ready)}
+
+
+def bench_replay(speedup, replay_speed=4.0, volume=1500, aspirate=15000, dispense=30000, syringe_volume=500.0):
+    ## A stroke by stroke transfer recorded against the emulator, then replayed from the trace as recorded and faster.
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'transfer.trace')
+        emulator = PumpEmulator(speedup=speedup)
+        with PtyPumpEmulator(emulator) as server:
+            pump = backend.pumpObject()
+            pump.waitEngine.scale = 1.0/speedup
+            pump.tracePath = path
+            pump.connect(server.port)
+            t0 = time.monotonic()
+            pump.pumpCmd('A+B', volume, aspirate, dispense, syringe_volume, compiled=False)
+            results = {'recorded_s': time.monotonic() - t0}
+            pump.disconnect()
+        results['events'] = len(readTrace(path))
+
+        for name, speed in (('replay', 1.0), ('replay_fast', replay_speed)):
+            replay = ReplaySerial(path, speed)
+            pump = backend.pumpObject()
+            pump.waitEngine.scale = 1.0/(speedup*speed)
+            pump.connect(replay)
+            t0 = time.monotonic()
+            pump.pumpCmd('A+B', volume, aspirate, dispense, syringe_volume, compiled=False)
+            results[name] = {'speed': speed, 'wall_s': time.monotonic() - t0, 'writes': replay.writes,
+                'mismatches': replay.mismatches}
+            pump.disconnect()
+    return results
+
+
+def bench_worklist(speedup, transfers=24, syringe_volume=500.0, seed=1):
+    ## A random worklist run in the order given and as planned, predicted and measured.
+    rng = random.Random(seed)
+    steps = [{'action': 'transfer', 'name': 'row %d' % (row + 1), 'row': row + 1, 'group': 0,
+        'syringe': rng.choice(['A+B', 'A+B', 'A']), 'volume': rng.choice([50, 120, 200, 250, 300, 380, 450, 700, 1100]),
+        'aspirate': rng.choice([15000, 30000]), 'dispense': rng.choice([15000, 30000])} for row in range(transfers)]
+    given = Recipe(steps, 'benchmark', syringe_volume)
+    plan, report = worklist.planWorklist(given)
+
+    for name, recipe in (('original', given), ('planned', plan)):
+        with session(speedup) as (pump, emulator):
+            t0 = time.monotonic()
+            RecipeRunner(pump, recipe).run()
+            report['%s_actual_s' % (name)] = (time.monotonic() - t0)*speedup # In instrument seconds.
+    report['actual_saved_s'] = report['original_actual_s'] - report['planned_actual_s']
+    return report
+
+
+BENCHMARKS = [
+    ('round_trip', bench_round_trip),
+    ('polls_per_stroke', bench_polls_per_stroke),
+    ('transfer_overhead', bench_transfer_overhead),
+    ('stop_latency', bench_stop_latency),
+    ('bus', bench_bus),
+    ('gui_startup', bench_gui_startup),
+    ('replay', bench_replay),
+    ('worklist', bench_worklist),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--speedup', type=float, default=1.0, help='Emulated motion time divisor.')
+    parser.add_argument('--only', action='append', choices=[name for name, fn in BENCHMARKS], help='Run only these benchmarks.')
+    parser.add_argument('--json', help='Also write the results to this file.')
+    parser.add_argument('--max-stop', type=float, default=STOP_BUCKETS[-1], help='stop_latency fails trials confirmed idle later than this, seconds.')
+    args = parser.parse_args(argv)
+
+    results = {'speedup': args.speedup}
+    for name, fn in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        results[name] = fn(args.speedup, max_stop=args.max_stop) if fn is bench_stop_latency else fn(args.speedup)
+        print('%s: %s' % (name, json.dumps(results[name], indent=2, sort_keys=True)))
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+'''
+MicroLab 500 auto-discovery.
+
+Candidate serial ports (from serial.tools.list_ports, so virtual consoles
+are left out) are probed concurrently with the 1a/aU handshake and a short
+timeout. A port is a pump if the firmware string it reports matches
+FIRMWARE_RE. Results for USB adapters are cached by USB serial number, so an
+adapter known not to be a pump is skipped on the next scan.
+
+    python discovery.py [--refresh] [--port /dev/pts/3]
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from serial.tools import list_ports
+
+import backend
+import protocol
+
+
+FIRMWARE_RE = re.compile(r'ML\s*-?\s*500|MICROLAB', re.IGNORECASE)
+PROBE_TIMEOUT = 0.3 # seconds to wait for each reply frame.
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'microlab', 'ports.json')
+
+
+PumpInfo = collections.namedtuple('PumpInfo', 'port firmware serial_number description')
+
+
+def fingerprintKey(portInfo):
+    # Stable across reboots and re-plugging only for adapters with a USB serial number.
+    if getattr(portInfo, 'serial_number', None):
+        return '%04x:%04x:%s' % (portInfo.vid or 0, portInfo.pid or 0, portInfo.serial_number)
+    return None
+
+
+def loadCache(path=CACHE_FILE):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def saveCache(cache, path=CACHE_FILE):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(cache, fh, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logging.info('Unable to write the port cache %s: %s' % (path, e))
+
+
+def probePort(port, timeout=PROBE_TIMEOUT, baud=9600):
+    ## Firmware string reported by the device on port, or None if it does not answer like a pump.
+    # Any failure only rules out this port, the other probes carry on. A port already open elsewhere is left alone.
+    try:
+        serialObject = backend.openPort(port, baud, timeout=timeout, write_timeout=timeout)
+    except Exception as e:
+        logging.debug('Unable to open %s: %s' % (port, e))
+        return None
+
+    try:
+        reader = backend.FrameReader(serialObject)
+        reader.reset()
+        commands = protocol.CommandSet('a')
+        serialObject.write(commands.autoAddress)
+        ack, address = reader.read_frame(), reader.read_frame()
+        if protocol.isNak(ack) or protocol.replyAddress(address) != 'a':
+            return None
+
+        serialObject.write(commands.firmware)
+        ack, firmware = reader.read_frame(), reader.read_frame()
+        if protocol.isNak(ack) or protocol.replyAddress(firmware) != 'a':
+            return None
+        return protocol.parseData(firmware)
+    except Exception as e:
+        logging.debug('Probe of %s failed: %s' % (port, e))
+        return None
+    finally:
+        try:
+            serialObject.close()
+        except Exception:
+            pass
+
+
+def discoverPumps(extra_ports=(), refresh=False, timeout=PROBE_TIMEOUT, cache_file=CACHE_FILE):
+    '''
+    Probes every candidate port at once and returns a PumpInfo for each pump
+    found. Cached non-pump adapters are skipped unless refresh is set.
+    '''
+    t0 = time.monotonic()
+    cache = loadCache(cache_file) if cache_file else {}
+
+    candidates = dict((info.device, info) for info in list_ports.comports())
+    for port in extra_ports:
+        candidates.setdefault(port, None)
+
+    probes = {}
+    for port, info in candidates.items():
+        key = fingerprintKey(info) if info is not None else None
+        if not refresh and key in cache and not cache[key]['pump']:
+            continue
+        probes[port] = key
+
+    with ThreadPoolExecutor(max_workers=max(len(probes), 1)) as pool:
+        firmware = dict(zip(probes, pool.map(lambda port: probePort(port, timeout), probes)))
+
+    pumps = []
+    for port, key in sorted(probes.items()):
+        is_pump = firmware[port] is not None and FIRMWARE_RE.search(firmware[port]) is not None
+        if key is not None:
+            cache[key] = {'pump': is_pump, 'firmware': firmware[port], 'port': port}
+        if is_pump:
+            info = candidates[port]
+            pumps.append(PumpInfo(port, firmware[port], getattr(info, 'serial_number', None), getattr(info, 'description', '')))
+
+    if cache_file:
+        saveCache(cache, cache_file)
+    logging.info('Found %d pump(s) on %d probed port(s) in %.2f seconds.' % (len(pumps), len(probes), time.monotonic() - t0))
+    return pumps
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--refresh', action='store_true', help='Probe ports cached as not being pumps too.')
+    parser.add_argument('--port', action='append', default=[], help='Also probe this port.')
+    parser.add_argument('--timeout', type=float, default=PROBE_TIMEOUT, help='Seconds to wait for each reply.')
+    args = parser.parse_args(argv)
+
+    for pump in discoverPumps(args.port, args.refresh, args.timeout):
+        print('%-20s %-20s %s' % (pump.port, pump.firmware, pump.serial_number or ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,340 @@
+import os
+import re
+import time
+import tty
+import select
+import logging
+import threading
+from collections import Counter
+
+
+## Response framing used by the MicroLab 500.
+# Every command is answered with an ack frame followed by a response frame
+# holding the device address and any data, e.g. b'\x06\r' then b'aY\r'.
+ACK = b'\x06'
+NAK = b'\x15'
+CR = b'\r'
+
+TOKEN_RE = re.compile(r'([A-Z])(\d*)')
+SYNC = ('|', None, None, None) # Command boundary in the action buffer.
+
+
+class syringeModel():
+    '''Plunger position, valve and motion timeline of one emulated syringe.'''
+
+    def __init__(self):
+        self.pos = 0 # steps, at the start of the first queued segment.
+        self.planned_pos = 0 # steps, once every queued segment has run.
+        self.speed = 10 # seconds per full stroke.
+        self.valve = 'I'
+        self.segments = [] # (t_start, t_end, pos_start, pos_end)
+
+    def position(self, now):
+        # Fold finished segments into pos and interpolate the running one.
+        while self.segments and self.segments[0][1] <= now:
+            self.pos = self.segments.pop(0)[3]
+
+        if self.segments:
+            t0, t1, p0, p1 = self.segments[0]
+            if now > t0:
+                return p0 + (p1 - p0)*(now - t0)/(t1 - t0)
+        return self.pos
+
+    def halt(self, now):
+        self.pos = int(round(self.position(now)))
+        self.planned_pos = self.pos
+        self.segments = []
+
+
+class PumpEmulator():
+    '''
+    Protocol and timing model of a MicroLab 500.
+
+    Understands the command set used by backend.pumpObject: auto-addressing
+    (1a), initialise (X), valves (I/O), relative and absolute moves (P/D/M)
+    with speed (S) and resolution (N) arguments, run (R), status (F),
+    position (YQP), halt (K), clear queue (V), config (H/J) and firmware (U).
+
+    Moves take steps/stroke_steps*S seconds and valve switches valve_time
+    seconds, both divided by speedup. Commands without R are buffered until
+    the next R; an R received while busy is queued behind the running move.
+    Within one command string each syringe runs its own moves in sequence,
+    both syringes starting together; the next command starts once both
+    have finished.
+    '''
+
+    def __init__(self, stroke_steps=1000, speedup=1.0, valve_time=0.2, init_time=2.0,
+            firmware='ML500 V1.10', clock=time.monotonic):
+        self.stroke_steps = stroke_steps
+        self.speedup = float(speedup)
+        self.valve_time = valve_time
+        self.init_time = init_time
+        self.firmware = firmware
+        self.clock = clock
+
+        self.address = None # Assigned by the 1a auto-address command.
+        self.syringes = {'B': syringeModel(), 'C': syringeModel()}
+        self.buffer = [] # Parsed actions waiting for an R, commands separated by SYNC.
+        self.busy_until = 0.0
+
+        ## Statistics for benchmarking.
+        self.command_counts = Counter()
+        self.motion_time = 0.0 # seconds the pump spent moving.
+        self.last_halt = None # clock time of the last K.
+        self.halt_motion_time = None # motion_time just after the last K, it only grows if motion started after the halt.
+
+
+    def status(self, now=None):
+        now = self.clock() if now is None else now
+        if now < self.busy_until:
+            return '*' # Busy.
+        elif self.buffer:
+            return 'N' # Idle with a non-empty command queue.
+        return 'Y' # Idle with an empty command queue.
+
+    def position(self, syringe, now=None):
+        now = self.clock() if now is None else now
+        return int(round(self.syringes[syringe].position(now)))
+
+
+    def handle(self, command):
+        '''Process one CR-terminated command and return the reply bytes, or None if not addressed.'''
+        now = self.clock()
+        text = command.rstrip(CR).decode('ascii', 'replace')
+
+        if text[:1] == '1' and len(text) == 2: ## Auto-address.
+            self.address = text[1]
+            self.command_counts['1a'] += 1
+            return ACK + CR + self.address.encode('ascii') + CR
+
+        if self.address is None or text[:1] != self.address:
+            return None
+
+        body = text[1:]
+        data = ''
+
+        if body == 'F':
+            self.command_counts['F'] += 1
+            data = self.status(now)
+        elif len(body) == 4 and body[1:] == 'YQP' and body[0] in self.syringes:
+            self.command_counts['YQP'] += 1
+            data = '%d' % (self.position(body[0], now))
+        elif body == 'K':
+            self.command_counts['K'] += 1
+            self.halt(now)
+        elif body == 'V':
+            self.command_counts['V'] += 1
+            self.buffer = []
+        elif body == 'U':
+            self.command_counts['U'] += 1
+            data = self.firmware
+        elif body in ('H', 'J'):
+            self.command_counts[body] += 1
+            data = '1' if body == 'H' else '0'
+        else:
+            self.command_counts['X' if body.startswith('X') else 'motion'] += 1
+            try:
+                self.queue(body, now)
+            except ValueError as e:
+                logging.debug('Emulator rejected %r: %s' % (text, e))
+                return NAK + CR + self.address.encode('ascii') + CR
+
+        return ACK + CR + (self.address + data).encode('ascii') + CR
+
+
+    def parse(self, body):
+        tokens = TOKEN_RE.findall(body)
+        if ''.join(letter + digits for letter, digits in tokens) != body:
+            raise ValueError('malformed command')
+
+        actions = []
+        execute = False
+        syringe = None
+        for letter, digits in tokens:
+            if letter in self.syringes:
+                syringe = letter
+            elif letter == 'X':
+                actions.append(('X', None, None, None))
+            elif letter == 'R':
+                execute = True
+            elif letter in 'IO':
+                if syringe is None:
+                    raise ValueError('valve command without a syringe')
+                actions.append((syringe, letter, None, None))
+            elif letter in 'PDM':
+                if syringe is None or not digits:
+                    raise ValueError('move without a syringe or step count')
+                actions.append((syringe, letter, int(digits), None))
+            elif letter == 'S':
+                if not actions or actions[-1][1] not in ('P', 'D', 'M') or not digits:
+                    raise ValueError('speed without a move')
+                syringe_, kind, steps, _ = actions[-1]
+                actions[-1] = (syringe_, kind, steps, int(digits))
+            elif letter == 'N':
+                pass # Step resolution, no effect on timing.
+            else:
+                raise ValueError('unknown command %s' % (letter))
+        return actions, execute
+
+
+    def queue(self, body, now):
+        actions, execute = self.parse(body)
+
+        # Validate the travel of the whole program before accepting it.
+        planned = dict((name, s.planned_pos) for name, s in self.syringes.items())
+        for syringe, kind, steps, speed in self.buffer + actions:
+            if syringe == SYNC[0]:
+                continue
+            elif syringe == 'X':
+                planned = dict((name, 0) for name in planned)
+            elif kind in 'PDM':
+                target = {'P': planned[syringe] + (steps or 0), 'D': planned[syringe] - (steps or 0), 'M': steps}[kind]
+                if target < 0 or target > self.stroke_steps:
+                    raise ValueError('move out of range')
+                planned[syringe] = target
+
+        if actions:
+            self.buffer.extend(actions + [SYNC])
+        if execute:
+            self.run(now)
+
+    def run(self, now):
+        start = max(now, self.busy_until)
+        lane_time = dict((name, start) for name in self.syringes)
+
+        for syringe, kind, steps, speed in self.buffer:
+            if syringe == SYNC[0]:
+                lane_time = dict.fromkeys(lane_time, max(lane_time.values()))
+                continue
+            elif syringe == 'X':
+                end = max(lane_time.values()) + self.init_time/self.speedup
+                for name, s in self.syringes.items():
+                    s.segments.append((lane_time[name], end, s.planned_pos, 0))
+                    s.planned_pos = 0
+                    s.valve = 'I'
+                    lane_time[name] = end
+                continue
+
+            s = self.syringes[syringe]
+            if kind in 'IO':
+                if s.valve != kind:
+                    lane_time[syringe] += self.valve_time/self.speedup
+                    s.valve = kind
+                continue
+
+            if speed is not None:
+                s.speed = speed
+            target = {'P': s.planned_pos + steps, 'D': s.planned_pos - steps, 'M': steps}[kind]
+            duration = abs(target - s.planned_pos)/float(self.stroke_steps)*s.speed/self.speedup
+            if duration > 0:
+                s.segments.append((lane_time[syringe], lane_time[syringe] + duration, s.planned_pos, target))
+            s.planned_pos = target
+            lane_time[syringe] += duration
+
+        self.buffer = []
+        self.busy_until = max(lane_time.values())
+        self.motion_time += self.busy_until - start
+
+    def halt(self, now):
+        if self.busy_until > now:
+            self.motion_time -= self.busy_until - now
+        for s in self.syringes.values():
+            s.halt(now)
+        self.busy_until = min(self.busy_until, now)
+        self.last_halt = now
+        self.halt_motion_time = self.motion_time
+
+
+
+class PumpChain():
+    '''
+    Several PumpEmulators daisy-chained on one port.
+
+    Auto-addressing (1x) gives the first pump address x, the next the
+    following letter and so on, and the reply carries the last address
+    assigned. Every other command is answered by the pump it is addressed to.
+    '''
+
+    def __init__(self, pumps):
+        self.pumps = list(pumps)
+
+    def handle(self, command):
+        text = command.rstrip(CR).decode('ascii', 'replace')
+        if text[:1] == '1' and len(text) == 2: ## Auto-address.
+            address = text[1]
+            for pump in self.pumps:
+                pump.handle(('1%s\r' % (address)).encode('ascii'))
+                last, address = address, chr(ord(address) + 1)
+            return ACK + CR + last.encode('ascii') + CR
+
+        for pump in self.pumps:
+            reply = pump.handle(command)
+            if reply is not None:
+                return reply
+        return None
+
+
+
+class PtyPumpEmulator():
+    '''
+    Serves a PumpEmulator (or a PumpChain) on a pseudo terminal so
+    backend.pumpObject can connect to it with a real serial.Serial through
+    the path in self.port.
+
+    Replies are delayed by the wire time of the command and response at the
+    given baud rate (10 bits per character for 7O1) plus processing_delay.
+    '''
+
+    def __init__(self, emulator=None, baud=9600, processing_delay=0.001):
+        self.emulator = emulator if emulator is not None else PumpEmulator()
+        self.char_time = 10.0/baud
+        self.processing_delay = processing_delay
+        self.port = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, name='PtyPumpEmulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+    def _serve(self):
+        pending = bytearray()
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                pending += os.read(self._master, 1024)
+            except OSError:
+                break
+
+            while CR in pending:
+                end = pending.index(CR) + 1
+                command = bytes(pending[:end])
+                del pending[:end]
+
+                reply = self.emulator.handle(command)
+                if reply is None:
+                    continue
+                time.sleep((len(command) + len(reply))*self.char_time + self.processing_delay)
+                os.write(self._master, reply)
@@ -0,0 +1,204 @@
+'''
+Crash-safe run journal for backend.pumpObject.
+
+An append-only binary log of each transfer: its parameters, every motion
+command the pump acknowledged, the synced plunger positions, the progress
+after each completed stroke and how the transfer ended. Records are written
+straight to the file, so they survive the controller crashing; fsync is
+batched to at most one every sync_interval seconds, plus one at the start and
+end of each transfer and for each command carrying the R that starts motion,
+so a power cut never loses a command the pump may go on to run.
+
+Reads map the file into memory. A torn record at the end (from a crash in
+the middle of a write) is detected by its CRC and cut off. pending returns
+the transfer the journal shows as started but never ended, which
+pumpObject.resumeTransfer uses to pump the rest without re-homing:
+
+    pump.journal = journal.Journal()
+    pump.connect('/dev/ttyUSB0')
+    if pump.pendingTransfer() is not None:
+        pump.resumeTransfer()
+'''
+
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+import collections
+
+from protocol import startsRun
+
+
+JOURNAL_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'microlab', 'journal.bin')
+MAGIC = b'MLJ1'
+
+## Record header: CRC32 of the rest of the record, payload length, kind, unix time.
+HEADER = struct.Struct('<IIBd')
+
+## Record kinds.
+TRANSFER = 1 # JSON transfer parameters.
+COMMAND = 2 # Motion command bytes, once acknowledged.
+POSITIONS = 3 # Plunger steps of B and C, -1 if unknown.
+PROGRESS = 4 # Volume pumped and total volume, ul.
+END = 5 # How the transfer ended: done, stopped, rejected, resumed or abandoned.
+
+POSITIONS_RECORD = struct.Struct('<ii')
+PROGRESS_RECORD = struct.Struct('<dd')
+
+
+Record = collections.namedtuple('Record', 'kind time data')
+
+PendingTransfer = collections.namedtuple('PendingTransfer', 'params started commands pumped positions')
+
+
+def decodeRecord(kind, payload):
+    if kind == TRANSFER:
+        return json.loads(payload.decode('utf-8'))
+    elif kind == POSITIONS:
+        return dict((name, steps if steps >= 0 else None) for name, steps in zip('BC', POSITIONS_RECORD.unpack(payload)))
+    elif kind == PROGRESS:
+        return PROGRESS_RECORD.unpack(payload)
+    elif kind == END:
+        return payload.decode('ascii')
+    return bytes(payload)
+
+
+def scanRecords(path):
+    '''
+    (records, end) for the journal at path: the decoded records and the
+    offset just past the last intact one.
+    '''
+    records = []
+    try:
+        fh = open(path, 'rb')
+    except FileNotFoundError:
+        return records, 0
+    with fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size <= len(MAGIC):
+            return records, 0
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError('%s is not a MicroLab journal.' % (path))
+            offset = len(MAGIC)
+            while offset + HEADER.size <= size:
+                crc, length, kind, stamp = HEADER.unpack_from(data, offset)
+                end = offset + HEADER.size + length
+                if end > size or zlib.crc32(data[offset + 4:end]) != crc:
+                    break # Torn by a crash part way through the write.
+                records.append(Record(kind, stamp, decodeRecord(kind, data[offset + HEADER.size:end])))
+                offset = end
+    return records, offset
+
+
+def readJournal(path=JOURNAL_FILE):
+    return scanRecords(path)[0]
+
+
+def pendingTransfer(records):
+    ## The last transfer in records if it has no END record, else None.
+    pending = None
+    for record in records:
+        if record.kind == TRANSFER:
+            pending = PendingTransfer(record.data, record.time, [], 0.0, None)
+        elif pending is None:
+            continue
+        elif record.kind == COMMAND:
+            pending.commands.append(record.data)
+        elif record.kind == PROGRESS:
+            pending = pending._replace(pumped=record.data[0])
+        elif record.kind == POSITIONS:
+            pending = pending._replace(positions=record.data)
+        elif record.kind == END:
+            pending = None
+    return pending
+
+
+
+class Journal():
+
+    def __init__(self, path=JOURNAL_FILE, sync_interval=0.5, max_bytes=1000000):
+        self.path = path
+        self.sync_interval = sync_interval # seconds between fsyncs.
+        self.max_bytes = max_bytes # Start a new file after a transfer ends beyond this size.
+        self.lock = threading.Lock()
+        self.synced = time.monotonic()
+        self.unsynced = 0 # Records written since the last fsync.
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        records, end = scanRecords(path)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if end == 0:
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, MAGIC)
+        elif os.fstat(self.fd).st_size > end:
+            logging.info('Dropping a torn record at the end of the journal %s.' % (path))
+            os.ftruncate(self.fd, end)
+        os.lseek(self.fd, 0, os.SEEK_END)
+
+
+    def append(self, kind, payload=b'', sync=False):
+        body = HEADER.pack(0, len(payload), kind, time.time())[4:] + payload
+        record = struct.pack('<I', zlib.crc32(body)) + body
+        with self.lock:
+            os.write(self.fd, record) # One write per record, in the page cache if the process dies.
+            self.unsynced += 1
+            if sync or time.monotonic() - self.synced >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        # Call with the lock held.
+        if self.unsynced:
+            os.fsync(self.fd)
+            self.unsynced = 0
+        self.synced = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            os.close(self.fd)
+            self.fd = None
+
+
+    def transfer(self, params):
+        self.append(TRANSFER, json.dumps(params, sort_keys=True).encode('utf-8'), sync=True)
+
+    def command(self, command):
+        # Once the pump has the R it runs on even if the host loses power, so that record goes to disk at once.
+        self.append(COMMAND, command, sync=startsRun(command))
+
+    def positions(self, positions):
+        steps = [positions.get(name) for name in 'BC']
+        self.append(POSITIONS, POSITIONS_RECORD.pack(*[-1 if value is None else value for value in steps]))
+
+    def progress(self, pumped, total):
+        self.append(PROGRESS, PROGRESS_RECORD.pack(pumped, total))
+
+    def end(self, reason='done'):
+        self.append(END, reason.encode('ascii'), sync=True)
+        with self.lock:
+            if os.fstat(self.fd).st_size > self.max_bytes:
+                self.rotate()
+
+    def rotate(self):
+        # Call with the lock held, between transfers. The previous file is kept as path.1.
+        os.close(self.fd)
+        os.replace(self.path, self.path + '.1')
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, MAGIC)
+        os.fsync(self.fd)
+
+
+    def records(self):
+        return readJournal(self.path)
+
+    def pending(self):
+        return pendingTransfer(self.records())
@@ -1,16 +1,51 @@
-import sys, os, time, glob
+import sys, os, time
+STARTED = time.time() # Before the Qt imports, for the startup benchmark.
+
+import json
 import logging
 import traceback
 
-from PySide2.QtGui import *
-from PySide2.QtWidgets import *
-from PySide2.QtCore import *
-from PySide2.QtUiTools import QUiLoader
+from PySide2.QtWidgets import QApplication, QMainWindow, QMessageBox
+from PySide2.QtCore import QObject, QRunnable, QThreadPool, QTimer, QEvent, Qt, Signal, Slot
+
+## backend (and with it serial) and qdarkstyle are imported once the window is on screen.
+backend = None
+
+
+LOG_VIEW_LINES = 2000 # Lines kept in the on-screen log.
+PLOT_POINTS = 600 # Points drawn per plot series, however long the run.
+
+
+
+
+def loadWindow():
+    ## The main window from the precompiled ui_main.py, or main.ui if that is missing.
+    try:
+        from ui_main import Ui_MainWindow
+    except ImportError:
+        from PySide2.QtCore import QFile
+        from PySide2.QtUiTools import QUiLoader
+        ui_file = QFile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.ui'))
+        ui_file.open(QFile.ReadOnly)
+        window = QUiLoader().load(ui_file)
+        ui_file.close()
+        return window
 
-import qdarkstyle
+    class uiWindow(QMainWindow, Ui_MainWindow):
+        def __init__(self):
+            super().__init__()
+            self.setupUi(self)
+    return uiWindow()
 
-import backend
 
+def listCommPorts():
+    # The ports pumps answered on, or every serial port if none did.
+    import discovery
+    pumps = discovery.discoverPumps()
+    if pumps:
+        return [pump.port for pump in pumps]
+    logging.info('No pumps found, listing all serial ports.')
+    return sorted(info.device for info in discovery.list_ports.comports())
 
 
 
@@ -40,6 +75,26 @@ class WorkerSignals(QObject):
     progress = Signal(int)
 
 
+class LogSignals(QObject):
+    '''
+    Delivers backend log lines to the GUI in batches.
+
+    lines
+        `list` of formatted log lines logged since the last batch
+    '''
+    lines = Signal(list)
+
+
+class StatusSignals(QObject):
+    '''
+    Carries backend status snapshots to the GUI thread.
+
+    changed
+        `backend.PumpStatus` published whenever the pump state changes
+    '''
+    changed = Signal(object)
+
+
 class Worker(QRunnable):
     def __init__(self, fn, *args, **kwargs):
             super(Worker, self).__init__()
@@ -69,35 +124,163 @@ class Worker(QRunnable):
 
 class mainWindow(QMainWindow):
 
-    def __init__(self):
+    def __init__(self, benchmark=False):
         super().__init__()
-        self.backend = backend.pumpObject()
+        self.backend = None
+        self.benchmark = benchmark
+        self.timings = {} # seconds from process start to first paint and to ready.
 
         self.threadpool = QThreadPool()
 
         self.setupUI()
 
+
+    def loadBackend(self):
+        global backend
+        if self.backend is not None:
+            return
+        import backend
+        import journal
+        import statushistory
+        backend.configureLogging()
+        self.backend = backend.pumpObject()
+        self.backend.journal = journal.Journal() # Lets a transfer cut short by a crash be resumed.
+        self.backend.timingPath = backend.TIMING_FILE # Predict with the calibration from timing.py --calibrate.
+
         self.refreshCommPorts()
 
-        self.statusTimer = QTimer()
-        self.statusTimer.timeout.connect(self.pollStatus)
-        self.statusTimer.start(500) ## Poll the pump status every 500ms.
+        # Redraw only when the backend publishes a new status snapshot, from whichever thread.
+        self.status = None
+        self.statusSignals = StatusSignals()
+        self.statusSignals.changed.connect(self.renderStatus)
+        self.backend.statusListeners.append(self.statusSignals.changed.emit)
+        self.renderStatus(self.backend.statusSnapshot)
 
-        self.log_fh = open(backend.LOG_FILE, 'r')
+        # Live plot of the status stream, from a fixed-size history.
+        self.history = statushistory.StatusHistory()
+        self.backend.statusListeners.append(self.history.append)
+        self.history.append(self.backend.statusSnapshot)
+        self.setupPlot()
 
+        # The elapsed time is the only thing that changes without the pump state changing.
+        self.elapsedTimer = QTimer()
+        self.elapsedTimer.timeout.connect(self.renderElapsed)
+        self.elapsedTimer.start(1000)
 
-    def setupUI(self):
-        # x = qdarkstyle.load_stylesheet_pyside2()
-        # app.setStyleSheet(x)
+        # Batch log lines from the backend ring buffer into the log view.
+        self.logSignals = LogSignals()
+        self.logSignals.lines.connect(self.appendLogLines)
+        self.logTimer = QTimer()
+        self.logTimer.timeout.connect(self.drainLog)
+        self.logTimer.start(200)
 
-        ui_file = QFile("main.ui")
-        ui_file.open(QFile.ReadOnly)
+        self.window.setEnabled(True)
 
-        loader = QUiLoader()
-        self.window = loader.load(ui_file)
-        ui_file.close()
+        import qdarkstyle
+        QApplication.instance().setStyleSheet(qdarkstyle.load_stylesheet())
+
+
+    def setupPlot(self):
+        # QtCharts is optional, without it there is no plot.
+        try:
+            from PySide2.QtCharts import QtCharts
+        except ImportError:
+            logging.info('QtCharts is not available, the live plot is disabled.')
+            self.plotted = None
+            return
+        from PySide2.QtCore import QPointF
+        from PySide2.QtGui import QPainter
+        from PySide2.QtWidgets import QHBoxLayout
+        self.QPointF = QPointF
+
+        def chart(title, axes):
+            view = QtCharts.QChartView()
+            view.setRenderHint(QPainter.Antialiasing, False)
+            view.chart().setTitle(title)
+            view.chart().legend().setAlignment(Qt.AlignBottom)
+            time_axis = QtCharts.QValueAxis()
+            time_axis.setTitleText('minutes')
+            time_axis.setLabelFormat('%d')
+            time_axis.setTickCount(5)
+            view.chart().addAxis(time_axis, Qt.AlignBottom)
+            value_axes = []
+            for name, alignment in axes:
+                axis = QtCharts.QValueAxis()
+                axis.setTitleText(name)
+                axis.setLabelFormat('%d')
+                view.chart().addAxis(axis, alignment)
+                value_axes.append(axis)
+            return view, time_axis, value_axes
+
+        def line(view, name, time_axis, value_axis):
+            series = QtCharts.QLineSeries()
+            series.setName(name)
+            series.setUseOpenGL(False)
+            view.chart().addSeries(series)
+            series.attachAxis(time_axis)
+            series.attachAxis(value_axis)
+            return series
+
+        flowView, flowTime, (volumeAxis, rateAxis) = chart('Delivery', [('µl', Qt.AlignLeft), ('µl/minute', Qt.AlignRight)])
+        positionView, positionTime, (stepAxis,) = chart('Plungers', [('steps', Qt.AlignLeft)])
+        self.plotAxes = {'time': (flowTime, positionTime), 'volume': volumeAxis, 'rate': rateAxis, 'steps': stepAxis}
+        self.plotSeries = {
+            'delivered': line(flowView, 'Delivered', flowTime, volumeAxis),
+            'flow': line(flowView, 'Set rate', flowTime, rateAxis),
+            'delivery_rate': line(flowView, 'Measured rate', flowTime, rateAxis),
+            'position_b': line(positionView, 'A', positionTime, stepAxis),
+            'position_c': line(positionView, 'B', positionTime, stepAxis),
+        }
+
+        layout = QHBoxLayout(self.window.plotArea)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(flowView, 3)
+        layout.addWidget(positionView, 2)
+
+        self.plotted = 0 # history.count at the last redraw.
+        self.plotTimer = QTimer()
+        self.plotTimer.timeout.connect(self.refreshPlot)
+        self.plotTimer.start(1000)
+
+
+    def refreshPlot(self):
+        # Samples the pump while it is busy, so a stall shows as a flat line, then redraws if anything was added.
+        if self.status is not None and self.status.status == 2:
+            count = self.history.count
+            self.backend.publishStatus() # Moves the predicted plunger positions on, the listener adds the sample.
+            if self.history.count == count:
+                self.history.append(self.backend.statusSnapshot)
+        if self.history.count == self.plotted:
+            return
+        self.plotted = self.history.count
+
+        data = self.history.series(PLOT_POINTS)
+        minutes = (data['time'] - data['time'][-1])/60.0
+        for name, series in self.plotSeries.items():
+            values = data[name]
+            series.replace([self.QPointF(x, y) for x, y in zip(minutes, values) if y == y]) # y == y drops NaN.
+
+        for axis in self.plotAxes['time']:
+            axis.setRange(min(minutes[0], -1.0), 0.0)
+        self.plotAxes['volume'].setRange(0.0, max(data['delivered'].max(), 1.0)*1.05)
+        self.plotAxes['rate'].setRange(0.0, max(data['flow'].max(), data['delivery_rate'].max(), 1.0)*1.05)
+        self.plotAxes['steps'].setRange(0.0, 1000.0)
 
+
+    def eventFilter(self, watched, event):
+        # Everything else waits until the window has been painted once.
+        if event.type() == QEvent.Paint and 'first_paint' not in self.timings:
+            self.timings['first_paint'] = time.time() - STARTED
+            QTimer.singleShot(0, self.loadBackend)
+        return False
+
+
+    def setupUI(self):
+        self.window = loadWindow()
+        self.window.setEnabled(False) # Until the backend is loaded.
+        self.window.installEventFilter(self)
         self.window.show()
+        QTimer.singleShot(1000, self.loadBackend) # In case no paint event reaches the filter.
 
 
         # Setup button connections
@@ -109,28 +292,59 @@ class mainWindow(QMainWindow):
         self.window.pumpStop.clicked.connect(self.pumpstopcmd)
         self.window.pumpDispense.clicked.connect(self.pumpdispensecmd)
 
+        # Keep only the most recent lines in the log view.
+        self.window.log_data_view.setMaximumBlockCount(LOG_VIEW_LINES)
+
 
 
 
     def refreshCommPorts(self):
-        backend.logging.info('Refreshing com ports.')
+        logging.info('Refreshing com ports.')
 
-        search_dir = '/dev'
-        files = glob.glob(os.path.join(search_dir, 'tty*'))
-        files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
+        # Stat the ports off the GUI thread.
+        worker = Worker(listCommPorts)
+        worker.signals.result.connect(self.showCommPorts)
+        self.threadpool.start(worker)
 
+    def showCommPorts(self, files):
         self.window.commCombo.clear()
         self.window.commCombo.addItems(files)
 
+        if 'ready' not in self.timings:
+            self.timings['ready'] = time.time() - STARTED
+            if self.benchmark:
+                print(json.dumps(dict(self.timings, started=STARTED)))
+                QApplication.instance().quit()
+
 
     def connect(self):
         ## Connect to pump.
         selected_com_port = self.window.commCombo.currentText()
         # self.backend.connect(selected_com_port)
         worker = Worker(self.backend.connect, selected_com_port)
+        worker.signals.result.connect(self.offerResume)
         self.threadpool.start(worker)
 
 
+    def offerResume(self, result=None):
+        # Offer to finish a transfer the journal shows was interrupted.
+        if self.backend.__PUMP_CONNECTION__ != 1:
+            return
+        pending = self.backend.pendingTransfer()
+        if pending is None:
+            return
+        params, delivered = pending
+
+        answer = QMessageBox.question(self.window, 'Resume transfer',
+            'A transfer of %d µl was interrupted after %d µl. Pump the remaining %d µl?' % (
+            params['volume'], delivered, params['volume'] - delivered))
+        if answer == QMessageBox.Yes:
+            worker = Worker(self.backend.resumeTransfer)
+            self.threadpool.start(worker)
+        else:
+            self.backend.abandonTransfer()
+
+
     def disconnect(self):
         ## Disconnect from the pump.
         worker = Worker(self.backend.disconnect)
@@ -145,79 +359,87 @@ class mainWindow(QMainWindow):
 
 
 
-    def pollStatus(self):
-        # Pump status polling.
-        # Used to update buttons and pump status text on gui.
-
-        status_text = ''
-        if self.backend.__PUMP_CONNECTION__ == 0:
-            status_text += 'Disconnected'
-        elif self.backend.__PUMP_CONNECTION__ == 1:
-            status_text += 'Connected'
-
-        if self.backend.__PUMP_CONNECTION__ == 1:
-
-            self.window.commConnect.setEnabled(False)
-            self.window.commDisconnect.setEnabled(True)
-            self.window.commInitialise.setEnabled(True)
-
-            if self.backend.__PUMP_STATUS__ == 0:
-                status_text += ', Uninitialised'
-            elif self.backend.__PUMP_STATUS__ == 1:
-                status_text += ', Ready'
-                self.window.pumpGo.setEnabled(True)
-                self.window.pumpDispense.setEnabled(True)
-            elif self.backend.__PUMP_STATUS__ == 2:
+    def renderStatus(self, status):
+        # Update the buttons and pump status text from a backend.PumpStatus.
+        # Only the widgets showing fields that changed since the last snapshot are touched.
+        changed = status.changed(self.status)
+        self.status = status
+
+        if changed & {'connection', 'status'}:
+            status_text = ''
+            if status.connection == 0:
+                status_text += 'Disconnected'
+            elif status.connection == 1:
+                status_text += 'Connected'
+
+            if status.connection == 1:
+
+                self.window.commConnect.setEnabled(False)
+                self.window.commDisconnect.setEnabled(True)
+                self.window.commInitialise.setEnabled(True)
+                self.window.commRefresh.setEnabled(False) # Probing would write to the port in use.
+
+                if status.status == 0:
+                    status_text += ', Uninitialised'
+                elif status.status == 1:
+                    status_text += ', Ready'
+                    self.window.pumpGo.setEnabled(True)
+                    self.window.pumpDispense.setEnabled(True)
+                elif status.status == 2:
+                    self.window.pumpGo.setEnabled(False)
+                    self.window.pumpDispense.setEnabled(False)
+                    status_text += ', Busy'
+
+                # Pump buttons
+                self.window.pumpStop.setEnabled(True)
+            else:
+                self.window.commConnect.setEnabled(True)
+                self.window.commDisconnect.setEnabled(False)
+                self.window.commInitialise.setEnabled(False)
+                self.window.commRefresh.setEnabled(True)
+
+                # Pump buttons
                 self.window.pumpGo.setEnabled(False)
-                self.window.pumpDispense.setEnabled(False)
-                status_text += ', Busy'
+                self.window.pumpStop.setEnabled(False)
 
-            # Pump buttons
-            self.window.pumpStop.setEnabled(True)
-            self.window.repaint()
-        else:
-            self.window.commConnect.setEnabled(True)
-            self.window.commDisconnect.setEnabled(False)
-            self.window.commInitialise.setEnabled(False)
-
-            # Pump buttons
-            self.window.pumpGo.setEnabled(False)
-            self.window.pumpStop.setEnabled(False)
-            self.window.repaint()
+            self.window.pumpStatus.setText(status_text)
 
 
 
-        self.window.pumpStatus.setText(status_text)
-
-        # Update the log file stream.
-        log_data_line = self.log_fh.readline().rstrip()
-        if log_data_line:
-            self.window.log_data_view.appendPlainText(log_data_line)
+        ## Pumping details. Update from the snapshot only if actively pumping.
+        if status.status == 2: ## Pump status of 2 is busy.
 
+            # Current task.
+            if changed & {'status', 'direction', 'pumping_volume', 'flow_rate'}:
+                self.window.current_task.setText('%s %d µl at %d µl/minute.' % (
+                    status.direction, status.pumping_volume, status.flow_rate))
 
+            # Volume pumped.
+            if changed & {'status', 'pumped_volume', 'total_volume'}:
+                self.window.task_progress.setText('Progress: %d µl of %d µl.' % (
+                    status.pumped_volume, status.total_volume))
 
-        ## Pumping details. Update from backend variables only if actively pumping.
-        if self.backend.__PUMP_STATUS__ == 2: ## Pump status of 2 is busy.
+            if changed & {'status', 'time_start', 'time_estimated'}:
+                self.renderElapsed()
 
-            # Current task.
-            self.window.current_task.setText('%s %d µl at %d µl/minute.' % (
-                self.backend.__direction__, self.backend.__pumping_volume__, self.backend.__flow_rate__))
 
-            # Volume pumped.
-            self.window.task_progress.setText('Progress: %d µl of %d µl.' % (
-                self.backend.__pumped_volume__, self.backend.__total_volume__))
+    def renderElapsed(self):
+        # Time elapsed/total.
+        if self.status is None or self.status.status != 2:
+            return
+        time_elapsed = time.time() - self.status.time_start
+        self.window.time_progress.setText('Time elapsed/Time total: %d seconds of %d seconds.' % (
+            time_elapsed, self.status.time_estimated))
 
-            # Time elapsed/total.
-            time_elapsed = time.time() - self.backend.__time_start__
-            self.window.time_progress.setText('Time elapsed/Time total: %d seconds of %d seconds.' % (
-                time_elapsed, self.backend.__time_estimated__))
 
-        # else:
-            # self.window.current_task.setText('')
-        #     self.window.task_progress.setText('')
-        #     self.window.time_progress.setText('')
 
+    def drainLog(self):
+        lines = backend.LOG_BUFFER.drain()
+        if lines:
+            self.logSignals.lines.emit(lines)
 
+    def appendLogLines(self, lines):
+        self.window.log_data_view.appendPlainText('\n'.join(lines))
 
 
 
@@ -231,12 +453,18 @@ class mainWindow(QMainWindow):
         if self.window.volume_units.currentText() == 'ml':
             volume = volume *1000
 
-        aspirate_sec_per_full_stroke = round(config_syringe_volume/(aspirate_rate/60.0))
-        dispense_sec_per_full_stroke = round(config_syringe_volume/(dispense_rate/60.0))
-        min_rate = config_syringe_volume*60.0/250.0
-        max_rate = config_syringe_volume*60.0/1.0
+        min_rate, max_rate = backend.rateLimits(config_syringe_volume)
+
+        if volume <= 0:
+            # Raise an error widget.
+            volume_error = QMessageBox()
+            volume_error.setIcon(QMessageBox.Critical)
+            volume_error.setText("Invalid volume")
+            volume_error.setInformativeText("The volume to pump must be positive.")
+            volume_error.exec_()
+            return
 
-        if aspirate_sec_per_full_stroke > 250 or aspirate_sec_per_full_stroke < 1:
+        if not backend.rateInRange(aspirate_rate, config_syringe_volume):
             # Raise an error widget.
             rate_error = QMessageBox()
             rate_error.setIcon(QMessageBox.Critical)
@@ -246,7 +474,7 @@ class mainWindow(QMainWindow):
             rate_error.exec_()
             return
 
-        if dispense_sec_per_full_stroke > 250 or dispense_sec_per_full_stroke < 1:
+        if not backend.rateInRange(dispense_rate, config_syringe_volume):
             # Raise an error widget.
             rate_error = QMessageBox()
             rate_error.setIcon(QMessageBox.Critical)
@@ -262,7 +490,8 @@ class mainWindow(QMainWindow):
         self.threadpool.start(worker)
 
     def pumpstopcmd(self):
-        worker = Worker(self.backend.stopPump)
+        # Stop latency is measured from the button press.
+        worker = Worker(self.backend.stopPump, requested=time.monotonic())
         self.threadpool.start(worker)
 
     def pumpdispensecmd(self):
@@ -277,9 +506,9 @@ class mainWindow(QMainWindow):
 if __name__ == "__main__":
 
     app = QApplication(sys.argv)
-    app.setStyleSheet(qdarkstyle.load_stylesheet())
 
-    window = mainWindow()
+    # --startup-benchmark prints the seconds to first paint and to ready as JSON, then exits.
+    window = mainWindow(benchmark='--startup-benchmark' in sys.argv)
 
 
     sys.exit(app.exec_())
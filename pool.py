@@ -0,0 +1,177 @@
+'''
+A pool of MicroLab 500s on separate serial ports, supervised from one process.
+
+Each pump gets its own pumpObject (and so its own serial I/O thread) and one
+job worker thread. Jobs go on a shared queue: a job for a named pump waits
+for that pump, a job for any pump goes to the first one free. snapshot
+gathers the state of every pump in one pass for a status display.
+
+    pool = PumpPool()
+    pool.add('/dev/ttyUSB0', 'left')
+    pool.add('/dev/ttyUSB1', 'right')
+    pool.submit('left', 'initialise')
+    pool.submit(None, 'pumpCmd', volume=2000, aspirate=6000, dispense=6000)
+    for state in pool.snapshot():
+        print(state['name'], state['status'], state['pumped_volume'])
+'''
+
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import Future
+
+import backend
+
+
+STATUS_TEXT = {0: 'Uninitialised', 1: 'Ready', 2: 'Busy'}
+
+
+class PoolJob():
+
+    def __init__(self, name, method, kwargs):
+        self.name = name # Pump name, None for any pump.
+        self.method = method
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class PumpPool():
+
+    def __init__(self):
+        self.pumps = collections.OrderedDict() # name: pumpObject
+        self.ports = {}
+        self.workers = {}
+        self.running = {} # name: method of the job in progress.
+        self.jobs = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+
+    def add(self, port, name=None, pump=None):
+        ## Connects a pump on port and starts its worker, returns the pump name.
+        name = name or port
+        if name in self.pumps:
+            raise ValueError('A pump named %s is already in the pool.' % (name))
+        pump = pump if pump is not None else backend.pumpObject()
+        if pump.__PUMP_CONNECTION__ != 1:
+            pump.connect(port)
+        if pump.__PUMP_CONNECTION__ != 1:
+            raise backend.serial.SerialException('Unable to connect to %s.' % (port))
+
+        with self.condition:
+            self.pumps[name] = pump
+            self.ports[name] = port
+            self.running[name] = None
+            self.workers[name] = threading.Thread(target=self.work, args=(name,), name='PumpPool-%s' % (name), daemon=True)
+            self.workers[name].start()
+        return name
+
+
+    def remove(self, name):
+        with self.condition:
+            pump = self.pumps.pop(name)
+            self.cancel(name)
+            self.condition.notify_all()
+        if self.running[name] is not None:
+            pump.stopPump()
+        self.workers.pop(name).join()
+        del self.ports[name], self.running[name]
+        pump.disconnect()
+
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.cancel(None)
+            self.condition.notify_all()
+        for name in list(self.pumps):
+            if self.running[name] is not None:
+                self.pumps[name].stopPump()
+            self.workers[name].join()
+            self.pumps[name].disconnect()
+        self.pumps.clear()
+
+
+    def submit(self, name, method, **kwargs):
+        ## Queues pumpObject.method(**kwargs) for pump name (None for any pump), returns a Future of its result.
+        if name is not None and name not in self.pumps:
+            raise KeyError('No pump named %s in the pool.' % (name))
+        job = PoolJob(name, method, kwargs)
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify_all()
+        return job.future
+
+
+    def cancel(self, name):
+        # Cancel the queued jobs for pump name (every job if None). Call with the condition held.
+        for job in list(self.jobs):
+            if name is None or job.name == name:
+                self.jobs.remove(job)
+                job.future.cancel()
+
+
+    def work(self, name):
+        pump = self.pumps[name]
+        while True:
+            with self.condition:
+                job = None
+                while job is None:
+                    if self.closed or name not in self.pumps:
+                        return
+                    job = next((job for job in self.jobs if job.name in (name, None)), None)
+                    if job is None:
+                        self.condition.wait()
+                self.jobs.remove(job)
+                self.running[name] = job.method
+
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(getattr(pump, job.method)(**job.kwargs))
+                except Exception as e:
+                    logging.exception('Pool job %s on %s failed.' % (job.method, name))
+                    job.future.set_exception(e)
+            with self.condition:
+                self.running[name] = None
+
+
+    def stop(self, name=None):
+        ## Stops one pump (all if name is None) at once, without waiting behind queued jobs, which are cancelled.
+        # Only pumps running a job are halted, idle ones have nothing to stop.
+        requested = time.monotonic()
+        with self.condition:
+            self.cancel(name)
+            names = [name for name in ([name] if name is not None else self.pumps) if self.running[name] is not None]
+
+        threads = [threading.Thread(target=self.pumps[name].stopPump, kwargs={'requested': requested}) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+    def snapshot(self):
+        ## The state of every pump, as a list of dicts in the order they were added.
+        now = time.time()
+        with self.condition:
+            queued = collections.Counter(job.name for job in self.jobs)
+            states = []
+            for name, pump in self.pumps.items():
+                state = pump.statusSnapshot # One consistent PumpStatus per pump.
+                states.append({
+                    'name': name,
+                    'port': self.ports[name],
+                    'connected': state.connection == 1,
+                    'status': STATUS_TEXT.get(state.status),
+                    'direction': state.direction,
+                    'pumping_volume': state.pumping_volume,
+                    'flow_rate': state.flow_rate,
+                    'pumped_volume': state.pumped_volume,
+                    'total_volume': state.total_volume,
+                    'time_elapsed': now - state.time_start if self.running[name] else 0,
+                    'time_estimated': state.time_estimated,
+                    'job': self.running[name],
+                    'queued': queued[name],
+                })
+            return states
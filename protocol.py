@@ -0,0 +1,174 @@
+'''
+MicroLab 500 command encoding and reply parsing.
+
+Every command is built here from typed parameters and every reply frame is
+parsed here, for backend, async_backend and discovery alike. Commands sent
+over and over (status, position, halt, clear) are encoded once per pump
+address in a CommandSet. Acks and status replies, read on every poll, are
+checked by byte value without slicing or decoding the frame. A frame that is
+not shaped like the reply expected raises PumpProtocolError.
+
+A command is the pump address, the command body and a CR; bodies of motion
+commands end with R to start them. Each command is answered with two
+frames: an ack (ACK or NAK, then CR) and a reply (the address, the data
+and CR).
+'''
+
+import re
+import functools
+
+import serial
+
+
+ACK = b'\x06'
+NAK = b'\x15'
+CR = b'\r'
+
+_ACK, _NAK, _CR = ACK[0], NAK[0], CR[0]
+
+
+## Instrument syringes driven by each GUI syringe mode.
+# In continuous mode one syringe refills while the other dispenses.
+CONTINUOUS = 'A+B continuous'
+SYRINGES = {'A+B': 'BC', 'A': 'B', 'B': 'C', CONTINUOUS: 'BC'}
+
+## aF status characters: busy, idle with an empty queue, idle with commands queued.
+# Queued commands wait for an R (after a crash part way through queueing a program, say), so N is idle too.
+STATUS_CODES = {ord('*'): 2, ord('Y'): 1, ord('N'): 1}
+
+COMMAND_TOKEN_RE = re.compile(r'([A-Z])(\d*)')
+
+
+class PumpProtocolError(serial.SerialException):
+    pass
+
+
+
+## Encoding.
+
+def encode(address, body, run=False, prefix=''):
+    ## Command bytes for body sent to address, with an R to start it if run.
+    return ('%s%s%s%s\r' % (prefix, address, body, 'R' if run else '')).encode('ascii')
+
+
+def moveBody(valve, move, steps, seconds_per_stroke, resolution, after=''):
+    '''
+    One plunger move: switch to valve I (input) or O (output), then move P
+    (aspirate steps), D (dispense steps) or M (to absolute step) at
+    seconds_per_stroke, with N resolution, then switch to the after valve.
+    '''
+    if valve not in 'IO' or after not in ('', 'I', 'O') or move not in 'PDM':
+        raise ValueError('Invalid move %s%s%s.' % (valve, move, after))
+    steps, seconds_per_stroke, resolution = int(steps), int(seconds_per_stroke), int(resolution)
+    if steps < 0 or seconds_per_stroke < 1 or resolution < 0:
+        raise ValueError('Move arguments must be positive, got %d steps at %d seconds per stroke.' % (steps, seconds_per_stroke))
+    return '%s%s%dS%dN%d%s' % (valve, move, steps, seconds_per_stroke, resolution, after)
+
+
+def aspirateBody(steps, seconds_per_stroke, after='O'):
+    # Draw steps through the input valve.
+    return moveBody('I', 'P', steps, seconds_per_stroke, 5, after)
+
+
+def emptyBody(seconds_per_stroke, after='O'):
+    # Empty the syringe through the output valve.
+    return moveBody('O', 'M', 0, seconds_per_stroke, 0, after)
+
+
+def syringeBody(syringe, body):
+    ## Applies a per-syringe command body to the syringes selected by the GUI syringe mode.
+    if syringe not in SYRINGES:
+        raise ValueError('Unknown syringe mode %s.' % (syringe))
+    return ''.join('%s%s' % (name, body) for name in SYRINGES[syringe])
+
+
+@functools.lru_cache(maxsize=256)
+def syringeCommand(syringe, body, address='a'):
+    # Strokes repeat with the same arguments, so the bytes are cached.
+    return encode(address, syringeBody(syringe, body), run=True)
+
+
+class CommandSet():
+    '''The fixed commands for one pump address, encoded once.'''
+
+    def __init__(self, address='a'):
+        self.address = address
+        self.autoAddress = encode(address, '', prefix='1')
+        self.status = encode(address, 'F')
+        self.halt = encode(address, 'K')
+        self.clear = encode(address, 'V')
+        self.initialise = encode(address, 'X', run=True)
+        self.firmware = encode(address, 'U')
+        self.configH = encode(address, 'H')
+        self.configJ = encode(address, 'J')
+        self.position = dict((name, encode(address, '%sYQP' % (name))) for name in 'BC')
+
+
+
+## Parsing.
+
+def commandTokens(command):
+    ## (letter, digits) of each token of a command after its address, digits '' if there are none.
+    return COMMAND_TOKEN_RE.findall(command[1:].decode('ascii'))
+
+
+def startsRun(command):
+    ## True if the command carries the R that starts the pump's queue.
+    return len(command) > 1 and command[-2] == ord('R') and command[-1] == _CR
+
+
+def _frame(frame, minimum, kind):
+    if len(frame) < minimum or frame[-1] != _CR:
+        raise PumpProtocolError('Malformed %s reply %r.' % (kind, frame))
+
+
+def isNak(ack):
+    ## True if the pump rejected the command, raising PumpProtocolError if the frame is neither an ack nor a nak.
+    _frame(ack, 2, 'ack')
+    if ack[0] == _ACK:
+        return False
+    elif ack[0] == _NAK:
+        return True
+    raise PumpProtocolError('Malformed ack %r.' % (ack))
+
+
+def matchesCommand(command, reply):
+    ## True if reply carries the address command was sent to.
+    # On a chain, the reply to 1x carries the last address assigned, from x on.
+    if not reply:
+        return False
+    if command[0] == ord('1'):
+        return command[1] <= reply[0] <= ord('z')
+    return reply[0] == command[0]
+
+
+def replyAddress(reply):
+    _frame(reply, 2, 'address')
+    return chr(reply[0])
+
+
+def parseStatus(reply):
+    ## Maps an aF reply to a pump status, None if the status character is unrecognised.
+    _frame(reply, 3, 'status')
+    return STATUS_CODES.get(reply[1])
+
+
+def parsePosition(reply):
+    ## Step position from a YQP reply, the address followed by the digits.
+    _frame(reply, 3, 'position')
+    digits = reply[1:-1]
+    if not digits.isdigit(): # int would also take signs, spaces and underscores.
+        raise PumpProtocolError('Malformed position reply %r.' % (reply))
+    return int(digits)
+
+
+def parseConfig(reply):
+    ## The configuration character of an H or J reply.
+    _frame(reply, 3, 'configuration')
+    return chr(reply[1])
+
+
+def parseData(reply):
+    ## The data of a reply, such as the firmware version, as text.
+    _frame(reply, 2, 'data')
+    return reply[1:-1].decode('ascii', 'replace')
@@ -0,0 +1,136 @@
+'''
+Command line client for the MicroLab 500 daemon (pumpd.py).
+
+Sends one JSON-RPC request to the daemon and prints the result as JSON. It
+only needs the standard library, so it starts in milliseconds:
+
+    python pumpctl.py status
+    python pumpctl.py pump 2000 --aspirate 6000 --dispense 6000 --wait
+    python pumpctl.py dispense --syringe A
+    python pumpctl.py recipe daily.json
+    python pumpctl.py resume --wait
+    python pumpctl.py stop
+
+--address selects the daemon: a Unix socket path (the default) or host:port.
+'''
+
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+
+
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'microlab.sock')
+
+
+class RPCError(Exception):
+
+    def __init__(self, code, message, data=None):
+        super(RPCError, self).__init__(message)
+        self.code = code
+        self.data = data
+
+
+def parseAddress(address):
+    ## (socket family, address) for a Unix socket path or a host:port pair.
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.sep not in address:
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+
+class PumpClient():
+    '''
+    Newline-delimited JSON-RPC 2.0 client for pumpd. One connection is kept
+    open, so several calls from a script share it.
+    '''
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        family, self.address = parseAddress(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(self.address)
+        self.stream = self.sock.makefile('rwb')
+        self.ids = 0
+
+    def call(self, method, **params):
+        self.ids += 1
+        request = {'jsonrpc': '2.0', 'id': self.ids, 'method': method, 'params': params}
+        self.stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.stream.flush()
+
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError('The daemon closed the connection.')
+        reply = json.loads(line)
+        if 'error' in reply:
+            error = reply['error']
+            raise RPCError(error['code'], error['message'], error.get('data'))
+        return reply['result']
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='Daemon socket path or host:port.')
+    commands = parser.add_subparsers(dest='method')
+    commands.required = True
+
+    commands.add_parser('status', help='Pump state, positions and the current job.')
+    commands.add_parser('initialise', help='Initialise the pump.')
+    commands.add_parser('stop', help='Halt the pump and clear its queue.')
+    commands.add_parser('wait', help='Wait for the current job to finish.')
+    commands.add_parser('resume', help='Pump the rest of a transfer interrupted by a crash.')
+
+    pump = commands.add_parser('pump', help='Transfer a volume.')
+    pump.add_argument('volume', type=float, help='ul.')
+    pump.add_argument('--syringe', default='A+B')
+    pump.add_argument('--aspirate', type=float, default=1000, help='ul/minute.')
+    pump.add_argument('--dispense', type=float, default=2500, help='ul/minute.')
+    pump.add_argument('--syringe-volume', type=float, default=500.0)
+
+    dispense = commands.add_parser('dispense', help='Dispense the syringes to waste.')
+    dispense.add_argument('--syringe', default='A+B')
+    dispense.add_argument('--dispense', type=float, default=2500, help='ul/minute.')
+    dispense.add_argument('--syringe-volume', type=float, default=500.0)
+
+    recipe = commands.add_parser('recipe', help='Run a recipe file (the path is read by the daemon).')
+    recipe.add_argument('path')
+
+    for command in (pump, dispense, recipe, commands.choices['initialise'], commands.choices['resume']):
+        command.add_argument('--wait', action='store_true', help='Return once the job has finished.')
+    args = parser.parse_args(argv)
+
+    params = dict((key, value) for key, value in vars(args).items() if key not in ('address', 'method', 'wait'))
+    if 'path' in params:
+        params['path'] = os.path.abspath(params['path'])
+    try:
+        with PumpClient(args.address) as client:
+            result = client.call(args.method, **params)
+            if getattr(args, 'wait', False):
+                result = client.call('wait')
+    except RPCError as e:
+        print('Error: %s' % (e), file=sys.stderr)
+        return 1
+    except OSError as e:
+        print('Unable to reach the daemon at %s: %s' % (args.address, e), file=sys.stderr)
+        return 1
+
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
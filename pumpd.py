@@ -0,0 +1,314 @@
+'''
+Headless MicroLab 500 daemon.
+
+Owns one backend.pumpObject and serves newline-delimited JSON-RPC 2.0 on a
+Unix socket (or host:port) so scripts and other hosts can drive the pump
+without a display. Methods:
+
+    status                                         pump state, positions, job
+    initialise
+    pump(volume, syringe, aspirate, dispense, syringe_volume)
+    dispense(syringe, dispense, syringe_volume)
+    recipe(path) or recipe(steps, name, syringe_volume)
+    resume                                         pumps the rest of an interrupted transfer
+    stop                                           halts the running job
+    wait                                           returns when the job ends
+
+initialise, pump, dispense and recipe start a job and return at once; only
+one job runs at a time. stop and status are answered while a job runs.
+
+    python pumpd.py --port /dev/ttyUSB0 [--address /tmp/microlab.sock]
+
+--metrics-port serves the pump's telemetry in the Prometheus text format over
+HTTP; --metrics-file rewrites it to a file, e.g. for node_exporter's textfile
+collector.
+
+pumpctl.py is the matching command line client.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+
+import backend
+import journal
+import telemetry
+from recipe import Recipe, RecipeRunner, RecipeError
+from pumpctl import DEFAULT_ADDRESS, parseAddress
+
+
+## JSON-RPC 2.0 error codes.
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+PUMP_ERROR = -32000
+PUMP_BUSY = -32001
+
+
+class ServiceError(Exception):
+
+    def __init__(self, code, message):
+        super(ServiceError, self).__init__(message)
+        self.code = code
+
+
+class PumpService():
+    '''
+    The RPC methods, around a connected pumpObject.
+
+    Long running methods start a job thread; its outcome is reported by
+    status and wait.
+    '''
+
+    def __init__(self, pump):
+        self.pump = pump
+        self.lock = threading.Lock()
+        self.job = None
+        self.jobName = None
+        self.jobStarted = None
+        self.jobError = None
+        self.jobResult = None
+
+
+    def methods(self):
+        return {
+            'status': self.status,
+            'initialise': self.initialise,
+            'pump': self.pumpVolume,
+            'dispense': self.dispense,
+            'recipe': self.recipe,
+            'resume': self.resume,
+            'stop': self.stop,
+            'wait': self.wait,
+        }
+
+
+    def startJob(self, name, fn, *args, **kwargs):
+        with self.lock:
+            if self.job is not None and self.job.is_alive():
+                raise ServiceError(PUMP_BUSY, 'The pump is busy with %s.' % (self.jobName))
+
+            def run():
+                try:
+                    self.jobResult = fn(*args, **kwargs)
+                except Exception as e:
+                    logging.exception('Job %s failed.' % (name))
+                    self.jobError = str(e)
+
+            self.jobName = name
+            self.jobStarted = time.time()
+            self.jobError = self.jobResult = None
+            self.job = threading.Thread(target=run, name='PumpJob', daemon=True)
+            self.job.start()
+        return {'job': name}
+
+
+    def checkSyringe(self, syringe, syringe_volume, *rates):
+        if syringe not in backend.SYRINGES:
+            raise ServiceError(INVALID_PARAMS, 'Unknown syringe mode %r.' % (syringe))
+        min_rate, max_rate = backend.rateLimits(syringe_volume)
+        for rate in rates:
+            if not backend.rateInRange(rate, syringe_volume):
+                raise ServiceError(INVALID_PARAMS, 'Rates must be between %d and %d ul/minute.' % (min_rate, max_rate))
+
+
+    def status(self):
+        state = self.pump.publishStatus() # Fresh, so live_positions is predicted for now.
+        return {
+            'connected': state.connection == 1,
+            'status': {0: 'uninitialised', 1: 'ready', 2: 'busy'}.get(state.status),
+            'direction': state.direction,
+            'flow_rate': state.flow_rate,
+            'pumped_volume': state.pumped_volume,
+            'total_volume': state.total_volume,
+            'time_estimated': state.time_estimated,
+            'positions': dict(state.positions),
+            'live_positions': dict(state.live_positions),
+            'interrupted': self.interrupted(),
+            'job': {
+                'name': self.jobName,
+                'running': self.job is not None and self.job.is_alive(),
+                'started': self.jobStarted,
+                'error': self.jobError,
+            },
+        }
+
+    def initialise(self):
+        return self.startJob('initialise', self.pump.initialise)
+
+    def pumpVolume(self, volume, syringe='A+B', aspirate=1000, dispense=2500, syringe_volume=500.0):
+        volume, aspirate, dispense, syringe_volume = float(volume), float(aspirate), float(dispense), float(syringe_volume)
+        self.checkSyringe(syringe, syringe_volume, aspirate, dispense)
+        if volume <= 0:
+            raise ServiceError(INVALID_PARAMS, 'Volume must be positive.')
+        return self.startJob('pump', self.pump.pumpCmd, syringe=syringe, volume=volume,
+            aspirate=aspirate, dispense=dispense, syringe_volume=syringe_volume)
+
+    def dispense(self, syringe='A+B', dispense=2500, syringe_volume=500.0):
+        dispense, syringe_volume = float(dispense), float(syringe_volume)
+        self.checkSyringe(syringe, syringe_volume, dispense)
+        return self.startJob('dispense', self.pump.dispensePump, syringe=syringe,
+            dispense=dispense, syringe_volume=syringe_volume)
+
+    def recipe(self, path=None, steps=None, name='', syringe_volume=500.0):
+        try:
+            recipe = Recipe.load(path) if path is not None else Recipe(steps or [], name, syringe_volume)
+            recipe.validate()
+        except (RecipeError, OSError, ValueError) as e:
+            raise ServiceError(INVALID_PARAMS, str(e))
+        runner = RecipeRunner(self.pump, recipe)
+        return self.startJob('recipe', lambda: [(step['name'], seconds) for step, seconds in runner.run()])
+
+    def interrupted(self):
+        pending = self.pump.pendingTransfer()
+        if pending is None:
+            return None
+        params, delivered = pending
+        return dict(params, delivered=delivered)
+
+    def resume(self):
+        if self.pump.pendingTransfer() is None:
+            raise ServiceError(INVALID_PARAMS, 'There is no interrupted transfer to resume.')
+        return self.startJob('resume', self.pump.resumeTransfer)
+
+    def stop(self):
+        self.pump.stopPump()
+        return self.status()
+
+    def wait(self):
+        job = self.job
+        if job is not None:
+            job.join()
+        return {'job': self.jobName, 'error': self.jobError, 'result': self.jobResult}
+
+
+
+class RPCHandler(socketserver.StreamRequestHandler):
+    ## One connection, any number of newline-delimited requests.
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = self.server.dispatch(line)
+            if reply is not None:
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+
+class RPCServerMixin():
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': PARSE_ERROR, 'message': 'Parse error.'}}
+
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': INVALID_REQUEST, 'message': 'Invalid request.'}}
+        requestId = request.get('id')
+        params = request.get('params') or {}
+
+        try:
+            method = self.service.methods().get(request['method'])
+            if method is None:
+                raise ServiceError(METHOD_NOT_FOUND, 'Unknown method %r.' % (request['method']))
+            try:
+                result = method(*params) if isinstance(params, list) else method(**params)
+            except TypeError as e:
+                raise ServiceError(INVALID_PARAMS, str(e))
+        except ServiceError as e:
+            reply = {'error': {'code': e.code, 'message': str(e)}}
+        except Exception as e:
+            logging.exception('RPC %s failed.' % (request['method']))
+            reply = {'error': {'code': PUMP_ERROR, 'message': str(e)}}
+        else:
+            reply = {'result': result}
+
+        if 'id' not in request:
+            return None # Notification.
+        reply.update(jsonrpc='2.0', id=requestId)
+        return reply
+
+
+class UnixRPCServer(RPCServerMixin, socketserver.ThreadingUnixStreamServer):
+    pass
+
+class TCPRPCServer(RPCServerMixin, socketserver.ThreadingTCPServer):
+    pass
+
+
+def makeServer(service, address=DEFAULT_ADDRESS):
+    family, address = parseAddress(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.unlink(address) # Left behind by a daemon that did not exit cleanly.
+        server = UnixRPCServer(address, RPCHandler)
+    else:
+        server = TCPRPCServer(address, RPCHandler)
+    server.service = service
+    return server
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', required=True, help='Serial port of the pump.')
+    parser.add_argument('--address', default=DEFAULT_ADDRESS, help='Unix socket path or host:port to listen on.')
+    parser.add_argument('--initialise', action='store_true', help='Initialise the pump on start up.')
+    parser.add_argument('--journal', default=journal.JOURNAL_FILE, help='Run journal, for resuming interrupted transfers.')
+    parser.add_argument('--timing-file', default=backend.TIMING_FILE, help='Calibrated timing models, from timing.py --calibrate.')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this HTTP port.')
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='Interface for --metrics-port.')
+    parser.add_argument('--metrics-file', help='Write Prometheus metrics to this file.')
+    parser.add_argument('--metrics-interval', type=float, default=15.0, help='Seconds between --metrics-file writes.')
+    args = parser.parse_args(argv)
+    backend.configureLogging()
+
+    pump = backend.pumpObject()
+    pump.journal = journal.Journal(args.journal)
+    pump.timingPath = args.timing_file
+    pump.connect(args.port)
+    if pump.__PUMP_CONNECTION__ != 1:
+        print('Unable to connect to %s.' % (args.port), file=sys.stderr)
+        return 1
+    if args.initialise:
+        pump.initialise()
+
+    metricsServer = metricsWriter = None
+    if args.metrics_port is not None:
+        metricsServer = telemetry.serveMetrics(pump.telemetry, args.metrics_port, args.metrics_host)
+        logging.info('Serving metrics on http://%s:%d/.' % (args.metrics_host, args.metrics_port))
+    if args.metrics_file:
+        metricsWriter = telemetry.writeMetrics(pump.telemetry, args.metrics_file, args.metrics_interval)
+
+    server = makeServer(PumpService(pump), args.address)
+    logging.info('Serving JSON-RPC on %s.' % (args.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if metricsServer is not None:
+            metricsServer.shutdown()
+        if metricsWriter is not None:
+            metricsWriter.set()
+        if server.address_family == socket.AF_UNIX:
+            os.unlink(args.address)
+        pump.disconnect()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
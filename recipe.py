@@ -0,0 +1,240 @@
+'''
+Recipe execution for the MicroLab 500.
+
+A recipe is a JSON (or YAML, if PyYAML is installed) file listing steps to
+run back to back on a backend.pumpObject:
+
+    {
+        "name": "Daily prime",
+        "syringe_volume": 500,
+        "steps": [
+            {"action": "initialise"},
+            {"name": "prime", "action": "transfer", "volume": 2, "units": "ml", "aspirate": 6000, "dispense": 6000},
+            {"action": "transfer", "syringe": "A", "volume": 750, "aspirate": 1000, "dispense": 2500},
+            {"action": "wait", "seconds": 30},
+            {"name": "to waste", "action": "dispense", "dispense": 5000}
+        ]
+    }
+
+Every step is validated before anything moves, and a dry run reports the
+predicted runtime of each step.
+
+    python recipe.py recipe.json --dry-run
+    python recipe.py recipe.json --port /dev/ttyUSB0
+'''
+
+import sys
+import json
+import time
+import logging
+import argparse
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import backend
+
+
+ACTIONS = ('initialise', 'transfer', 'dispense', 'wait')
+
+STEP_DEFAULTS = {
+    'syringe': 'A+B',
+    'units': 'ul',
+    'aspirate': 1000, # ul/minute.
+    'dispense': 2500, # ul/minute.
+}
+
+
+class RecipeError(ValueError):
+    pass
+
+
+class Recipe():
+
+    def __init__(self, steps, name='', syringe_volume=500.0):
+        self.name = name
+        self.syringe_volume = float(syringe_volume)
+        self.steps = []
+        for index, step in enumerate(steps):
+            if not isinstance(step, dict):
+                raise RecipeError('Step %d is not an object.' % (index + 1))
+            step = dict(STEP_DEFAULTS, **step)
+            step.setdefault('name', step.get('action', ''))
+            self.steps.append(step)
+
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fh:
+            if path.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise RecipeError('PyYAML is required to read %s.' % (path))
+                try:
+                    data = yaml.safe_load(fh)
+                except yaml.YAMLError as e:
+                    raise RecipeError('%s is not valid YAML: %s' % (path, e))
+            else:
+                data = json.load(fh)
+
+        if not isinstance(data, dict) or not isinstance(data.get('steps'), list):
+            raise RecipeError('%s does not contain a list of steps.' % (path))
+        return cls(data['steps'], data.get('name', path), data.get('syringe_volume', 500.0))
+
+
+    def volume(self, step):
+        # Step volume in ul.
+        return float(step['volume'])*(1000 if step['units'] == 'ml' else 1)
+
+
+    def validate(self):
+        ## Checks every step, raising a RecipeError listing all problems.
+        min_rate, max_rate = backend.rateLimits(self.syringe_volume)
+        problems = []
+        for index, step in enumerate(self.steps):
+            where = 'Step %d (%s)' % (index + 1, step['name'])
+            action = step.get('action')
+            if action not in ACTIONS:
+                problems.append('%s: unknown action %r.' % (where, action))
+                continue
+
+            try:
+                if action in ('transfer', 'dispense') and step['syringe'] not in backend.SYRINGES:
+                    problems.append('%s: unknown syringe mode %r.' % (where, step['syringe']))
+                if action == 'transfer':
+                    if step['units'] not in ('ul', 'ml'):
+                        problems.append('%s: volume units must be ul or ml.' % (where))
+                    elif self.volume(step) <= 0:
+                        problems.append('%s: volume must be positive.' % (where))
+                if action in ('transfer', 'dispense'):
+                    rates = ('aspirate', 'dispense') if action == 'transfer' else ('dispense',)
+                    for rate in rates:
+                        if not backend.rateInRange(float(step[rate]), self.syringe_volume):
+                            problems.append('%s: %s rate must be between %d and %d ul/minute.' % (
+                                where, rate, min_rate, max_rate))
+                if action == 'wait' and float(step['seconds']) < 0:
+                    problems.append('%s: wait must not be negative.' % (where))
+            except (KeyError, TypeError, ValueError) as e:
+                problems.append('%s: missing or invalid value %s.' % (where, e))
+
+        if problems:
+            raise RecipeError('\n'.join(problems))
+
+
+
+def dryRun(recipe, positions=None, stroke_steps=1000.0, timing=None):
+    ## Predicted seconds for each step, without touching the pump.
+    timing = timing or backend.NOMINAL_TIMING
+    recipe.validate()
+    positions = dict(positions or {'B': 0, 'C': 0})
+    estimates = []
+    for step in recipe.steps:
+        action = step['action']
+        if action == 'initialise':
+            seconds = timing.initialise_time
+            commands = [b'aXR\r']
+        elif action == 'wait':
+            seconds = float(step['seconds'])
+            commands = []
+        elif action == 'dispense':
+            travel = max(positions[name] for name in backend.SYRINGES[step['syringe']])
+            seconds = timing.strokeTime(travel, float(step['dispense']), recipe.syringe_volume, stroke_steps) + timing.command_latency
+            commands = [backend.dispenseCommand(step['syringe'], float(step['dispense']), recipe.syringe_volume)]
+        else:
+            if step['syringe'] == backend.CONTINUOUS:
+                program = backend.compileContinuousTransfer(recipe.volume(step), float(step['aspirate']), float(step['dispense']),
+                    recipe.syringe_volume, stroke_steps, positions, timing=timing)
+            else:
+                program = backend.compileTransfer(step['syringe'], recipe.volume(step), float(step['aspirate']), float(step['dispense']),
+                    recipe.syringe_volume, stroke_steps, positions, timing=timing)
+            seconds = program.duration
+            commands = program.commands
+
+        for command in commands:
+            backend.trackPositions(positions, command)
+        estimates.append((step, seconds))
+    return estimates
+
+
+
+class RecipeRunner():
+    '''
+    Runs a validated recipe on a connected pumpObject, one step straight
+    after another. A stopPump during the run ends it after the current step.
+    '''
+
+    def __init__(self, pump, recipe):
+        self.pump = pump
+        self.recipe = recipe
+        self.results = [] # (step, seconds taken)
+
+
+    def run(self):
+        self.recipe.validate()
+        stops = self.pump.stopRequests
+        stopped = lambda: self.pump.stopRequests != stops
+
+        for index, step in enumerate(self.recipe.steps):
+            if stopped():
+                logging.info('Recipe %s stopped.' % (self.recipe.name))
+                break
+
+            logging.info('Recipe %s step %d: %s.' % (self.recipe.name, index + 1, step['name']))
+            t0 = time.monotonic()
+            action = step['action']
+            if action == 'initialise':
+                self.pump.initialise()
+            elif action == 'wait':
+                self.pump.waitEngine.sleep(float(step['seconds']), stopped)
+            elif action == 'dispense':
+                self.pump.dispensePump(syringe=step['syringe'], dispense=float(step['dispense']),
+                    syringe_volume=self.recipe.syringe_volume)
+            else:
+                self.pump.pumpCmd(syringe=step['syringe'], volume=self.recipe.volume(step), aspirate=float(step['aspirate']),
+                    dispense=float(step['dispense']), syringe_volume=self.recipe.syringe_volume)
+            self.results.append((step, time.monotonic() - t0))
+
+        return self.results
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recipe', help='JSON or YAML recipe file.')
+    parser.add_argument('--dry-run', action='store_true', help='Validate and print the predicted runtime only.')
+    parser.add_argument('--port', help='Serial port of the pump.')
+    args = parser.parse_args(argv)
+
+    try:
+        recipe = Recipe.load(args.recipe)
+        estimates = dryRun(recipe, timing=backend.loadTimingModel(args.port) if args.port else None)
+    except (RecipeError, OSError, ValueError) as e: # Missing file, malformed JSON or YAML, invalid steps.
+        print(e)
+        return 1
+
+    for index, (step, seconds) in enumerate(estimates):
+        print('%3d  %-24s %8.1f s' % (index + 1, step['name'], seconds))
+    print('Total %.1f seconds.' % (sum(seconds for step, seconds in estimates)))
+    if args.dry_run:
+        return 0
+
+    if not args.port:
+        parser.error('--port is required unless --dry-run is given.')
+    backend.configureLogging()
+    pump = backend.pumpObject()
+    pump.timingPath = backend.TIMING_FILE
+    pump.connect(args.port)
+    if pump.__PUMP_CONNECTION__ != 1:
+        print('Unable to connect to %s.' % (args.port))
+        return 1
+    try:
+        for step, seconds in RecipeRunner(pump, recipe).run():
+            print('%-24s %8.1f s' % (step['name'], seconds))
+    finally:
+        pump.disconnect()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
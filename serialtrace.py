@@ -0,0 +1,277 @@
+'''
+Serial trace capture and replay for backend.pumpObject.
+
+Set pump.tracePath before connect to record every write to and read from
+the pump, with timestamps, in a compact binary trace. ReplaySerial plays a
+trace back in place of the port, at real time or speed times faster, so a
+session from the field (garbled acks, unusual N/* status sequences, slow
+firmware replies) can be reproduced on a dev box, and the control loops can
+be timed against a real instrument's behaviour:
+
+    pump.tracePath = 'rig3.trace'
+    pump.connect('/dev/ttyUSB0')
+    ...
+    pump = backend.pumpObject()
+    pump.connect(ReplaySerial('rig3.trace', speed=10))
+
+    python serialtrace.py rig3.trace
+
+Replies to a command are sent at the recorded offsets after it, divided by
+speed. Commands are matched against the recorded writes in order. A command
+repeated back to back (status polls) is answered from the recorded run of
+that command by time, so the pump looks busy for as long as it was busy in
+the recording even if the backend polls more or less often than it did.
+'''
+
+import sys
+import time
+import struct
+import logging
+import argparse
+import threading
+import collections
+
+import serial
+
+
+MAGIC = b'MLS1'
+
+## Event header: microseconds since the previous event, direction, data length.
+EVENT = struct.Struct('<IcH')
+WRITE = b'W'
+READ = b'R'
+
+MAX_DELTA = 0xffffffff # Gaps longer than about 71 minutes are shortened to this.
+
+
+TraceEvent = collections.namedtuple('TraceEvent', 'time direction data')
+
+
+class ReplayMismatch(serial.SerialException):
+    pass
+
+
+class TraceRecorder():
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'wb')
+        self.fh.write(MAGIC)
+        self.lock = threading.Lock()
+        self.last = time.monotonic()
+
+    def record(self, direction, data):
+        with self.lock:
+            if self.fh is None:
+                return
+            now = time.monotonic()
+            delta = min(int(round((now - self.last)*1e6)), MAX_DELTA)
+            self.last += delta/1e6
+            self.fh.write(EVENT.pack(delta, direction, len(data)) + data)
+            if direction == WRITE:
+                self.fh.flush() # The reply to the previous write is on disk before the next command.
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+
+
+def readTrace(path):
+    ## The TraceEvents in the trace at path, times in seconds from the start of the recording.
+    events = []
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a serial trace.' % (path))
+
+    offset, now = len(MAGIC), 0.0
+    while offset + EVENT.size <= len(data):
+        delta, direction, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        if offset + length > len(data):
+            break # Cut short while recording.
+        now += delta/1e6
+        events.append(TraceEvent(now, direction, data[offset:offset + length]))
+        offset += length
+    return events
+
+
+
+class TracingSerial():
+    '''
+    Wraps an open serial port, recording what goes through it. Everything
+    other than the recorded calls is passed straight to the port.
+    '''
+
+    def __init__(self, serialObject, recorder):
+        self.serialObject = serialObject
+        self.recorder = recorder
+
+    def write(self, data):
+        self.recorder.record(WRITE, bytes(data))
+        return self.serialObject.write(data)
+
+    def read(self, size=1):
+        data = self.serialObject.read(size)
+        if data:
+            self.recorder.record(READ, data)
+        return data
+
+    def readinto(self, buffer):
+        received = self.serialObject.readinto(buffer)
+        if received:
+            self.recorder.record(READ, bytes(buffer[:received]))
+        return received
+
+    def close(self):
+        self.serialObject.close()
+        self.recorder.close()
+
+    def __getattr__(self, name):
+        return getattr(self.serialObject, name)
+
+
+
+class ReplaySerial():
+    '''
+    A serial-like transport that answers from a recorded trace.
+
+    A command with no recorded match raises ReplayMismatch if strict, or is
+    left unanswered so the backend times out. timeout is the read timeout in
+    seconds, like serial.Serial's.
+    '''
+
+    def __init__(self, trace, speed=1.0, strict=True, timeout=10):
+        self.events = readTrace(trace) if isinstance(trace, str) else list(trace)
+        self.name = 'replay:%s' % (trace if isinstance(trace, str) else 'trace')
+        self.speed = float(speed)
+        self.strict = strict
+        self.timeout = timeout
+        self.is_open = True
+
+        self.condition = threading.Condition()
+        self.pending = collections.deque() # (monotonic time due, bytes) of replies on their way.
+        self.last = None # Index of the last recorded write matched.
+        self.lastData = None
+        self.anchor = None # (recorded time, monotonic time) the replay clock is aligned on.
+        self.writes = self.mismatches = 0
+
+
+    def traceTime(self):
+        # The point in the recording the replay has reached.
+        recorded, real = self.anchor
+        return recorded + (time.monotonic() - real)*self.speed
+
+    def find(self, data, start):
+        for index in range(start, len(self.events)):
+            if self.events[index].direction == WRITE and self.events[index].data == data:
+                return index
+        return None
+
+    def run(self, start):
+        # start and the recorded writes of the same command straight after it.
+        run = [start]
+        for index in range(start + 1, len(self.events)):
+            event = self.events[index]
+            if event.direction == WRITE:
+                if event.data != self.events[start].data:
+                    break
+                run.append(index)
+        return run
+
+
+    def write(self, data):
+        data = bytes(data)
+        self.writes += 1
+        with self.condition:
+            if data == self.lastData:
+                start = self.last # A repeated command is answered from the same recorded run.
+            else:
+                start = self.find(data, 0 if self.last is None else self.last + 1)
+                if start is None:
+                    self.mismatches += 1
+                    if self.strict:
+                        raise ReplayMismatch('%r was not sent at this point in the recording.' % (data))
+                    logging.info('Replay: no recorded match for %r, leaving it unanswered.' % (data))
+                    return len(data)
+
+            run = self.run(start)
+            if self.anchor is None or (len(run) == 1 and data != self.lastData):
+                self.anchor = (self.events[start].time, time.monotonic()) # A new command realigns the clock.
+            now = self.traceTime()
+            chosen = max([index for index in run if self.events[index].time <= now] or [run[0]])
+            self.last, self.lastData = chosen, data
+
+            sent = time.monotonic()
+            for event in self.events[chosen + 1:]:
+                if event.direction == WRITE:
+                    break
+                self.pending.append((sent + (event.time - self.events[chosen].time)/self.speed, event.data))
+            self.condition.notify_all()
+        return len(data)
+
+
+    def _due(self):
+        # Call with the condition held.
+        now = time.monotonic()
+        return sum(len(data) for due, data in self.pending if due <= now)
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            return self._due()
+
+    def readinto(self, buffer):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.condition:
+            while not self._due():
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    return 0
+                waits = [self.pending[0][0] - now] if self.pending else []
+                if deadline is not None:
+                    waits.append(deadline - now)
+                self.condition.wait(min(waits) if waits else None)
+
+            received = 0
+            view = memoryview(buffer)
+            while self.pending and self.pending[0][0] <= time.monotonic() and received < len(view):
+                due, data = self.pending.popleft()
+                taken = data[:len(view) - received]
+                view[received:received + len(taken)] = taken
+                received += len(taken)
+                if len(taken) < len(data):
+                    self.pending.appendleft((due, data[len(taken):]))
+            return received
+
+    def read(self, size=1):
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def reset_input_buffer(self):
+        with self.condition:
+            now = time.monotonic()
+            while self.pending and self.pending[0][0] <= now:
+                self.pending.popleft()
+
+    def close(self):
+        self.is_open = False
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', help='Trace file to print.')
+    args = parser.parse_args(argv)
+
+    previous = 0.0
+    for event in readTrace(args.trace):
+        print('%10.4f %+8.4f %s %r' % (event.time, event.time - previous, event.direction.decode('ascii'), event.data))
+        previous = event.time
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+'''
+Bounded status history for live plotting.
+
+StatusHistory keeps the last capacity samples of the pump state in a fixed
+NumPy ring buffer, so memory use does not grow over an overnight run. Feed
+it backend.PumpStatus snapshots (it can be added to
+pumpObject.statusListeners directly) and, while the pump is busy, a sample
+every second or so, so stalls show as flat lines. Plunger positions are
+taken from PumpStatus.live_positions. series downsamples the
+whole buffer to a fixed number of points for display:
+
+    history = StatusHistory()
+    pump.statusListeners.append(history.append)
+    data = history.series(points=600)
+    data['time'], data['delivered'], data['flow'], data['delivery_rate'], data['position_b']
+'''
+
+import time
+import threading
+
+import numpy as np
+
+
+FIELDS = ('time', 'delivered', 'flow', 'position_b', 'position_c')
+TIME, DELIVERED, FLOW, POSITION_B, POSITION_C = range(len(FIELDS))
+
+
+class StatusHistory():
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.data = np.full((capacity, len(FIELDS)), np.nan)
+        self.count = 0 # Samples ever added, the newest is at (count - 1) % capacity.
+        self.lock = threading.Lock()
+
+        # Delivered volume is kept cumulative across transfers.
+        self.transfer = None # time_start of the transfer being followed.
+        self.previous = 0.0 # ul delivered by the transfers before it.
+        self.pumped = 0.0
+
+
+    def append(self, status, now=None):
+        ## Adds a sample from a backend.PumpStatus, at now (time.monotonic seconds) or the current time.
+        now = time.monotonic() if now is None else now
+        positions = dict(status.live_positions) # Where the plungers are predicted to be, not where the queue ends.
+        with self.lock:
+            if status.time_start != self.transfer:
+                self.previous += self.pumped
+                self.transfer, self.pumped = status.time_start, 0.0
+            self.pumped = status.pumped_volume
+
+            row = self.data[self.count % self.capacity]
+            row[TIME] = now
+            row[DELIVERED] = self.previous + self.pumped
+            row[FLOW] = status.flow_rate if status.status == 2 else 0.0
+            row[POSITION_B] = np.nan if positions.get('B') is None else positions['B']
+            row[POSITION_C] = np.nan if positions.get('C') is None else positions['C']
+            self.count += 1
+
+
+    def samples(self):
+        ## Copy of the buffered samples, oldest first.
+        with self.lock:
+            if self.count <= self.capacity:
+                return self.data[:self.count].copy()
+            start = self.count % self.capacity
+            return np.concatenate((self.data[start:], self.data[:start]))
+
+
+    def series(self, points=600, window=None):
+        '''
+        Columns of the last window seconds (everything if None), reduced to
+        at most points samples by time bucket: the last delivered volume and
+        positions of each bucket, its highest set flow rate, and the measured
+        delivery rate over it in ul/minute.
+        '''
+        data = self.samples()
+        if window is not None and len(data):
+            data = data[data[:, TIME] >= data[-1, TIME] - window]
+        if len(data) > points:
+            edges = np.linspace(data[0, TIME], data[-1, TIME], points + 1)[:-1]
+            starts = np.unique(np.searchsorted(data[:, TIME], edges))
+            ends = np.append(starts[1:], len(data)) - 1
+            flow = np.maximum.reduceat(data[:, FLOW], starts)
+            data = data[ends]
+            data[:, FLOW] = flow
+
+        columns = dict((name, data[:, index]) for index, name in enumerate(FIELDS))
+        rate = np.zeros(len(data))
+        if len(data) > 1:
+            elapsed = np.diff(data[:, TIME])
+            rate[1:] = np.where(elapsed > 0, np.diff(data[:, DELIVERED])*60/np.where(elapsed > 0, elapsed, 1), 0)
+        columns['delivery_rate'] = rate
+        return columns
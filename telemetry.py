@@ -0,0 +1,260 @@
+'''
+Serial and transfer telemetry for backend.pumpObject.
+
+Every exchange on the serial port is counted by command kind with its bytes,
+round-trip latency, NAKs and errors. Status polling loops and whole transfers
+are also recorded, so polls per stroke, serial utilisation and host overhead
+per transfer can be read off a running rig. The counters are exported as
+Prometheus text, either written to a file or served over HTTP:
+
+    server = telemetry.serveMetrics(pump.telemetry, port=9105)
+    pump.telemetry.write('/var/lib/node_exporter/microlab.prom')
+    stop = telemetry.writeMetrics(pump.telemetry, 'microlab.prom', interval=15.0)
+
+pumpd.py exposes both with --metrics-port and --metrics-file.
+'''
+
+import os
+import time
+import bisect
+import functools
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from protocol import isNak
+
+
+## Histogram bucket upper bounds, seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OVERHEAD_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STOP_BUCKETS = (0.025, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0)
+
+
+@functools.lru_cache(maxsize=256)
+def commandKind(command):
+    ## Classifies a raw command such as b'aF\r' for labelling.
+    # Status and position polls repeat the same bytes, so they are classified once.
+    body = command[1:].rstrip(b'\r')
+    if command[:1] == b'1':
+        return 'address'
+    elif body == b'F':
+        return 'status'
+    elif body.endswith(b'YQP'):
+        return 'position'
+    elif body == b'K':
+        return 'halt'
+    elif body == b'V':
+        return 'clear'
+    elif body in (b'U', b'H', b'J'):
+        return 'info'
+    elif body.startswith(b'X'):
+        return 'initialise'
+    return 'motion'
+
+
+class Histogram():
+    '''Cumulative bucket counts, sum and count of observations, per label.'''
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = {} # label: per-bucket counts, the last one is +Inf.
+        self.sums = Counter()
+
+    def observe(self, value, label=''):
+        counts = self.counts.get(label)
+        if counts is None:
+            counts = self.counts[label] = [0]*(len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[label] += value
+
+    def count(self, label=''):
+        return sum(self.counts.get(label, ()))
+
+
+class Telemetry():
+    '''
+    Low-overhead counters and histograms fed by a pumpObject.
+
+    Commands are recorded from the serial I/O thread, waits and transfers
+    from the caller's thread; a lock keeps exports consistent.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self.lock:
+            self.started = self.clock()
+            self.commands = Counter()
+            self.errors = Counter()
+            self.naks = Counter()
+            self.bytes_sent = Counter()
+            self.bytes_received = Counter()
+            self.round_trip = Histogram(LATENCY_BUCKETS)
+            self.serial_busy = 0.0 # seconds spent in exchanges.
+
+            self.waits = 0
+            self.wait_time = 0.0 # seconds spent waiting for the pump to go idle.
+            self.wait_polls = 0
+
+            self.transfers = 0
+            self.transfer_strokes = 0
+            self.transfer_polls = 0
+            self.transfer_overhead = Histogram(OVERHEAD_BUCKETS)
+            self.last_transfer = {}
+
+            self.stops = Histogram(STOP_BUCKETS)
+
+
+    def recordCommand(self, command, ack, response, seconds, error=None):
+        kind = commandKind(command)
+        with self.lock:
+            self.commands[kind] += 1
+            self.bytes_sent[kind] += len(command)
+            self.bytes_received[kind] += len(ack or b'') + len(response or b'')
+            self.round_trip.observe(seconds, kind)
+            self.serial_busy += seconds
+            if error is not None:
+                self.errors[kind] += 1
+            elif isNak(ack):
+                self.naks[kind] += 1
+
+    def recordWait(self, seconds, polls):
+        with self.lock:
+            self.waits += 1
+            self.wait_time += seconds
+            self.wait_polls += polls
+
+    def recordTransfer(self, strokes, wall, motion, polls):
+        ## One completed transfer: wall clock seconds against the predicted motion seconds.
+        overhead = max(wall - motion, 0.0)
+        with self.lock:
+            self.transfers += 1
+            self.transfer_strokes += strokes
+            self.transfer_polls += polls
+            self.transfer_overhead.observe(overhead)
+            self.last_transfer = {'strokes': strokes, 'wall': wall, 'motion': motion, 'overhead': overhead, 'polls': polls}
+
+
+    def recordStop(self, seconds):
+        ## Seconds from a stop request to the pump confirmed idle.
+        with self.lock:
+            self.stops.observe(seconds)
+
+
+    def snapshot(self):
+        ## Derived figures as a dict.
+        with self.lock:
+            uptime = max(self.clock() - self.started, 1e-9)
+            return {
+                'uptime_s': uptime,
+                'commands': dict(self.commands),
+                'serial_utilisation': self.serial_busy/uptime,
+                'polls_per_stroke': self.transfer_polls/float(self.transfer_strokes) if self.transfer_strokes else 0.0,
+                'overhead_s_per_transfer': self.transfer_overhead.sums['']/self.transfers if self.transfers else 0.0,
+                'wait_s': self.wait_time,
+                'last_transfer': dict(self.last_transfer),
+                'stops': self.stops.count(),
+            }
+
+
+    def prometheus(self, prefix='microlab'):
+        ## Prometheus text exposition format.
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+            for labels, value in samples:
+                labels = ','.join('%s="%s"' % item for item in labels)
+                lines.append('%s_%s%s %r' % (prefix, name, '{%s}' % (labels) if labels else '', value))
+
+        def histogram(name, help, hist, label_name=None):
+            samples = []
+            for label, counts in sorted(hist.counts.items()):
+                labels = ((label_name, label),) if label_name else ()
+                running = 0
+                for bound, count in zip(hist.buckets + ('+Inf',), counts):
+                    running += count
+                    samples.append((labels + (('le', bound),), running))
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for labels, value in samples:
+                lines.append('%s_%s_bucket{%s} %d' % (prefix, name, ','.join('%s="%s"' % item for item in labels), value))
+            for label in sorted(hist.counts):
+                labels = '{%s="%s"}' % (label_name, label) if label_name else ''
+                lines.append('%s_%s_sum%s %r' % (prefix, name, labels, hist.sums[label]))
+                lines.append('%s_%s_count%s %d' % (prefix, name, labels, hist.count(label)))
+
+        snapshot = self.snapshot()
+        with self.lock:
+            by_kind = lambda counter: [((('kind', kind),), value) for kind, value in sorted(counter.items())]
+            metric('serial_commands_total', 'counter', 'Commands exchanged with the pump.', by_kind(self.commands))
+            metric('serial_errors_total', 'counter', 'Exchanges that timed out or failed.', by_kind(self.errors))
+            metric('serial_naks_total', 'counter', 'Commands the pump rejected.', by_kind(self.naks))
+            metric('serial_bytes_sent_total', 'counter', 'Bytes written to the pump.', by_kind(self.bytes_sent))
+            metric('serial_bytes_received_total', 'counter', 'Bytes read from the pump.', by_kind(self.bytes_received))
+            histogram('serial_round_trip_seconds', 'Command round-trip latency.', self.round_trip, 'kind')
+            metric('serial_busy_seconds_total', 'counter', 'Time the serial port spent in exchanges.', [((), self.serial_busy)])
+            metric('serial_utilisation', 'gauge', 'Fraction of uptime the serial port was busy.', [((), snapshot['serial_utilisation'])])
+
+            metric('wait_seconds_total', 'counter', 'Time spent waiting for the pump to go idle.', [((), self.wait_time)])
+            metric('wait_polls_total', 'counter', 'Status polls issued while waiting.', [((), self.wait_polls)])
+
+            metric('transfers_total', 'counter', 'Completed transfers.', [((), self.transfers)])
+            metric('transfer_strokes_total', 'counter', 'Strokes of completed transfers.', [((), self.transfer_strokes)])
+            metric('transfer_polls_total', 'counter', 'Status polls during completed transfers.', [((), self.transfer_polls)])
+            metric('polls_per_stroke', 'gauge', 'Status polls per stroke over completed transfers.', [((), snapshot['polls_per_stroke'])])
+            histogram('transfer_overhead_seconds', 'Transfer wall time not spent moving.', self.transfer_overhead)
+            histogram('stop_seconds', 'Time from a stop request to the pump confirmed idle.', self.stops)
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, path):
+        # Replace the file in one rename so a scraper never reads half of it.
+        with open(path + '.tmp', 'w') as fh:
+            fh.write(self.prometheus())
+        os.replace(path + '.tmp', path)
+
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.telemetry.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Keep scrapes out of the pump log.
+
+
+def serveMetrics(telemetry, port=9105, host='127.0.0.1'):
+    ## Serves the metrics on http://host:port/ from a daemon thread, call .shutdown() on the result to stop.
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.telemetry = telemetry
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    return server
+
+
+def writeMetrics(telemetry, path, interval=15.0):
+    ## Rewrites the metrics file every interval seconds from a daemon thread, set the returned Event to stop.
+    # A last write on stop keeps the final counters.
+    stop = threading.Event()
+    def run():
+        while True:
+            stopping = stop.wait(interval)
+            try:
+                telemetry.write(path)
+            except OSError:
+                pass
+            if stopping:
+                return
+    threading.Thread(target=run, name='MetricsWriter', daemon=True).start()
+    return stop
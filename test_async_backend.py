@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+import emulator
+from async_backend import AsyncPumpObject
+from protocol import PumpProtocolError
+
+
+def test_query_recovers_from_stray_frames():
+    async def run(port):
+        pump = AsyncPumpObject()
+        await pump.connect(port)
+        try:
+            # A late reply left over from an earlier exchange is dropped before the next command.
+            pump.port.frames.put_nowait(b'\x06\r')
+            pump.port.frames.put_nowait(b'a1000\r')
+            pump.port.buffer += b'a'
+            ack, response = await pump.query(pump.commandSet.position['B'])
+            assert response == b'a0\r'
+
+            # A reply out of step with its command resets the port, the next exchange pairs up again.
+            original = pump.port.read_frame
+            async def shifted(timeout=10):
+                pump.port.read_frame = original
+                return b'\x06\r'
+            pump.port.read_frame = shifted
+            with pytest.raises(PumpProtocolError):
+                await pump.query(pump.commandSet.position['C'])
+            await asyncio.sleep(0.1) # The real ack and reply arrive late.
+            assert await pump.status() == 1
+            ack, response = await pump.query(pump.commandSet.position['C'])
+            assert response == b'a0\r'
+        finally:
+            await pump.disconnect()
+
+    with emulator.PtyPumpEmulator() as pty:
+        asyncio.run(run(pty.port))
@@ -0,0 +1,90 @@
+import time
+import threading
+
+import pytest
+
+import backend
+import emulator
+from protocol import startsRun
+
+
+def test_stop_while_queueing(monkeypatch):
+    # A stop that arrives after the R-less chunks were accepted must keep the chunk carrying the R off the wire.
+    pump = emulator.PumpEmulator(speedup=50.0, init_time=0.1)
+    received = []
+    handle = pump.handle
+    monkeypatch.setattr(pump, 'handle', lambda command: received.append(command) or handle(command))
+
+    with emulator.PtyPumpEmulator(pump) as pty:
+        pumpObject = backend.pumpObject()
+        pumpObject.connect(pty.port)
+        pumpObject.initialise()
+
+        program = pumpObject.compileTransfer(volume=20000)
+        assert len(program.commands) > 1
+        submit = pumpObject.submit
+        def stopFirst(command, *args):
+            if command == program.commands[-1]:
+                pumpObject.stopPump()
+            return submit(command, *args)
+        monkeypatch.setattr(pumpObject, 'submit', stopFirst)
+
+        del received[:]
+        motion = pump.motion_time
+        assert not pumpObject.pumpCmdCompiled(program)
+        pumpObject.disconnect()
+
+    assert received
+    assert not any(startsRun(command) for command in received)
+    assert pump.motion_time == motion
+
+
+def test_program_positions():
+    # The first stroke dumps the 600 steps already drawn, the second dumps the first before drawing 200 steps.
+    program = backend.compileTransfer('A+B', volume=600, syringe_volume=500.0, positions={'B': 600, 'C': 0})
+    assert program.start == {'B': 600, 'C': 0}
+    assert program.positions == [{'B': 0, 'C': 0}, {'B': 1000, 'C': 1000}, {'B': 0, 'C': 0}, {'B': 200, 'C': 200}]
+
+    # Continuous: the syringes take turns filling and emptying.
+    program = backend.compileContinuousTransfer(volume=1000, syringe_volume=500.0)
+    assert program.positions == [{'B': 1000, 'C': 0}, {'B': 0, 'C': 1000}, {'B': 0, 'C': 0}]
+
+
+def test_predict_positions():
+    segments = [(2.0, {'B': 1000, 'C': 1000}), (1.0, {'B': 0, 'C': 1000})]
+    start = {'B': 0, 'C': 0}
+    assert backend.predictPositions(start, segments, 0.0) == start
+    assert backend.predictPositions(start, segments, 1.0) == {'B': 500, 'C': 500}
+    assert backend.predictPositions(start, segments, 2.5) == {'B': 500, 'C': 1000}
+    assert backend.predictPositions(start, segments, 10.0) == {'B': 0, 'C': 1000}
+    assert backend.predictPositions({'B': None, 'C': 0}, segments, 1.0) == {'B': None, 'C': 500}
+
+
+@pytest.mark.parametrize('compiled', [True, False])
+def test_live_positions_follow_the_transfer(compiled):
+    # The model jumps to the end of each queued move once it is acked, the live positions move with the plungers.
+    with emulator.PtyPumpEmulator(emulator.PumpEmulator(speedup=10.0, init_time=0.1)) as pty:
+        pump = backend.pumpObject()
+        pump.waitEngine.scale = 0.1
+        pump.connect(pty.port)
+        pump.initialise()
+
+        transfer = threading.Thread(target=pump.pumpCmd, args=('A', 500), kwargs={'aspirate': 3000, 'compiled': compiled})
+        transfer.start()
+        time.sleep(0.6) # Half way through the 1 s stroke.
+        positions, live = dict(pump.positions), pump.livePositions()
+        transfer.join()
+        final = pump.publishStatus()
+        pump.disconnect()
+
+    assert positions['B'] == 1000
+    assert 200 < live['B'] < 800
+    assert dict(final.positions) == dict(final.live_positions) == {'B': 1000, 'C': 0}
+
+
+@pytest.mark.parametrize('volume', [0, -500])
+def test_non_positive_volume(volume):
+    pump = backend.pumpObject()
+    with pytest.raises(ValueError):
+        pump.pumpCmd('A+B', volume)
+    assert not pump.transferRunning
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+import backend
+import journal
+
+
+PARAMS = {'address': 'a', 'syringe': 'A+B', 'volume': 1500, 'aspirate': 6000, 'dispense': 6000,
+    'syringe_volume': 500.0, 'stroke_steps': 1000.0, 'compiled': True}
+
+## One full stroke of both syringes per command; the first two started, the last still waiting for an R.
+STROKES = [b'aBIP1000S5N5OCIP1000S5N5OR\r', b'aBOM0S5N0OIP1000S5N5OCOM0S5N0OIP1000S5N5OR\r',
+    b'aBOM0S5N0OIP1000S5N5OCOM0S5N0OIP1000S5N5O\r']
+
+
+def interrupted(path):
+    # A journal as left by a crash part way through a compiled transfer.
+    log = journal.Journal(path)
+    log.transfer(PARAMS)
+    log.positions({'B': 0, 'C': 0})
+    for command in STROKES:
+        log.command(command)
+    log.close()
+
+
+def test_pending_transfer(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    interrupted(path)
+    pending = journal.pendingTransfer(journal.readJournal(path))
+    assert pending.params == PARAMS
+    assert pending.commands == STROKES
+    assert pending.positions == {'B': 0, 'C': 0}
+
+    log = journal.Journal(path)
+    log.end('done')
+    assert log.pending() is None
+    log.close()
+
+
+def test_ran_volume():
+    # Commands after the last R never ran.
+    assert backend.ranVolume(STROKES, 'A+B') == 1000.0
+    assert backend.ranVolume(STROKES[:1], 'A+B') == 500.0
+    assert backend.ranVolume(STROKES[2:], 'A+B') == 0.0
+    assert backend.ranVolume([b'aBIP400S5N5OR\r'], 'A') == 200.0
+    # In continuous mode the syringes take turns.
+    assert backend.ranVolume([b'aBIP1000S5N5\r', b'aBOM0S5N0CIP1000S5N5R\r'], backend.CONTINUOUS) == 1000.0
+
+
+def test_torn_tail(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    interrupted(path)
+    records, end = journal.scanRecords(path)
+
+    # Cut the last command record short, as a crash part way through the write would.
+    with open(path, 'r+b') as fh:
+        fh.truncate(end - 5)
+    records = journal.readJournal(path)
+    assert [record.data for record in records if record.kind == journal.COMMAND] == STROKES[:2]
+    assert backend.ranVolume(journal.pendingTransfer(records).commands, 'A+B') == 1000.0
+
+    # Opening the journal drops the torn record, so new records follow the intact ones.
+    log = journal.Journal(path)
+    log.progress(1000.0, 1500.0)
+    log.close()
+    pending = journal.pendingTransfer(journal.readJournal(path))
+    assert pending.commands == STROKES[:2]
+    assert pending.pumped == 1000.0
+
+
+def test_corrupt_record(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    interrupted(path)
+    records, end = journal.scanRecords(path)
+
+    # Flip a byte of the last record's payload, its CRC no longer matches.
+    with open(path, 'r+b') as fh:
+        fh.seek(end - 3)
+        byte = fh.read(1)
+        fh.seek(end - 3)
+        fh.write(bytes([byte[0] ^ 0xff]))
+    records, intact = journal.scanRecords(path)
+    assert intact == end - journal.HEADER.size - len(STROKES[-1])
+    assert journal.pendingTransfer(records).commands == STROKES[:2]
+
+
+def test_not_a_journal(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    with open(path, 'wb') as fh:
+        fh.write(b'something else')
+    with pytest.raises(ValueError):
+        journal.readJournal(path)
+
+
+def test_rotation(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    log = journal.Journal(path, max_bytes=100)
+    log.transfer(PARAMS)
+    log.command(STROKES[0])
+    log.end('done')
+
+    # The finished journal is kept as path.1 and a new one started.
+    assert journal.readJournal(path) == []
+    assert [record.kind for record in journal.readJournal(path + '.1')] == [journal.TRANSFER, journal.COMMAND, journal.END]
+    log.transfer(PARAMS)
+    log.close()
+    assert journal.pendingTransfer(journal.readJournal(path)).params == PARAMS
+    assert os.path.getsize(path + '.1') > 100
+
+
+def test_pump_pending_transfer(tmp_path):
+    path = str(tmp_path / 'journal.bin')
+    interrupted(path)
+    pump = backend.pumpObject()
+    pump.journal = journal.Journal(path)
+    params, delivered = pump.pendingTransfer()
+    assert params == PARAMS
+    assert delivered == 1000.0
+
+    # Another pump's transfer is not this pump's to resume.
+    other = backend.pumpObject('b')
+    other.journal = pump.journal
+    assert other.pendingTransfer() is None
+    pump.abandonTransfer()
+    assert pump.pendingTransfer() is None
+    pump.journal.close()
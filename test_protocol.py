@@ -0,0 +1,115 @@
+import pytest
+
+import protocol
+from protocol import PumpProtocolError
+
+
+## Encoding.
+
+def test_encode():
+    assert protocol.encode('a', 'F') == b'aF\r'
+    assert protocol.encode('b', 'X', run=True) == b'bXR\r'
+    assert protocol.encode('a', '', prefix='1') == b'1a\r'
+
+
+def test_move_bodies():
+    assert protocol.aspirateBody(800, 5) == 'IP800S5N5O'
+    assert protocol.aspirateBody(800, 5, after='') == 'IP800S5N5'
+    assert protocol.emptyBody(30) == 'OM0S30N0O'
+    assert protocol.emptyBody(30, after='') == 'OM0S30N0'
+    assert protocol.moveBody('O', 'D', 120, 10, 0) == 'OD120S10N0'
+
+
+@pytest.mark.parametrize('args', [
+    ('X', 'P', 100, 5, 5), # Unknown valve.
+    ('I', 'Q', 100, 5, 5), # Unknown move.
+    ('I', 'P', -1, 5, 5),
+    ('I', 'P', 100, 0, 5),
+])
+def test_move_body_rejects(args):
+    with pytest.raises(ValueError):
+        protocol.moveBody(*args)
+
+
+def test_syringe_command():
+    body = protocol.aspirateBody(800, 5)
+    assert protocol.syringeCommand('A+B', body) == b'aBIP800S5N5OCIP800S5N5OR\r'
+    assert protocol.syringeCommand('A', body) == b'aBIP800S5N5OR\r'
+    assert protocol.syringeCommand('B', body, 'c') == b'cCIP800S5N5OR\r'
+    assert protocol.syringeCommand(protocol.CONTINUOUS, body) == b'aBIP800S5N5OCIP800S5N5OR\r'
+    with pytest.raises(ValueError):
+        protocol.syringeCommand('C', body)
+
+
+def test_command_set():
+    commands = protocol.CommandSet('b')
+    assert commands.autoAddress == b'1b\r'
+    assert commands.status == b'bF\r'
+    assert (commands.halt, commands.clear) == (b'bK\r', b'bV\r')
+    assert commands.initialise == b'bXR\r'
+    assert commands.position == {'B': b'bBYQP\r', 'C': b'bCYQP\r'}
+
+
+def test_command_tokens():
+    assert protocol.commandTokens(b'aBIP800S5N5OR\r') == [('B', ''), ('I', ''), ('P', '800'), ('S', '5'), ('N', '5'),
+        ('O', ''), ('R', '')]
+    assert protocol.startsRun(b'aBIP800S5N5OR\r')
+    assert not protocol.startsRun(b'aBIP800S5N5O\r')
+
+
+
+## Parsing.
+
+def test_is_nak():
+    assert protocol.isNak(b'\x15\r')
+    assert not protocol.isNak(b'\x06\r')
+
+
+@pytest.mark.parametrize('frame', [b'', b'\r', b'\x06', b'Z\r'])
+def test_is_nak_malformed(frame):
+    with pytest.raises(PumpProtocolError):
+        protocol.isNak(frame)
+
+
+def test_matches_command():
+    assert protocol.matchesCommand(b'aF\r', b'aY\r')
+    assert not protocol.matchesCommand(b'aF\r', b'bY\r')
+    assert not protocol.matchesCommand(b'aF\r', b'')
+    # On a chain, 1x is answered with the last address assigned, from x on.
+    assert protocol.matchesCommand(b'1a\r', b'c\r')
+    assert protocol.matchesCommand(b'1b\r', b'b\r')
+    assert not protocol.matchesCommand(b'1b\r', b'a\r')
+
+
+def test_parse_status():
+    assert protocol.parseStatus(b'a*\r') == 2 # Busy.
+    assert protocol.parseStatus(b'aY\r') == 1 # Idle.
+    assert protocol.parseStatus(b'aN\r') == 1 # Idle, commands queued without an R.
+    assert protocol.parseStatus(b'aQ\r') is None
+
+
+def test_parse_position():
+    assert protocol.parsePosition(b'a0\r') == 0
+    assert protocol.parsePosition(b'b1000\r') == 1000
+
+
+def test_parse_config_and_data():
+    assert protocol.parseConfig(b'a1\r') == '1'
+    assert protocol.parseData(b'aML500 V1.10\r') == 'ML500 V1.10'
+    assert protocol.replyAddress(b'c\r') == 'c'
+
+
+@pytest.mark.parametrize('parser, frame', [
+    (protocol.parseStatus, b'a\r'), # No status character.
+    (protocol.parseStatus, b'aY'), # No CR, cut short.
+    (protocol.parsePosition, b'a\r'),
+    (protocol.parsePosition, b'a12x\r'),
+    (protocol.parsePosition, b'a-12\r'),
+    (protocol.parsePosition, b'a 12\r'),
+    (protocol.parseConfig, b'a\r'),
+    (protocol.replyAddress, b'\r'),
+    (protocol.parseData, b'aML500'),
+])
+def test_malformed_frames(parser, frame):
+    with pytest.raises(PumpProtocolError):
+        parser(frame)
@@ -0,0 +1,159 @@
+'''
+Vectorised runtime model and rate planner for MicroLab 500 transfers.
+
+transferTimes evaluates the same kinematics as backend.compileTransfer and
+backend.compileContinuousTransfer (rounded seconds per stroke, waste dumps,
+valve switches, a partial final stroke and command latency) for whole
+arrays of candidate parameters at once. planRates uses it to pick the
+aspirate/dispense rates with the shortest runtime within the pump's limits.
+
+    python timing.py 20000 --syringe-volume 500 --max-aspirate 6000
+    python timing.py --calibrate /dev/ttyUSB0
+    python timing.py 20000 --port /dev/ttyUSB0
+
+--calibrate saves the fitted model for the port in backend.TIMING_FILE, which
+the GUI, pumpd and the recipe and worklist runners load on connect. --port
+plans with the model saved for a port.
+'''
+
+import sys
+import json
+import argparse
+
+import numpy as np
+
+import backend
+
+
+def fitTimingModel(samples, stroke_steps=1000.0):
+    ## Least-squares fit of a TimingModel to measured (steps, seconds per stroke, valve switches, seconds) moves.
+    data = np.asarray(samples, dtype=float)
+    if len(data) < 3:
+        raise ValueError('At least three measured moves are needed to calibrate.')
+
+    design = np.column_stack([data[:, 0]/stroke_steps*data[:, 1], data[:, 2], np.ones(len(data))])
+    (speed_scale, valve_switch_time, command_latency), residuals, rank, singular = np.linalg.lstsq(design, data[:, 3], rcond=None)
+    return backend.TimingModel(float(speed_scale), max(float(valve_switch_time), 0.0), max(float(command_latency), 0.0))
+
+
+def digits(values):
+    # Number of decimal digits in positive integers.
+    return np.floor(np.log10(np.maximum(values, 1))) + 1
+
+
+def transferTimes(volume, aspirate, dispense, syringe_volume=500.0, stroke_steps=1000.0, start_travel=0.0,
+        syringe='A+B', timing=None, max_command_length=250):
+    ## Predicted seconds for transfers, every numeric argument may be an array (they are broadcast together).
+    timing = timing or backend.NOMINAL_TIMING
+    volume, aspirate, dispense, syringe_volume, start_travel = np.broadcast_arrays(
+        *[np.asarray(x, dtype=float) for x in (volume, aspirate, dispense, syringe_volume, start_travel)])
+
+    aspirate_speed = np.round(syringe_volume/(aspirate/60.0))
+    dispense_speed = np.round(syringe_volume/(dispense/60.0))
+    move = lambda steps, speed, switches: timing.moveTime(steps, speed, 0, stroke_steps) + switches*timing.valve_switch_time
+
+    full = np.floor(volume/syringe_volume)
+    remainder = volume - full*syringe_volume
+    partial = remainder > 0
+    strokes = full + partial
+    full_steps = np.floor(stroke_steps)
+    partial_steps = np.floor(remainder*stroke_steps/syringe_volume)
+    first_steps = np.where(full > 0, full_steps, partial_steps)
+    last_steps = np.where(partial, partial_steps, full_steps)
+
+    if syringe == backend.CONTINUOUS:
+        # Empty both syringes, then each half cycle overlaps one aspirate with the previous dispense.
+        seconds = np.where(start_travel > 0, move(start_travel, dispense_speed, 1), 0.0)
+        seconds = seconds + move(first_steps, aspirate_speed, 1)
+        full_pairs = np.maximum(full - 1, 0)
+        seconds = seconds + full_pairs*np.maximum(move(full_steps, aspirate_speed, 1), move(full_steps, dispense_speed, 1))
+        seconds = seconds + np.where(partial & (full > 0),
+            np.maximum(move(partial_steps, aspirate_speed, 1), move(full_steps, dispense_speed, 1)), 0.0)
+        seconds = seconds + move(last_steps, dispense_speed, 1)
+        commands = strokes + 1 + (start_travel > 0)
+    else:
+        # Every stroke after the first dumps a full syringe (unless it moves no steps), the first only if there is no room.
+        first_dump = start_travel + first_steps > stroke_steps
+        seconds = np.where(first_dump, move(start_travel, dispense_speed, 0), 0.0)
+        later_dumps = np.maximum(full - 1, 0) + (partial & (full > 0) & (partial_steps > 0))
+        seconds = seconds + later_dumps*move(full_steps, dispense_speed, 0)
+        seconds = seconds + move(full*full_steps + partial*partial_steps, aspirate_speed, 2*strokes)
+
+        # Roughly the command string length each stroke adds, to count the chunks.
+        stroke_length = (8 + digits(dispense_speed)) + (7 + digits(full_steps) + digits(aspirate_speed))
+        stroke_length = stroke_length*len(backend.SYRINGES[syringe])
+        commands = np.ceil(strokes*stroke_length/(max_command_length - 3))
+
+    return np.where(volume > 0, seconds + commands*timing.command_latency, 0.0)
+
+
+def planRates(volume, syringe_volume=500.0, syringe='A+B', start_travel=0.0, max_aspirate=None, max_dispense=None,
+        timing=None, stroke_steps=1000.0):
+    ## Fastest (aspirate, dispense, seconds) within the pump limits and the optional rate caps (ul/minute).
+    # Only whole seconds per stroke reach the instrument, so those are the candidates.
+    speeds = np.arange(backend.MIN_SECONDS_PER_STROKE, backend.MAX_SECONDS_PER_STROKE + 1, dtype=float)
+    rates = syringe_volume*60.0/speeds
+    aspirate, dispense = np.meshgrid(rates, rates, indexing='ij')
+
+    allowed = np.ones(aspirate.shape, dtype=bool)
+    if max_aspirate is not None:
+        allowed &= aspirate <= max_aspirate
+    if max_dispense is not None:
+        allowed &= dispense <= max_dispense
+    if not allowed.any():
+        raise ValueError('No rate within the pump limits satisfies the caps.')
+
+    seconds = transferTimes(volume, aspirate, dispense, syringe_volume, stroke_steps, start_travel, syringe, timing)
+    seconds = np.where(allowed, seconds, np.inf)
+    best = np.unravel_index(np.argmin(seconds), seconds.shape)
+    return float(aspirate[best]), float(dispense[best]), float(seconds[best])
+
+
+def calibrate(pump, syringe='A', syringe_volume=500.0, moves=((1000, 5), (500, 5), (1000, 10), (250, 20), (1000, 2))):
+    ## Runs (steps, seconds per stroke) test strokes on a connected pump and fits its timing model.
+    for steps, seconds_per_stroke in moves:
+        volume = steps*syringe_volume/1000.0
+        rate = syringe_volume*60.0/seconds_per_stroke
+        pump.pumpCmd(syringe, volume, rate, rate, syringe_volume, compiled=False)
+        pump.dispensePump(syringe, rate, syringe_volume)
+    return fitTimingModel(pump.moveSamples)
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('volume', type=float, nargs='?', help='Transfer volume in ul to plan.')
+    parser.add_argument('--syringe', default='A+B', choices=sorted(backend.SYRINGES))
+    parser.add_argument('--syringe-volume', type=float, default=500.0)
+    parser.add_argument('--max-aspirate', type=float, help='Aspirate rate cap, ul/minute.')
+    parser.add_argument('--max-dispense', type=float, help='Dispense rate cap, ul/minute.')
+    parser.add_argument('--calibrate', metavar='PORT', help='Measure test strokes on the pump at PORT and save the fitted model.')
+    parser.add_argument('--port', help='Plan with the model calibrated for this port.')
+    parser.add_argument('--timing-file', default=backend.TIMING_FILE, help='Calibrated models by port.')
+    args = parser.parse_args(argv)
+
+    timing = None
+    if args.port:
+        timing = backend.loadTimingModel(args.port, args.timing_file)
+    if args.calibrate:
+        backend.configureLogging()
+        pump = backend.pumpObject()
+        pump.connect(args.calibrate)
+        pump.initialise()
+        try:
+            timing = calibrate(pump, syringe_volume=args.syringe_volume)
+        finally:
+            pump.disconnect()
+        print(json.dumps(vars(timing), indent=2))
+        backend.saveTimingModel(timing, args.calibrate, args.timing_file)
+        print('Saved to %s.' % (args.timing_file))
+
+    if args.volume is not None:
+        aspirate, dispense, seconds = planRates(args.volume, args.syringe_volume, args.syringe,
+            max_aspirate=args.max_aspirate, max_dispense=args.max_dispense, timing=timing)
+        print('Aspirate %.0f ul/minute, dispense %.0f ul/minute: %.1f seconds.' % (aspirate, dispense, seconds))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
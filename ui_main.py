@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+## Form generated from reading UI file 'main.ui'
+##
+## Regenerate after editing main.ui with:
+##     pyside2-uic main.ui -o ui_main.py
+################################################################################
+
+from PySide2.QtCore import QCoreApplication, QMetaObject, QRect, Qt
+from PySide2.QtWidgets import (QComboBox, QFrame, QGroupBox, QLabel, QLineEdit, QPlainTextEdit,
+    QPushButton, QVBoxLayout, QWidget)
+
+
+class Ui_MainWindow(object):
+    def setupUi(self, MainWindow):
+        if not MainWindow.objectName():
+            MainWindow.setObjectName(u"MainWindow")
+        MainWindow.resize(746, 917)
+        MainWindow.setWindowOpacity(1.000000000000000)
+        self.centralwidget = QWidget(MainWindow)
+        self.centralwidget.setObjectName(u"centralwidget")
+        self.commCombo = QComboBox(self.centralwidget)
+        self.commCombo.setObjectName(u"commCombo")
+        self.commCombo.setGeometry(QRect(100, 12, 151, 26))
+        self.label = QLabel(self.centralwidget)
+        self.label.setObjectName(u"label")
+        self.label.setGeometry(QRect(20, 10, 81, 31))
+        self.line = QFrame(self.centralwidget)
+        self.line.setObjectName(u"line")
+        self.line.setGeometry(QRect(-30, 50, 781, 20))
+        self.line.setFrameShape(QFrame.HLine)
+        self.line.setFrameShadow(QFrame.Sunken)
+        self.commInitialise = QPushButton(self.centralwidget)
+        self.commInitialise.setObjectName(u"commInitialise")
+        self.commInitialise.setEnabled(False)
+        self.commInitialise.setGeometry(QRect(640, 10, 92, 32))
+        self.commInitialise.setCheckable(False)
+        self.commInitialise.setFlat(False)
+        self.commDisconnect = QPushButton(self.centralwidget)
+        self.commDisconnect.setObjectName(u"commDisconnect")
+        self.commDisconnect.setEnabled(False)
+        self.commDisconnect.setGeometry(QRect(510, 10, 111, 32))
+        self.pumpGo = QPushButton(self.centralwidget)
+        self.pumpGo.setObjectName(u"pumpGo")
+        self.pumpGo.setEnabled(True)
+        self.pumpGo.setGeometry(QRect(60, 260, 113, 32))
+        self.pumpStop = QPushButton(self.centralwidget)
+        self.pumpStop.setObjectName(u"pumpStop")
+        self.pumpStop.setEnabled(True)
+        self.pumpStop.setGeometry(QRect(200, 260, 113, 32))
+        self.label_3 = QLabel(self.centralwidget)
+        self.label_3.setObjectName(u"label_3")
+        self.label_3.setGeometry(QRect(10, 340, 101, 31))
+        self.pumpStatus = QLabel(self.centralwidget)
+        self.pumpStatus.setObjectName(u"pumpStatus")
+        self.pumpStatus.setGeometry(QRect(120, 340, 241, 31))
+        self.commRefresh = QPushButton(self.centralwidget)
+        self.commRefresh.setObjectName(u"commRefresh")
+        self.commRefresh.setGeometry(QRect(260, 10, 93, 32))
+        self.commConnect = QPushButton(self.centralwidget)
+        self.commConnect.setObjectName(u"commConnect")
+        self.commConnect.setGeometry(QRect(400, 10, 93, 32))
+        self.layoutWidget = QWidget(self.centralwidget)
+        self.layoutWidget.setObjectName(u"layoutWidget")
+        self.layoutWidget.setGeometry(QRect(18, 91, 131, 121))
+        self.verticalLayout = QVBoxLayout(self.layoutWidget)
+        self.verticalLayout.setObjectName(u"verticalLayout")
+        self.verticalLayout.setContentsMargins(0, 0, 0, 0)
+        self.label_2 = QLabel(self.layoutWidget)
+        self.label_2.setObjectName(u"label_2")
+
+        self.verticalLayout.addWidget(self.label_2)
+
+        self.label_4 = QLabel(self.layoutWidget)
+        self.label_4.setObjectName(u"label_4")
+
+        self.verticalLayout.addWidget(self.label_4)
+
+        self.label_5 = QLabel(self.layoutWidget)
+        self.label_5.setObjectName(u"label_5")
+
+        self.verticalLayout.addWidget(self.label_5)
+
+        self.label_6 = QLabel(self.layoutWidget)
+        self.label_6.setObjectName(u"label_6")
+
+        self.verticalLayout.addWidget(self.label_6)
+
+        self.layoutWidget1 = QWidget(self.centralwidget)
+        self.layoutWidget1.setObjectName(u"layoutWidget1")
+        self.layoutWidget1.setGeometry(QRect(150, 90, 131, 121))
+        self.verticalLayout_2 = QVBoxLayout(self.layoutWidget1)
+        self.verticalLayout_2.setObjectName(u"verticalLayout_2")
+        self.verticalLayout_2.setContentsMargins(0, 0, 0, 0)
+        self.syringeMode = QComboBox(self.layoutWidget1)
+        self.syringeMode.addItem("")
+        self.syringeMode.addItem("")
+        self.syringeMode.addItem("")
+        self.syringeMode.addItem("")
+        self.syringeMode.setObjectName(u"syringeMode")
+
+        self.verticalLayout_2.addWidget(self.syringeMode)
+
+        self.volume = QLineEdit(self.layoutWidget1)
+        self.volume.setObjectName(u"volume")
+
+        self.verticalLayout_2.addWidget(self.volume)
+
+        self.aspirate_rate = QLineEdit(self.layoutWidget1)
+        self.aspirate_rate.setObjectName(u"aspirate_rate")
+
+        self.verticalLayout_2.addWidget(self.aspirate_rate)
+
+        self.dispense_rate = QLineEdit(self.layoutWidget1)
+        self.dispense_rate.setObjectName(u"dispense_rate")
+
+        self.verticalLayout_2.addWidget(self.dispense_rate)
+
+        self.groupBox = QGroupBox(self.centralwidget)
+        self.groupBox.setObjectName(u"groupBox")
+        self.groupBox.setGeometry(QRect(400, 70, 271, 161))
+        self.label_7 = QLabel(self.groupBox)
+        self.label_7.setObjectName(u"label_7")
+        self.label_7.setGeometry(QRect(10, 30, 121, 24))
+        self.config_syringe_volume = QLineEdit(self.groupBox)
+        self.config_syringe_volume.setObjectName(u"config_syringe_volume")
+        self.config_syringe_volume.setGeometry(QRect(140, 30, 61, 21))
+        self.label_11 = QLabel(self.groupBox)
+        self.label_11.setObjectName(u"label_11")
+        self.label_11.setGeometry(QRect(210, 30, 51, 24))
+        self.layoutWidget2 = QWidget(self.centralwidget)
+        self.layoutWidget2.setObjectName(u"layoutWidget2")
+        self.layoutWidget2.setGeometry(QRect(290, 120, 91, 91))
+        self.verticalLayout_3 = QVBoxLayout(self.layoutWidget2)
+        self.verticalLayout_3.setObjectName(u"verticalLayout_3")
+        self.verticalLayout_3.setContentsMargins(0, 0, 0, 0)
+        self.volume_units = QComboBox(self.layoutWidget2)
+        self.volume_units.addItem("")
+        self.volume_units.addItem("")
+        self.volume_units.setObjectName(u"volume_units")
+
+        self.verticalLayout_3.addWidget(self.volume_units)
+
+        self.label_9 = QLabel(self.layoutWidget2)
+        self.label_9.setObjectName(u"label_9")
+
+        self.verticalLayout_3.addWidget(self.label_9)
+
+        self.label_10 = QLabel(self.layoutWidget2)
+        self.label_10.setObjectName(u"label_10")
+
+        self.verticalLayout_3.addWidget(self.label_10)
+
+        self.current_task = QLineEdit(self.centralwidget)
+        self.current_task.setObjectName(u"current_task")
+        self.current_task.setEnabled(False)
+        self.current_task.setGeometry(QRect(10, 370, 721, 21))
+        self.current_task.setAcceptDrops(False)
+        self.time_progress = QLineEdit(self.centralwidget)
+        self.time_progress.setObjectName(u"time_progress")
+        self.time_progress.setEnabled(False)
+        self.time_progress.setGeometry(QRect(10, 430, 721, 21))
+        self.time_progress.setAcceptDrops(False)
+        self.task_progress = QLineEdit(self.centralwidget)
+        self.task_progress.setObjectName(u"task_progress")
+        self.task_progress.setEnabled(False)
+        self.task_progress.setGeometry(QRect(10, 400, 721, 21))
+        self.task_progress.setAcceptDrops(False)
+        self.log_data_view = QPlainTextEdit(self.centralwidget)
+        self.log_data_view.setObjectName(u"log_data_view")
+        self.log_data_view.setEnabled(False)
+        self.log_data_view.setGeometry(QRect(10, 480, 731, 161))
+        self.log_data_view.setFocusPolicy(Qt.NoFocus)
+        self.log_data_view.setAcceptDrops(False)
+        self.log_data_view.setInputMethodHints(Qt.ImhNone)
+        self.log_data_view.setFrameShape(QFrame.StyledPanel)
+        self.log_data_view.setFrameShadow(QFrame.Sunken)
+        self.log_data_view.setUndoRedoEnabled(False)
+        self.log_data_view.setReadOnly(True)
+        self.plotArea = QWidget(self.centralwidget)
+        self.plotArea.setObjectName(u"plotArea")
+        self.plotArea.setGeometry(QRect(10, 650, 731, 261))
+        self.pumpDispense = QPushButton(self.centralwidget)
+        self.pumpDispense.setObjectName(u"pumpDispense")
+        self.pumpDispense.setEnabled(False)
+        self.pumpDispense.setGeometry(QRect(340, 260, 161, 32))
+        MainWindow.setCentralWidget(self.centralwidget)
+        self.commConnect.raise_()
+        self.layoutWidget.raise_()
+        self.layoutWidget1.raise_()
+        self.label.raise_()
+        self.line.raise_()
+        self.commInitialise.raise_()
+        self.commDisconnect.raise_()
+        self.pumpGo.raise_()
+        self.pumpStop.raise_()
+        self.label_3.raise_()
+        self.pumpStatus.raise_()
+        self.commCombo.raise_()
+        self.layoutWidget2.raise_()
+        self.commRefresh.raise_()
+        self.groupBox.raise_()
+        self.current_task.raise_()
+        self.time_progress.raise_()
+        self.task_progress.raise_()
+        self.log_data_view.raise_()
+        self.plotArea.raise_()
+        self.pumpDispense.raise_()
+
+        self.retranslateUi(MainWindow)
+
+        QMetaObject.connectSlotsByName(MainWindow)
+    # setupUi
+
+    def retranslateUi(self, MainWindow):
+        MainWindow.setWindowTitle(QCoreApplication.translate("MainWindow", u"Microlab 500 controller", None))
+        self.label.setText(QCoreApplication.translate("MainWindow", u"Com port:", None))
+        self.commInitialise.setText(QCoreApplication.translate("MainWindow", u"Initialise", None))
+        self.commDisconnect.setText(QCoreApplication.translate("MainWindow", u"Disconnect", None))
+        self.pumpGo.setText(QCoreApplication.translate("MainWindow", u"Pump", None))
+        self.pumpStop.setText(QCoreApplication.translate("MainWindow", u"Stop", None))
+        self.label_3.setText(QCoreApplication.translate("MainWindow", u"Pump status:", None))
+        self.pumpStatus.setText("")
+        self.commRefresh.setText(QCoreApplication.translate("MainWindow", u"Refresh", None))
+        self.commConnect.setText(QCoreApplication.translate("MainWindow", u"Connect", None))
+        self.label_2.setText(QCoreApplication.translate("MainWindow", u"Syringe selector:", None))
+        self.label_4.setText(QCoreApplication.translate("MainWindow", u"Volume:", None))
+        self.label_5.setText(QCoreApplication.translate("MainWindow", u"Aspirate rate:", None))
+        self.label_6.setText(QCoreApplication.translate("MainWindow", u"Dispense rate:", None))
+        self.syringeMode.setItemText(0, QCoreApplication.translate("MainWindow", u"A+B", None))
+        self.syringeMode.setItemText(1, QCoreApplication.translate("MainWindow", u"A", None))
+        self.syringeMode.setItemText(2, QCoreApplication.translate("MainWindow", u"B", None))
+        self.syringeMode.setItemText(3, QCoreApplication.translate("MainWindow", u"A+B continuous", None))
+
+        self.volume.setText(QCoreApplication.translate("MainWindow", u"400", None))
+        self.aspirate_rate.setText(QCoreApplication.translate("MainWindow", u"10000", None))
+        self.dispense_rate.setText(QCoreApplication.translate("MainWindow", u"10000", None))
+        self.groupBox.setTitle(QCoreApplication.translate("MainWindow", u"Config", None))
+        self.label_7.setText(QCoreApplication.translate("MainWindow", u"Syringe volume:", None))
+        self.config_syringe_volume.setText(QCoreApplication.translate("MainWindow", u"500", None))
+        self.label_11.setText(QCoreApplication.translate("MainWindow", u"µl", None))
+        self.volume_units.setItemText(0, QCoreApplication.translate("MainWindow", u"µl", None))
+        self.volume_units.setItemText(1, QCoreApplication.translate("MainWindow", u"ml", None))
+
+        self.label_9.setText(QCoreApplication.translate("MainWindow", u"µl/minute", None))
+        self.label_10.setText(QCoreApplication.translate("MainWindow", u"µl/minute", None))
+        self.current_task.setText("")
+        self.time_progress.setText("")
+        self.task_progress.setText("")
+        self.pumpDispense.setText(QCoreApplication.translate("MainWindow", u"Dispense to waste", None))
+    # retranslateUi
@@ -0,0 +1,263 @@
+'''
+Worklist planning for the MicroLab 500.
+
+A worklist is a CSV file of transfers, one per row:
+
+    name,volume,units,syringe,aspirate,dispense,group
+    sample 1,350,ul,A+B,6000,6000,0
+    sample 2,1.2,ml,A,1000,2500,0
+    wash,600,ul,A+B,6000,6000,1
+
+Only volume is required; the other columns default as in recipe steps and
+group to 0. Transfers are only reordered within a group, and groups run in
+ascending order.
+
+A syringe keeps filling across transfers until the next stroke does not
+fit, when it is dumped to waste at the rate of the transfer that needs the
+room. The planner packs the partial strokes of each syringe mode into as few
+syringe fills as it can (first fit decreasing, large transfers opening a
+fill with their last partial stroke), starts every fill with the fastest
+dispense rate in it and keeps equal rates together. The original and
+planned orders are both predicted with the backend timing model and the
+plan is only used if it is faster.
+
+    python worklist.py list.csv --dry-run
+    python worklist.py list.csv --port /dev/ttyUSB0
+'''
+
+import sys
+import csv
+import time
+import argparse
+import itertools
+
+import backend
+from recipe import Recipe, RecipeRunner, RecipeError
+
+
+EPSILON = 1e-6 # ul, slack when packing volumes into a syringe.
+
+
+def loadWorklist(path, syringe_volume=500.0):
+    ## Reads a CSV worklist into a Recipe of transfer steps.
+    steps = []
+    with open(path, newline='') as fh:
+        for row, record in enumerate(csv.DictReader(fh)):
+            step = dict((key.strip(), value.strip()) for key, value in record.items() if key and value and value.strip())
+            step.setdefault('name', 'row %d' % (row + 1))
+            step['action'] = 'transfer'
+            step['row'] = row + 1
+            try:
+                step['group'] = int(step.get('group', 0))
+                for key in ('volume', 'aspirate', 'dispense'):
+                    if key in step:
+                        step[key] = float(step[key])
+            except ValueError as e:
+                raise RecipeError('Row %d (%s): %s.' % (row + 1, step['name'], e))
+            steps.append(step)
+
+    if not steps:
+        raise RecipeError('%s has no transfers.' % (path))
+    worklist = Recipe(steps, path, syringe_volume)
+    worklist.validate()
+    return worklist
+
+
+def settings(step):
+    return (step['syringe'], float(step['aspirate']), float(step['dispense']))
+
+
+def simulate(worklist, steps, positions=None, stroke_steps=1000.0, timing=None):
+    ## (predicted seconds, dumps to waste, setting changes) of running steps in order from positions.
+    timing = timing or backend.NOMINAL_TIMING
+    positions = dict(positions or {'B': 0, 'C': 0})
+    seconds, dumps, changes, previous = 0.0, 0, 0, None
+    for step in steps:
+        syringe, aspirate, dispense = settings(step)
+        if syringe == backend.CONTINUOUS:
+            dumps += int(positions['B'] > 0 or positions['C'] > 0)
+            program = backend.compileContinuousTransfer(worklist.volume(step), aspirate, dispense, worklist.syringe_volume,
+                stroke_steps, positions, timing=timing)
+        else:
+            program = backend.compileTransfer(syringe, worklist.volume(step), aspirate, dispense, worklist.syringe_volume,
+                stroke_steps, positions, timing=timing)
+            dumps += sum(1 for phase in program.phases if phase[0] == 'Dispensing')
+        for command in program.commands:
+            backend.trackPositions(positions, command)
+
+        seconds += program.duration
+        changes += int(previous is not None and settings(step) != previous)
+        previous = settings(step)
+    return seconds, dumps, changes
+
+
+def packFills(worklist, steps):
+    '''
+    Orders the transfers of one syringe mode so their partial strokes share
+    syringe fills. Returns the fills as lists of steps.
+    '''
+    capacity = worklist.syringe_volume
+    fills = [] # [volume in the syringe, steps]
+
+    # A transfer of at least a syringe ends with its remainder in the syringe, and opens a fill.
+    for step in sorted(steps, key=lambda step: -worklist.volume(step)):
+        volume = worklist.volume(step)
+        if volume >= capacity:
+            remainder = volume % capacity
+            fills.append([remainder if remainder > EPSILON else capacity, [step]])
+            continue
+
+        # Best fit, preferring a fill already at the same rates.
+        room = [fill for fill in fills if fill[0] + volume <= capacity + EPSILON]
+        if room:
+            fill = max(room, key=lambda fill: (any(settings(other) == settings(step) for other in fill[1]), fill[0]))
+            fill[0] += volume
+            fill[1].append(step)
+        else:
+            fills.append([volume, [step]])
+
+    ordered = []
+    for volume, members in fills:
+        # The first transfer of a fill dumps the last one, so it should dispense fastest.
+        large = [step for step in members if worklist.volume(step) >= capacity]
+        small = sorted((step for step in members if worklist.volume(step) < capacity),
+            key=lambda step: (-float(step['dispense']), float(step['aspirate'])))
+        first = large or small[:1]
+        rest = sorted((step for step in members if step not in first), key=settings)
+        ordered.append((volume, first + rest))
+
+    # Equal rates together, and the fullest fill last, as it never has to be dumped.
+    ordered.sort(key=lambda fill: settings(fill[1][0]))
+    if ordered:
+        ordered.append(ordered.pop(max(range(len(ordered)), key=lambda index: ordered[index][0])))
+    return [members for volume, members in ordered]
+
+
+def planWorklist(worklist, positions=None, stroke_steps=1000.0, timing=None):
+    '''
+    (planned Recipe, report) for a worklist. report holds the predicted
+    seconds, dumps and setting changes of the original and planned orders.
+    '''
+    worklist.validate()
+    timing = timing or backend.NOMINAL_TIMING
+    start = dict(positions or {'B': 0, 'C': 0})
+
+    planned = []
+    state = dict(start)
+    for group, steps in itertools.groupby(sorted(worklist.steps, key=lambda step: step['group']), key=lambda step: step['group']):
+        steps = list(steps)
+        modes = {}
+        for step in steps:
+            modes.setdefault(step['syringe'], []).append(step)
+        parts = [list(itertools.chain.from_iterable(packFills(worklist, members))) for members in modes.values()]
+
+        # A handful of syringe modes at most, so every order of them is tried.
+        best = None
+        for order in itertools.permutations(parts):
+            candidate = list(itertools.chain.from_iterable(order))
+            seconds = simulate(worklist, candidate, state, stroke_steps, timing)[0]
+            if best is None or seconds < best[0]:
+                best = (seconds, candidate)
+        planned.extend(best[1])
+        for step in best[1]: # The next group starts where this one leaves the plungers.
+            state = positionsAfter(worklist, step, state, stroke_steps)
+
+    original = simulate(worklist, worklist.steps, start, stroke_steps, timing)
+    plan = simulate(worklist, planned, start, stroke_steps, timing)
+    used = plan[0] < original[0]
+    report = {
+        'transfers': len(worklist.steps),
+        'reordered': used,
+        'original_s': original[0],
+        'planned_s': plan[0] if used else original[0],
+        'original_dumps': original[1],
+        'planned_dumps': plan[1] if used else original[1],
+        'original_changes': original[2],
+        'planned_changes': plan[2] if used else original[2],
+    }
+    report['saved_s'] = report['original_s'] - report['planned_s']
+    return Recipe(planned if used else list(worklist.steps), worklist.name, worklist.syringe_volume), report
+
+
+def positionsAfter(worklist, step, positions, stroke_steps=1000.0):
+    ## Plunger positions once step has run from positions.
+    syringe, aspirate, dispense = settings(step)
+    positions = dict(positions)
+    if syringe == backend.CONTINUOUS:
+        program = backend.compileContinuousTransfer(worklist.volume(step), aspirate, dispense, worklist.syringe_volume,
+            stroke_steps, positions)
+    else:
+        program = backend.compileTransfer(syringe, worklist.volume(step), aspirate, dispense, worklist.syringe_volume,
+            stroke_steps, positions)
+    for command in program.commands:
+        backend.trackPositions(positions, command)
+    return positions
+
+
+
+def runPlan(pump, plan, report):
+    ## Runs a planned worklist, adding the measured seconds to report.
+    t0 = time.monotonic()
+    results = RecipeRunner(pump, plan).run()
+    report['actual_s'] = time.monotonic() - t0
+    report['completed'] = len(results)
+    return results
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('worklist', help='CSV worklist.')
+    parser.add_argument('--syringe-volume', type=float, default=500.0)
+    parser.add_argument('--keep-order', action='store_true', help='Run the transfers in the order given.')
+    parser.add_argument('--dry-run', action='store_true', help='Print the plan and its predicted runtime only.')
+    parser.add_argument('--port', help='Serial port of the pump.')
+    args = parser.parse_args(argv)
+
+    try:
+        worklist = loadWorklist(args.worklist, args.syringe_volume)
+    except (RecipeError, OSError) as e:
+        print(e)
+        return 1
+    pump = None
+    positions = None
+    if not args.dry_run:
+        if not args.port:
+            parser.error('--port is required unless --dry-run is given.')
+        backend.configureLogging()
+        pump = backend.pumpObject()
+        pump.timingPath = backend.TIMING_FILE
+        pump.connect(args.port)
+        if pump.__PUMP_CONNECTION__ != 1:
+            print('Unable to connect to %s.' % (args.port))
+            return 1
+        positions = pump.currentPositions()
+
+    timing = pump.timingModel if pump is not None else backend.loadTimingModel(args.port) if args.port else None
+    plan, report = planWorklist(worklist, positions, timing=timing)
+    if args.keep_order:
+        plan = worklist
+        report.update(reordered=False, planned_s=report['original_s'], planned_dumps=report['original_dumps'],
+            planned_changes=report['original_changes'], saved_s=0.0)
+
+    for index, step in enumerate(plan.steps):
+        print('%3d  row %-4d %-24s %8.1f ul  %-15s %6d %6d' % (index + 1, step['row'], step['name'], plan.volume(step),
+            step['syringe'], float(step['aspirate']), float(step['dispense'])))
+    print('Predicted %.1f s in the given order, %.1f s planned (%.1f s saved).' % (
+        report['original_s'], report['planned_s'], report['saved_s']))
+    print('Dumps to waste %d -> %d, rate or syringe changes %d -> %d.' % (report['original_dumps'], report['planned_dumps'],
+        report['original_changes'], report['planned_changes']))
+    if pump is None:
+        return 0
+
+    try:
+        runPlan(pump, plan, report)
+    finally:
+        pump.disconnect()
+    print('Ran %d of %d transfers in %.1f s, %.1f s predicted.' % (report['completed'], report['transfers'],
+        report['actual_s'], report['planned_s']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())